@@ -0,0 +1,88 @@
+"""
+Benchmark: db_manager.insert_data (pandas conversion + temp table + INSERT ON CONFLICT) versus
+db_manager.bulk_insert_data (Arrow record batches straight into a table without the UNIQUE key, kept free of
+duplicates by the load ledger).
+
+Synthetic forecast hours are built with hrrr_processor.assemble_rows and loaded hour by hour into
+fresh DuckDB files, the way StreamingWriter does during an ingest.
+
+Usage:
+    python bench_db_insert.py --rows 10000000 --hours 49
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+from config import GRIB_VARIABLES
+from db_manager import bulk_insert_data, create_table_if_not_exists, insert_data
+from hrrr_processor import assemble_rows
+from utils import get_grib_s3_uri
+
+GRID_SHAPE = (1059, 1799)
+
+
+def build_hours(n_rows: int, n_hours: int, seed: int) -> list:
+    rng = np.random.default_rng(seed)
+    n_points = max(1, n_rows // (n_hours * len(GRIB_VARIABLES)))
+    lats, lons = np.meshgrid(np.linspace(21.1, 52.6, GRID_SHAPE[0]), np.linspace(225.9, 299.1, GRID_SHAPE[1]), indexing="ij")
+    flat_index = rng.choice(GRID_SHAPE[0] * GRID_SHAPE[1], n_points, replace=False)
+    iy, ix = np.unravel_index(flat_index, GRID_SHAPE)
+    run_time_utc = pd.Timestamp("2025-01-01 06:00", tz="UTC")
+
+    hours = []
+    for forecast_hour in range(n_hours):
+        fields = {var_name: rng.random(GRID_SHAPE, dtype=np.float32) for var_name in GRIB_VARIABLES}
+        hours.append(
+            assemble_rows(
+                fields,
+                iy,
+                ix,
+                lats,
+                lons,
+                run_time_utc,
+                run_time_utc + pd.Timedelta(hours=forecast_hour),
+                get_grib_s3_uri(run_time_utc.date(), forecast_hour),
+            )
+        )
+    return hours
+
+
+def run(method: str, hours: list, db_dir: str) -> float:
+    con = duckdb.connect(os.path.join(db_dir, f"{method}.db"))
+    create_table_if_not_exists(con, bulk=method == "bulk")
+    start = time.perf_counter()
+    for data_df in hours:
+        if method == "bulk":
+            bulk_insert_data(con, data_df, unique_key=False)
+        else:
+            insert_data(con, data_df.copy())  # insert_data converts columns in place
+    duration = time.perf_counter() - start
+    con.close()
+    return duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the temp-table insert path with the Arrow bulk-load path.")
+    parser.add_argument("--rows", type=int, default=10_000_000, help="Total rows to load.")
+    parser.add_argument("--hours", type=int, default=49, help="Number of forecast hours the rows are split into.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    hours = build_hours(args.rows, args.hours, args.seed)
+    total_rows = sum(len(data_df) for data_df in hours)
+    print(f"Loading {total_rows} rows in {len(hours)} forecast hours")
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        for method in ["temp-table", "bulk"]:
+            duration = run(method, hours, db_dir)
+            print(f"  {method:>10}: {duration:8.2f} s  ({total_rows / duration:,.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
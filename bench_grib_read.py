@@ -0,0 +1,77 @@
+"""
+Benchmark: one cfgrib open per variable (the previous extract_data_from_grib approach)
+versus the single-pass reader in grib_reader.py, with and without its persisted message index.
+
+Usage:
+    python bench_grib_read.py hrrr.t06z.wrfsfcf00.grib2 --repeat 3
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import xarray as xr
+
+import grib_reader
+from config import GRIB_VARIABLES, MESSAGE_INDEX_SUFFIX, VARIABLE_MAP
+from grib_reader import read_grib_fields
+
+
+def read_per_variable_cfgrib(grib_file: str, variables: list) -> dict:
+    """Opens the file once per variable with cfgrib's filter_by_keys, as extract_data_from_grib used to."""
+    fields = {}
+    for var_name in variables:
+        var_ds = xr.open_dataset(
+            grib_file,
+            engine="cfgrib",
+            backend_kwargs={"filter_by_keys": VARIABLE_MAP[var_name], "decode_timedelta": False, "indexpath": ""},
+        )
+        fields[var_name] = var_ds[list(var_ds.data_vars)[0]].values
+        var_ds.close()
+    return fields
+
+
+def read_without_index(grib_file: str, variables: list) -> dict:
+    """Single-pass reader forced to rescan the file: no message index sidecar, no memoized grid coordinates."""
+    index_path = f"{grib_file}{MESSAGE_INDEX_SUFFIX}"
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    grib_reader._grid_coordinates.clear()
+    return read_grib_fields(grib_file, variables)
+
+
+def best_of(func, repeat: int) -> tuple:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-variable cfgrib opens with the single-pass GRIB reader.")
+    parser.add_argument("grib_file", help="Path to a HRRR wrfsfc GRIB2 file.")
+    parser.add_argument("--variables", default=",".join(GRIB_VARIABLES))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    variables = [v.strip() for v in args.variables.split(",")]
+
+    cfgrib_time, cfgrib_fields = best_of(lambda: read_per_variable_cfgrib(args.grib_file, variables), args.repeat)
+    scan_time, _ = best_of(lambda: read_without_index(args.grib_file, variables), args.repeat)
+    single_time, grib = best_of(lambda: read_grib_fields(args.grib_file, variables), args.repeat)
+
+    for var_name in variables:
+        if not np.allclose(cfgrib_fields[var_name], grib["fields"][var_name], equal_nan=True):
+            print(f"WARNING: values differ for {var_name}")
+
+    print(f"{len(variables)} variables, best of {args.repeat}")
+    print(f"  cfgrib, one open per variable: {cfgrib_time:8.3f} s")
+    print(f"  single-pass reader, full scan: {scan_time:8.3f} s")
+    print(f"  single-pass reader, indexed:   {single_time:8.3f} s")
+    print(f"  speedup (scan / indexed):      {cfgrib_time / scan_time:8.1f}x / {cfgrib_time / single_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
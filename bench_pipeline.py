@@ -0,0 +1,298 @@
+"""
+Benchmark: the ingest pipeline end to end and stage by stage, fully offline.
+
+Synthetic HRRR files (see synthetic_hrrr.py) are served by the local S3 stand-in, then each stage is timed on
+its own: fetching every forecast hour into an empty cache, scanning and decoding every message of every file,
+the nearest-point (or interpolation) lookup, extracting the points from each file, and inserting the rows into
+a fresh DuckDB file. Finally the whole pipeline runs again from an empty cache, as hrrr_ingest.py would.
+
+Each run is appended to a JSON history and compared with the last run of the same configuration, so
+regressions show up as stages that got slower.
+
+Usage:
+    python bench_pipeline.py --points 10000 --hours 6 --fetch-mode partial
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import duckdb
+import numpy as np
+
+import grib_reader
+import grid_index
+from cache_manager import get_cache_manager
+from config import (
+    ALL_VARIABLES,
+    DEFAULT_DECODE_WORKERS,
+    DEFAULT_DOWNLOAD_WORKERS,
+    DEFAULT_INTERP,
+    FETCH_MODES,
+    S3_BUCKET_URL,
+    STORAGE_SCHEMAS,
+    setup_logging,
+)
+from derived import source_variables
+from db_manager import StreamingWriter, create_table_if_not_exists
+from file_fetch import get_cache_path, get_grib_file_path
+from grib_reader import decode_fields, load_grid_coordinates, read_grib_header, scan_grib_messages
+from hrrr_processor import extract_data_from_grib
+from local_s3 import start_local_s3
+from metrics import get_metrics, write_json_report
+from pipeline import run_pipeline
+from s3_async import AsyncS3Client
+from scheduler import plan_tasks
+from synthetic_hrrr import SYNTHETIC_RUN_DATE, write_fixtures
+from utils import points_digest
+
+RUN_HOUR = 6
+# A stage this much slower than in the previous run of the same configuration is flagged
+REGRESSION_RATIO = 1.2
+
+
+def random_points(grib_file: str, n_points: int, seed: int) -> tuple:
+    """Points scattered over the grid: random grid cells, jittered by up to a grid cell, longitudes in -180..180."""
+    lats, lons = load_grid_coordinates(grib_file, scan_grib_messages(grib_file)[0])
+    rng = np.random.default_rng(seed)
+    iy, ix = rng.integers(0, lats.shape[0], n_points), rng.integers(0, lats.shape[1], n_points)
+    jitter = rng.uniform(-0.015, 0.015, (2, n_points))
+    point_lats = lats[iy, ix] + jitter[0]
+    point_lons = (lons[iy, ix] + jitter[1] + 180.0) % 360.0 - 180.0
+    return point_lats.astype(np.float64), point_lons.astype(np.float64)
+
+
+def forget_memoized_grids():
+    """Drops the grid coordinates, KD-trees and point lookups memoized in this process (not the ones on disk)."""
+    grib_reader._grid_coordinates.clear()
+    grid_index._trees.clear()
+    grid_index._lookups.clear()
+
+
+def clear_cache(tasks: list, fetch_mode: str, variables: list):
+    for task in tasks:
+        get_cache_manager().remove(get_cache_path(task.run_date, task.forecast_hour, fetch_mode, variables, task.run_hour))
+
+
+def bench_fetch(s3_client, tasks, fetch_mode, variables, download_workers) -> tuple:
+    def fetch(task):
+        return get_grib_file_path(
+            s3_client, S3_BUCKET_URL, task.run_date, task.forecast_hour, fetch_mode, variables, run_hour=task.run_hour
+        )
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(download_workers) as pool:
+        grib_files = list(pool.map(fetch, tasks))
+    seconds = time.perf_counter() - start
+    nbytes = sum(os.path.getsize(path) for path in grib_files)
+    return grib_files, {"seconds": seconds, "bytes": nbytes, "bytes_per_second": nbytes / seconds}
+
+
+def bench_decode(grib_files: list, variables: list) -> tuple:
+    """Scans each file without its message index or memoized coordinates, then decodes every message whole."""
+    scan_seconds = decode_seconds = 0.0
+    messages = 0
+    for grib_file in grib_files:
+        forget_memoized_grids()
+        start = time.perf_counter()
+        header = read_grib_header(grib_file, variables)
+        scan_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        messages += len(decode_fields(grib_file, header["messages"]))
+        decode_seconds += time.perf_counter() - start
+    return {"seconds": scan_seconds, "files": len(grib_files)}, {
+        "seconds": decode_seconds,
+        "messages": messages,
+        "messages_per_second": messages / decode_seconds,
+    }
+
+
+def bench_lookup(grib_file: str, point_lats, point_lons, interp: str) -> dict:
+    """The point lookup of a fresh decode worker: the grid index is loaded from disk, the lookup is not memoized."""
+    header = read_grib_header(grib_file, ["temperature_2m"])
+    # The first run on a host builds and saves the grid index; only loading it is part of the measurement
+    grid_index.compute_sampling(header["latitude"], header["longitude"], point_lats[:1], point_lons[:1], interp)
+    forget_memoized_grids()
+    header = read_grib_header(grib_file, ["temperature_2m"])
+    start = time.perf_counter()
+    grid_index.compute_sampling(header["latitude"], header["longitude"], point_lats, point_lons, interp)
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "points_per_second": len(point_lats) / seconds}
+
+
+def bench_extract(grib_files, tasks, point_lats, point_lons, variables, interp) -> tuple:
+    frames = []
+    start = time.perf_counter()
+    for grib_file, task in zip(grib_files, tasks):
+        frames.append(extract_data_from_grib(grib_file, task.source_s3, point_lats, point_lons, variables, interp))
+    seconds = time.perf_counter() - start
+    rows = sum(len(data_df) for data_df in frames)
+    return frames, {"seconds": seconds, "rows": rows, "rows_per_second": rows / seconds}
+
+
+def bench_insert(frames: list, db_path: str, digest: str, schema: str, bulk: bool, interp: str) -> dict:
+    con = duckdb.connect(db_path)
+    create_table_if_not_exists(con, schema, bulk=bulk)
+    writer = StreamingWriter(con, digest, bulk=bulk, schema=schema, interp=interp)
+    start = time.perf_counter()
+    for data_df in frames:
+        writer.add(data_df.copy())  # the temp-table path converts columns in place
+    writer.close()
+    seconds = time.perf_counter() - start
+    con.close()
+    return {"seconds": seconds, "rows": writer.written_rows, "rows_per_second": writer.written_rows / seconds}
+
+
+def bench_end_to_end(s3_client, tasks, point_lats, point_lons, variables, args, db_path: str, digest: str) -> dict:
+    con = duckdb.connect(db_path)
+    create_table_if_not_exists(con, args.schema, bulk=args.bulk_load)
+    writer = StreamingWriter(con, digest, bulk=args.bulk_load, schema=args.schema, interp=args.interp)
+    forget_memoized_grids()  # decode workers start out like the ones of a fresh ingest
+    get_metrics().reset()
+    start = time.perf_counter()
+    results = run_pipeline(
+        s3_client,
+        tasks,
+        (point_lats, point_lons),
+        variables,
+        fetch_mode=args.fetch_mode,
+        download_workers=args.download_workers,
+        decode_workers=args.decode_workers,
+        interp=args.interp,
+    )
+    for _, data_df in results:
+        writer.add(data_df)
+    writer.close()
+    seconds = time.perf_counter() - start
+    con.close()
+    timings = get_metrics().snapshot()["timings"]
+    return {
+        "seconds": seconds,
+        "rows": writer.written_rows,
+        "rows_per_second": writer.written_rows / seconds,
+        # Totals across all threads and workers, showing which stage bounds the pipeline
+        "stage_totals": {
+            "download": timings.get("download", [0, 0.0])[1],
+            "decode": sum(total for name, (_, total, _) in timings.items() if name.startswith("decode.")),
+            "db.flush": timings.get("db.flush", [0, 0.0])[1],
+        },
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path: str) -> dict:
+    if not os.path.exists(path):
+        return {"runs": []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(record: dict, history: dict):
+    """Prints each stage next to the last run with the same configuration, flagging regressions."""
+    previous = next((run for run in reversed(history["runs"]) if run["config"] == record["config"]), None)
+    for stage, result in record["stages"].items():
+        line = f"  {stage:>10}: {result['seconds']:8.3f} s"
+        if previous and stage in previous["stages"]:
+            ratio = result["seconds"] / max(previous["stages"][stage]["seconds"], 1e-9)
+            line += f"  ({ratio:5.2f}x of {previous['commit'] or 'previous run'})"
+            if ratio > REGRESSION_RATIO:
+                line += "  REGRESSION"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ingest pipeline offline on synthetic HRRR files.")
+    parser.add_argument("--points", type=int, default=1000, help="Number of random points to extract.")
+    parser.add_argument("--hours", type=int, default=2, help="Last forecast hour (f00 to f<hours>).")
+    parser.add_argument("--variables", default=",".join(ALL_VARIABLES), help="Comma separated variables to ingest.")
+    parser.add_argument("--fetch-mode", choices=FETCH_MODES, default="full")
+    parser.add_argument("--interp", default=DEFAULT_INTERP)
+    parser.add_argument("--schema", choices=STORAGE_SCHEMAS, default="wide")
+    parser.add_argument("--bulk-load", action="store_true")
+    parser.add_argument("--download-workers", type=int, default=DEFAULT_DOWNLOAD_WORKERS)
+    parser.add_argument("--decode-workers", type=int, default=DEFAULT_DECODE_WORKERS)
+    parser.add_argument("--fixtures", default="bench_fixtures", help="Directory of synthetic files, reused across runs.")
+    parser.add_argument("--history", default="bench_history.json", help="JSON file every run is appended to.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    setup_logging()
+
+    variables = [var.strip() for var in args.variables.split(",")]
+    grib_paths = write_fixtures(args.fixtures, args.hours, SYNTHETIC_RUN_DATE, RUN_HOUR, args.seed)
+    point_lats, point_lons = random_points(grib_paths[0], args.points, args.seed)
+    digest = points_digest(point_lats, point_lons, interp=args.interp)
+    tasks = sorted(
+        plan_tasks([SYNTHETIC_RUN_DATE], [RUN_HOUR], args.hours, variables, fetch_mode=args.fetch_mode),
+        key=lambda task: task.forecast_hour,
+    )
+
+    server, endpoint_url = start_local_s3(args.fixtures)
+    s3_client = AsyncS3Client(endpoint_url=endpoint_url, max_connections=args.download_workers * 2)
+    stages = {}
+    try:
+        with tempfile.TemporaryDirectory() as db_dir:
+            clear_cache(tasks, args.fetch_mode, variables)
+            grib_files, stages["fetch"] = bench_fetch(s3_client, tasks, args.fetch_mode, variables, args.download_workers)
+            stages["scan"], stages["decode"] = bench_decode(grib_files, source_variables(variables))
+            stages["lookup"] = bench_lookup(grib_files[0], point_lats, point_lons, args.interp)
+            frames, stages["extract"] = bench_extract(grib_files, tasks, point_lats, point_lons, variables, args.interp)
+            stages["insert"] = bench_insert(
+                frames, os.path.join(db_dir, "insert.db"), digest, args.schema, args.bulk_load, args.interp
+            )
+
+            clear_cache(tasks, args.fetch_mode, variables)
+            stages["end_to_end"] = bench_end_to_end(
+                s3_client, tasks, point_lats, point_lons, variables, args, os.path.join(db_dir, "pipeline.db"), digest
+            )
+            clear_cache(tasks, args.fetch_mode, variables)
+    finally:
+        s3_client.close()
+        server.shutdown()
+
+    record = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": {
+            "points": args.points,
+            "hours": args.hours,
+            "variables": variables,
+            "fetch_mode": args.fetch_mode,
+            "interp": args.interp,
+            "schema": args.schema,
+            "bulk_load": args.bulk_load,
+            "download_workers": args.download_workers,
+            "decode_workers": args.decode_workers,
+            "seed": args.seed,
+        },
+        "stages": stages,
+    }
+    history = load_history(args.history)
+    print(f"{args.points} points, {len(tasks)} files, {len(variables)} variables, fetch mode {args.fetch_mode}")
+    compare(record, history)
+    history["runs"].append(record)
+    write_json_report(history, args.history)
+    print(f"Appended to {args.history}")
+
+
+if __name__ == "__main__":
+    main()
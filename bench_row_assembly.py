@@ -0,0 +1,81 @@
+"""
+Benchmark: per-(point, variable) dict rows (the previous extract_data_from_grib approach)
+versus columnar row assembly in hrrr_processor.assemble_rows.
+
+Runs on synthetic HRRR-sized fields, so no GRIB file is needed. Reports wall time and peak
+Python memory (tracemalloc) for building the output DataFrame.
+
+Usage:
+    python bench_row_assembly.py --points 1000,10000,100000
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from config import GRIB_VARIABLES
+from hrrr_processor import assemble_rows
+
+GRID_SHAPE = (1059, 1799)
+
+
+def assemble_rows_dicts(fields, iy, ix, lats, lons, run_time_utc, valid_time_utc, source_s3) -> pd.DataFrame:
+    """One dict per (point, variable), then pd.DataFrame(list_of_dicts)."""
+    extracted_data = []
+    for var_name, data_array in fields.items():
+        for y, x in zip(iy, ix):
+            extracted_data.append(
+                {
+                    "valid_time_utc": valid_time_utc,
+                    "run_time_utc": run_time_utc,
+                    "latitude": lats[y, x],
+                    "longitude": lons[y, x],
+                    "variable": var_name,
+                    "value": float(data_array[y, x]),
+                    "source_s3": source_s3,
+                }
+            )
+    return pd.DataFrame(extracted_data)
+
+
+def measure(func, *args) -> tuple:
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare dict-based and columnar row assembly.")
+    parser.add_argument("--points", default="1000,10000,100000", help="Comma separated point counts.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    lats, lons = np.meshgrid(np.linspace(21.1, 52.6, GRID_SHAPE[0]), np.linspace(225.9, 299.1, GRID_SHAPE[1]), indexing="ij")
+    fields = {var_name: rng.random(GRID_SHAPE, dtype=np.float32) * 1000 for var_name in GRIB_VARIABLES}
+    run_time_utc = pd.Timestamp("2025-01-01 06:00", tz="UTC")
+    valid_time_utc = pd.Timestamp("2025-01-01 07:00", tz="UTC")
+    source_s3 = "s3://noaa-hrrr-bdp-pds.s3.amazonaws.com/hrrr.20250101/conus/hrrr.t06z.wrfsfcf01.grib2"
+
+    print(f"{len(fields)} variables on a {GRID_SHAPE[0]}x{GRID_SHAPE[1]} grid")
+    print(f"{'points':>8} {'method':>9} {'rows':>10} {'time (s)':>9} {'peak MB':>8} {'df MB':>7}")
+    for n_points in [int(n) for n in args.points.split(",")]:
+        iy = rng.integers(0, GRID_SHAPE[0], n_points)
+        ix = rng.integers(0, GRID_SHAPE[1], n_points)
+        row_args = (fields, iy, ix, lats, lons, run_time_utc, valid_time_utc, source_s3)
+
+        for method, func in [("dicts", assemble_rows_dicts), ("columnar", assemble_rows)]:
+            duration, peak, data_df = measure(func, *row_args)
+            df_mb = data_df.memory_usage(deep=True).sum() / 1e6
+            print(f"{n_points:>8} {method:>9} {len(data_df):>10} {duration:>9.3f} {peak / 1e6:>8.1f} {df_mb:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from config import CACHE_DIR, CACHE_INDEX_FILE, CACHE_SIZE_LIMIT, GRID_INDEX_DIR, MESSAGE_INDEX_SUFFIX
+from utils import file_lock
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class CacheManager:
+    """
+    Keeps the GRIB cache under a size limit by evicting least-recently-used files before each write.
+
+    The size and last access time of every cached file are kept in a small JSON index (CACHE_INDEX_FILE),
+    so startup does not walk the cache directory; the directory is only scanned when the index is missing.
+    Pinned files are never evicted. Pins are stored per process id, so several runs on one host can share
+    the cache and pins left behind by a dead process are ignored. A file is only evicted while its eviction holds
+    the file's download lock (see file_fetch.cached_download), so no one is fetching or opening it meanwhile.
+
+    A file's size includes its message index sidecar, and evicting it also deletes the sidecar and the lock file.
+    The persisted grid index (GRID_INDEX_DIR) counts against the limit but is never evicted. Space reserved for
+    downloads in progress is kept in the index per process id too, so concurrent runs stay under the limit together.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = CACHE_DIR,
+        size_limit: int = CACHE_SIZE_LIMIT,
+        index_file: str = CACHE_INDEX_FILE,
+        grid_index_dir: str = GRID_INDEX_DIR,
+    ):
+        self.cache_dir = cache_dir
+        self.size_limit = size_limit
+        self.index_file = index_file
+        self.grid_index_dir = grid_index_dir
+        self._lock = threading.Lock()
+
+    # --- index persistence ---
+
+    def _load(self) -> dict:
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+            index.setdefault("reserved", {})  # indexes written before reservations were shared
+            return index
+        except FileNotFoundError:
+            return self._scan()
+        except ValueError:
+            logging.warning(f"Cache index {self.index_file} is corrupt, rebuilding it.")
+            return self._scan()
+
+    def _scan(self) -> dict:
+        """Builds the index from the files on disk (only needed when there is no index yet)."""
+        files = {}
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".grib2"):
+                    path = os.path.join(root, name)
+                    files[os.path.relpath(path, self.cache_dir)] = {
+                        "size": self._disk_size(path),
+                        "last_access": os.stat(path).st_mtime,
+                    }
+        return {"files": files, "pins": {}, "reserved": {}}
+
+    def _save(self, index: dict):
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        tmp_path = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_file)
+
+    @contextmanager
+    def _index(self):
+        """Loads, yields and saves the index while holding both the thread and the inter-process lock."""
+        with self._lock, file_lock(f"{self.index_file}.lock"):
+            index = self._load()
+            yield index
+            self._save(index)
+
+    def _key(self, path: str) -> str:
+        return os.path.relpath(os.path.abspath(path), self.cache_dir)
+
+    @staticmethod
+    def _is_pinned(index: dict, key: str) -> bool:
+        return any(_pid_alive(pid) for pid in index["pins"].get(key, []))
+
+    @staticmethod
+    def _pin(index: dict, key: str):
+        pids = index["pins"].setdefault(key, [])
+        pids.append(os.getpid())
+
+    @staticmethod
+    def _disk_size(path: str) -> int:
+        """Size of a cached GRIB plus its message index sidecar, if it has been written yet."""
+        size = os.path.getsize(path)
+        try:
+            size += os.path.getsize(path + MESSAGE_INDEX_SUFFIX)
+        except FileNotFoundError:
+            pass
+        return size
+
+    @staticmethod
+    def _delete(path: str, lock: bool = False):
+        """Deletes a GRIB and its message index, and its lock file if `lock` (only while holding that lock)."""
+        for deleted_path in (path, path + MESSAGE_INDEX_SUFFIX) + ((f"{path}.lock",) if lock else ()):
+            try:
+                os.remove(deleted_path)
+            except FileNotFoundError:
+                pass
+
+    def _grid_index_size(self) -> int:
+        try:
+            with os.scandir(self.grid_index_dir) as entries:
+                return sum(entry.stat().st_size for entry in entries if entry.is_file())
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def _reserve(index: dict, nbytes: int):
+        """Adds `nbytes` (negative to release) to this process's reservation and drops those of dead processes."""
+        reserved = index["reserved"]
+        pid = str(os.getpid())
+        reserved[pid] = max(0, reserved.get(pid, 0) + nbytes)
+        for owner in list(reserved):
+            if not reserved[owner] or not _pid_alive(int(owner)):
+                del reserved[owner]
+
+    # --- public API ---
+
+    def total_size(self) -> int:
+        with self._index() as index:
+            return sum(entry["size"] for entry in index["files"].values()) + self._grid_index_size()
+
+    def ensure_space(self, nbytes: int):
+        """
+        Evicts least-recently-used, unpinned files until `nbytes` more fit under the size limit, and reserves
+        that space for a download in progress. Call `add` (or `release`) once the download finishes.
+        """
+        with self._index() as index:
+            self._reserve(index, 0)  # forgets reservations of processes that died mid-download
+            files = index["files"]
+            used = sum(entry["size"] for entry in files.values()) + sum(index["reserved"].values())
+            used += self._grid_index_size()
+            for key in sorted(files, key=lambda k: files[k]["last_access"]):
+                if used + nbytes <= self.size_limit:
+                    break
+                if self._is_pinned(index, key):
+                    continue
+                path = os.path.join(self.cache_dir, key)
+                # Not waiting for the lock: its holder may be waiting for the index lock held here
+                with file_lock(f"{path}.lock", blocking=False) as locked:
+                    if not locked:
+                        continue
+                    self._delete(path, lock=True)
+                used -= files.pop(key)["size"]
+                index["pins"].pop(key, None)
+                logging.info(f"Evicted {key} from cache.")
+
+            if used + nbytes > self.size_limit:
+                logging.warning(
+                    f"Cache is over its {self.size_limit / 1e9:.1f} GB limit, all remaining files are pinned or in use."
+                )
+            self._reserve(index, nbytes)
+
+    def release(self, nbytes: int):
+        """Gives back space reserved by `ensure_space` for a download that did not complete."""
+        with self._index() as index:
+            self._reserve(index, -nbytes)
+
+    def add(self, path: str, reserved: int = 0, pin: bool = False):
+        """Registers a newly written file, releasing the space reserved for it."""
+        with self._index() as index:
+            key = self._key(path)
+            index["files"][key] = {"size": self._disk_size(path), "last_access": time.time()}
+            if pin:
+                self._pin(index, key)
+            self._reserve(index, -reserved)
+
+    def touch(self, path: str, pin: bool = False):
+        """Marks a cached file as just used (cache hit), picking up the size of a sidecar written since."""
+        with self._index() as index:
+            key = self._key(path)
+            index["files"][key] = {"size": self._disk_size(path), "last_access": time.time()}
+            if pin:
+                self._pin(index, key)
+
+    def remove(self, path: str):
+        """Deletes a cached file, pinned or not, and drops it from the index."""
+        with self._index() as index:
+            key = self._key(path)
+            self._delete(path)
+            index["files"].pop(key, None)
+            index["pins"].pop(key, None)
+
+    def pin(self, path: str):
+        with self._index() as index:
+            self._pin(index, self._key(path))
+
+    def unpin(self, path: str):
+        with self._index() as index:
+            key = self._key(path)
+            if key in index["files"] and os.path.exists(path):
+                index["files"][key]["size"] = self._disk_size(path)  # the decode may have written its sidecar
+            pids = index["pins"].get(key, [])
+            if os.getpid() in pids:
+                pids.remove(os.getpid())
+            # Drop pins of processes that are gone while we are here
+            pids[:] = [pid for pid in pids if _pid_alive(pid)]
+            if not pids:
+                index["pins"].pop(key, None)
+
+    @contextmanager
+    def pinned(self, paths: list):
+        """Pins `paths` for the duration of the block."""
+        for path in paths:
+            self.pin(path)
+        try:
+            yield
+        finally:
+            for path in paths:
+                self.unpin(path)
+
+
+_cache_manager = None
+
+
+def get_cache_manager() -> CacheManager:
+    """Process-wide cache manager for CACHE_DIR."""
+    global _cache_manager
+    if _cache_manager is None:
+        _cache_manager = CacheManager()
+    return _cache_manager
@@ -12,13 +12,61 @@ def setup_logging():
 
 DB_FILE = "data.db"
 TABLE_NAME = "hrrr_forecasts"
+LEDGER_TABLE_NAME = "hrrr_ingest_ledger"  # which (source file, variable, point set) loads have been committed
+# Input points are collapsed to unique grid cells before extraction; this table maps each input point back to
+# the coordinates its values are stored under, and the view joins it with hrrr_forecasts
+POINT_MAP_TABLE_NAME = "hrrr_point_map"
+POINT_FORECASTS_VIEW_NAME = "hrrr_point_forecasts"
+DEFAULT_FLUSH_ROWS = 0  # 0 flushes every forecast hour as soon as it is extracted
+BULK_BATCH_ROWS = 1_000_000  # Arrow record batch size for --bulk-load
+DEFAULT_OUTPUT = "duckdb"  # or parquet://<dir>, see parquet_sink.py
+METRICS_PREFIX = "hrrr_ingest"  # metric name prefix in --prometheus-textfile output
+# forecast_query.py: recent results kept in memory, and how far a queried point may be from a stored location
+QUERY_CACHE_SIZE = 256
+QUERY_MAX_DISTANCE_KM = 3.0  # about one HRRR grid cell
+# --output parquet://<dir>: large row groups keep per-column chunks big enough for efficient scans
+PARQUET_ROW_GROUP_ROWS = 1_000_000
+PARQUET_COMPRESSION = "zstd"
+
+# "wide" stores hrrr_forecasts as one table. "compact" stores small-integer keys into points/variables/sources
+# dimension tables plus a float32 value, and exposes hrrr_forecasts as a view with the same columns.
+STORAGE_SCHEMAS = ["wide", "compact"]
+DEFAULT_STORAGE_SCHEMA = "wide"
+POINTS_TABLE_NAME = "hrrr_points"
+VARIABLES_TABLE_NAME = "hrrr_variables"
+SOURCES_TABLE_NAME = "hrrr_sources"
+VALUES_TABLE_NAME = "hrrr_values"
 S3_BUCKET_URL = "noaa-hrrr-bdp-pds"
+S3_ENDPOINT_URL = os.environ.get("HRRR_S3_ENDPOINT_URL")  # e.g. a local S3 stand-in, see local_s3.py
+DEFAULT_S3_CONNECTIONS = 32  # pooled connections shared by run-date discovery and downloads
+S3_MAX_RETRIES = 4
+S3_RETRY_BACKOFF = 0.5  # seconds, doubled on each retry
+RUN_DATE_LOOKBACK_DAYS = 10
 CACHE_DIR = os.path.join(os.getcwd(), ".cache", "hrrr")
 CACHE_SIZE_LIMIT = 3 * 1024 * 1024 * 1024
+CACHE_INDEX_FILE = os.path.join(CACHE_DIR, "cache_index.json")  # sizes, last access times and pins of cached files
+GRID_INDEX_DIR = os.path.join(CACHE_DIR, "grid_index")  # persisted KD-tree and coordinates of the HRRR grid
+MESSAGE_INDEX_SUFFIX = ".msgidx.json"  # sidecar next to each cached GRIB with its message offsets and keys
 
-RUN_HOUR = 6  # 06z forecast run
+RUN_HOUR = 6  # 06z forecast run, the default cycle
+ALL_CYCLES = list(range(24))  # HRRR runs every hour
+EXTENDED_CYCLES = [0, 6, 12, 18]  # synoptic cycles forecast out to 48 hours, the others to 18
+MAX_FORECAST_HOUR = 48
+MAX_FORECAST_HOUR_HOURLY_CYCLES = 18
 DEFAULT_NUM_HOURS = 48
 
+# --watch: how often S3 is polled for new forecast hours, how far back runs are still followed,
+# and how many times a failing forecast hour is retried before it is skipped
+DEFAULT_POLL_INTERVAL = 30  # seconds
+WATCH_LOOKBACK_HOURS = 6
+WATCH_MAX_ATTEMPTS = 3
+
+# distributed.py: workers lease forecast hours from a shared SQLite work ledger; a lease not renewed in time
+# (the worker died) expires and the hour is handed out again, up to WORK_MAX_ATTEMPTS times
+WORK_LEASE_SECONDS = 600
+WORK_MAX_ATTEMPTS = 3
+WORK_POLL_INTERVAL = 10  # seconds an idle worker waits before checking for expired leases
+
 # Mapping from user-friendly names to cfgrib filter keys
 # Crosscheck between HRRR grib2 File Inventory, grib_ls, and GRIB Parameter database
 VARIABLE_MAP = {
@@ -33,6 +81,63 @@ VARIABLE_MAP = {
     "v_component_wind_10m": {"shortName": "10v"},  # https://codes.ecmwf.int/grib/param-db/166
     "u_component_wind_80m": {"shortName": "u", "typeOfLevel": "heightAboveGround", "level": 80},
     "v_component_wind_80m": {"shortName": "v", "typeOfLevel": "heightAboveGround", "level": 80},
+    # Derived variables: a NumPy expression over the listed input variables, evaluated on the values at the points
+    # at extraction time (see derived.py). Inputs are decoded once, however many derived variables use them.
+    "wind_speed_10m": {
+        "expression": "hypot(u_component_wind_10m, v_component_wind_10m)",
+        "inputs": ["u_component_wind_10m", "v_component_wind_10m"],
+    },
+    "wind_direction_10m": {
+        "expression": "wind_direction(u_component_wind_10m, v_component_wind_10m, longitude)",
+        "inputs": ["u_component_wind_10m", "v_component_wind_10m"],
+    },
+    "wind_speed_80m": {
+        "expression": "hypot(u_component_wind_80m, v_component_wind_80m)",
+        "inputs": ["u_component_wind_80m", "v_component_wind_80m"],
+    },
+    "wind_direction_80m": {
+        "expression": "wind_direction(u_component_wind_80m, v_component_wind_80m, longitude)",
+        "inputs": ["u_component_wind_80m", "v_component_wind_80m"],
+    },
+    "visible_downward_solar_flux": {  # beam + diffuse
+        "expression": "visible_beam_downward_solar_flux + visible_diffuse_downward_solar_flux",
+        "inputs": ["visible_beam_downward_solar_flux", "visible_diffuse_downward_solar_flux"],
+    },
+}
+
+# HRRR's Lambert conformal projection (LoV and the standard parallel Latin1 = Latin2), used to rotate its
+# grid-relative wind components to earth-relative for wind directions
+HRRR_LAMBERT_LOV = 262.5
+HRRR_LAMBERT_LATIN = 38.5
+
+# Mapping from user-friendly names to the "VAR:level" descriptions used in the .idx inventory
+# https://www.nco.ncep.noaa.gov/pmb/products/hrrr/hrrr.t00z.wrfsfcf00.grib2.shtml
+VARIABLE_IDX_MAP = {
+    "surface_pressure": "PRES:surface",
+    "surface_roughness": "SFCR:surface",
+    "visible_beam_downward_solar_flux": "VBDSF:surface",
+    "visible_diffuse_downward_solar_flux": "VDDSF:surface",
+    "temperature_2m": "TMP:2 m above ground",
+    "dewpoint_2m": "DPT:2 m above ground",
+    "relative_humidity_2m": "RH:2 m above ground",
+    "u_component_wind_10m": "UGRD:10 m above ground",
+    "v_component_wind_10m": "VGRD:10 m above ground",
+    "u_component_wind_80m": "UGRD:80 m above ground",
+    "v_component_wind_80m": "VGRD:80 m above ground",
 }
 
+FETCH_MODES = ["full", "partial"]
+DEFAULT_FETCH_MODE = "full"
+
+# How values are sampled at the points: "nearest" grid cell, "bilinear" over the enclosing grid quad, or
+# "idw-<k>" inverse distance weighting of the k nearest cells (e.g. idw-4)
+INTERP_METHODS = ["nearest", "bilinear", "idw-<k>"]
+DEFAULT_INTERP = "nearest"
+
+POINTS_CHUNK_ROWS = 1_000_000  # rows per chunk when reading a points CSV/Parquet file
+
+DEFAULT_DOWNLOAD_WORKERS = 4
+DEFAULT_DECODE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
 ALL_VARIABLES = list(VARIABLE_MAP.keys())
+GRIB_VARIABLES = [name for name, keys in VARIABLE_MAP.items() if "expression" not in keys]  # not derived
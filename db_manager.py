@@ -1,6 +1,27 @@
+import logging
+import time
+from datetime import datetime, timezone
+
 import duckdb
 import pandas as pd
-from config import DB_FILE, TABLE_NAME
+import pyarrow as pa
+import pyarrow.compute as pc
+from metrics import get_metrics
+from config import (
+    DB_FILE,
+    TABLE_NAME,
+    LEDGER_TABLE_NAME,
+    POINT_MAP_TABLE_NAME,
+    POINT_FORECASTS_VIEW_NAME,
+    DEFAULT_FLUSH_ROWS,
+    BULK_BATCH_ROWS,
+    DEFAULT_STORAGE_SCHEMA,
+    DEFAULT_INTERP,
+    POINTS_TABLE_NAME,
+    VARIABLES_TABLE_NAME,
+    SOURCES_TABLE_NAME,
+    VALUES_TABLE_NAME,
+)
 
 
 def get_db_connection():
@@ -8,26 +29,234 @@ def get_db_connection():
     return duckdb.connect(database=DB_FILE, read_only=False)
 
 
-def create_table_if_not_exists(con):
-    """Creates the hrrr_forecasts table if it doesn't exist."""
+def get_storage_schema(con):
+    """Returns "wide" or "compact" depending on how hrrr_forecasts is stored, or None if it doesn't exist yet."""
+    row = con.execute(
+        "SELECT table_type FROM information_schema.tables WHERE table_name = ?", [TABLE_NAME]
+    ).fetchone()
+    if row is None:
+        return None
+    return "compact" if row[0] == "VIEW" else "wide"
+
+
+def has_unique_key(con) -> bool:
+    """Whether the wide hrrr_forecasts table has its UNIQUE key (tables created with --bulk-load don't)."""
+    row = con.execute(
+        "SELECT 1 FROM duckdb_constraints() WHERE table_name = ? AND constraint_type = 'UNIQUE' LIMIT 1", [TABLE_NAME]
+    ).fetchone()
+    return row is not None
+
+
+def create_table_if_not_exists(con, schema: str = DEFAULT_STORAGE_SCHEMA, bulk: bool = False):
+    """
+    Creates the hrrr_forecasts table (or the compact tables and view) and the ingest ledger if they don't exist.
+    With `bulk`, a new wide table gets no UNIQUE key: like the compact schema, it is kept free of duplicates by
+    the load ledger (see bulk_insert_data), so appends skip the per-row index check.
+    """
+    existing_schema = get_storage_schema(con)
+    if existing_schema is not None and existing_schema != schema:
+        raise ValueError(f"{DB_FILE} already uses the '{existing_schema}' schema, cannot use '{schema}'.")
+
+    if schema == "compact":
+        create_compact_tables(con)
+    else:
+        unique_key = "" if bulk else ", UNIQUE (valid_time_utc, run_time_utc, latitude, longitude, variable)"
+        con.execute(
+            f"""
+                CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+                    valid_time_utc TIMESTAMP,
+                    run_time_utc TIMESTAMP,
+                    latitude FLOAT,
+                    longitude FLOAT,
+                    variable VARCHAR,
+                    value FLOAT,
+                    source_s3 VARCHAR{unique_key}
+                );
+            """
+        )
     con.execute(
         f"""
-            CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
-                valid_time_utc TIMESTAMP,
+            CREATE TABLE IF NOT EXISTS {LEDGER_TABLE_NAME} (
+                source_s3 VARCHAR,
+                variable VARCHAR,
+                points_digest VARCHAR,
                 run_time_utc TIMESTAMP,
+                row_count BIGINT,
+                loaded_at TIMESTAMP,
+                interp VARCHAR,
+                PRIMARY KEY (source_s3, variable, points_digest)
+            );
+            ALTER TABLE {LEDGER_TABLE_NAME} ADD COLUMN IF NOT EXISTS interp VARCHAR;
+        """
+    )
+    con.execute(
+        f"""
+            CREATE TABLE IF NOT EXISTS {POINT_MAP_TABLE_NAME} (
+                points_digest VARCHAR,
+                point_id VARCHAR,
+                latitude DOUBLE,
+                longitude DOUBLE,
+                grid_iy SMALLINT,
+                grid_ix SMALLINT,
+                forecast_latitude FLOAT,
+                forecast_longitude FLOAT,
+                PRIMARY KEY (points_digest, point_id)
+            );
+            CREATE VIEW IF NOT EXISTS {POINT_FORECASTS_VIEW_NAME} AS
+                SELECT m.points_digest, m.point_id, m.latitude AS point_latitude, m.longitude AS point_longitude, f.*
+                FROM {POINT_MAP_TABLE_NAME} m
+                JOIN {TABLE_NAME} f ON f.latitude = m.forecast_latitude AND f.longitude = m.forecast_longitude;
+        """
+    )
+
+
+def create_compact_tables(con):
+    """
+    Creates the compact schema: points/variables/sources dimension tables, a narrow values fact table
+    of small-integer keys plus a float32 value, and a hrrr_forecasts view with the wide table's columns.
+    Points are keyed by their grid cell (grid_iy << 16 | grid_ix), so no lookup is needed to build the key.
+    """
+    con.execute(f"CREATE SEQUENCE IF NOT EXISTS {VARIABLES_TABLE_NAME}_key_seq")
+    con.execute(f"CREATE SEQUENCE IF NOT EXISTS {SOURCES_TABLE_NAME}_key_seq")
+    con.execute(
+        f"""
+            CREATE TABLE IF NOT EXISTS {POINTS_TABLE_NAME} (
+                point_key INTEGER PRIMARY KEY,
+                grid_iy SMALLINT,
+                grid_ix SMALLINT,
                 latitude FLOAT,
-                longitude FLOAT,
-                variable VARCHAR,
-                value FLOAT,
-                source_s3 VARCHAR,
-                UNIQUE (valid_time_utc, run_time_utc, latitude, longitude, variable)
+                longitude FLOAT
             );
+            CREATE TABLE IF NOT EXISTS {VARIABLES_TABLE_NAME} (
+                variable_key SMALLINT PRIMARY KEY DEFAULT nextval('{VARIABLES_TABLE_NAME}_key_seq'),
+                variable VARCHAR UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS {SOURCES_TABLE_NAME} (
+                source_key INTEGER PRIMARY KEY DEFAULT nextval('{SOURCES_TABLE_NAME}_key_seq'),
+                source_s3 VARCHAR UNIQUE,
+                run_time_utc TIMESTAMP,
+                valid_time_utc TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS {VALUES_TABLE_NAME} (
+                source_key INTEGER,
+                variable_key SMALLINT,
+                point_key INTEGER,
+                value FLOAT
+            );
+            CREATE VIEW IF NOT EXISTS {TABLE_NAME} AS
+                SELECT s.valid_time_utc, s.run_time_utc, p.latitude, p.longitude, v.variable, f.value, s.source_s3
+                FROM {VALUES_TABLE_NAME} f
+                JOIN {SOURCES_TABLE_NAME} s USING (source_key)
+                JOIN {VARIABLES_TABLE_NAME} v USING (variable_key)
+                JOIN {POINTS_TABLE_NAME} p USING (point_key);
         """
     )
 
 
-def insert_data(con, data_df):
-    """Inserts data from a Pandas DataFrame into the table. Duplicates are skipped."""
+def get_loaded_sources(con, points_digest: str) -> dict:
+    """Returns {source_s3: set of variables} already committed for the point set identified by points_digest."""
+    rows = con.execute(
+        f"SELECT source_s3, variable FROM {LEDGER_TABLE_NAME} WHERE points_digest = ?", [points_digest]
+    ).fetchall()
+    loaded = {}
+    for source_s3, variable in rows:
+        loaded.setdefault(source_s3, set()).add(variable)
+    return loaded
+
+
+def check_interp(con, interp: str):
+    """
+    Raises ValueError if the ledger records loads made with another interpolation method than `interp`. Rows are
+    keyed by their coordinates, not their method, so rows of two methods for the same point would collide.
+    Loads recorded before the method was stored are not checked.
+    """
+    rows = con.execute(
+        f"SELECT DISTINCT interp FROM {LEDGER_TABLE_NAME} WHERE interp IS NOT NULL AND interp <> ?", [interp]
+    ).fetchall()
+    if rows:
+        methods = ", ".join(sorted(row[0] for row in rows))
+        raise ValueError(f"The database holds rows interpolated with {methods}, not {interp}; use one per database.")
+
+
+def has_point_map(con, points_digest: str) -> bool:
+    """Whether the point map of the point set identified by points_digest has been saved."""
+    row = con.execute(f"SELECT 1 FROM {POINT_MAP_TABLE_NAME} WHERE points_digest = ? LIMIT 1", [points_digest])
+    return row.fetchone() is not None
+
+
+def save_point_map(con, map_df, points_digest: str):
+    """Saves the input point -> forecast row coordinates mapping (see hrrr_processor.map_points) of a point set."""
+    con.register("df_point_map", map_df)
+    try:
+        con.execute(
+            f"""
+                INSERT INTO {POINT_MAP_TABLE_NAME}
+                SELECT ?, point_id, latitude, longitude, grid_iy, grid_ix, forecast_latitude, forecast_longitude
+                FROM df_point_map
+                ON CONFLICT (points_digest, point_id) DO NOTHING;
+            """,
+            [points_digest],
+        )
+    finally:
+        con.unregister("df_point_map")
+
+
+def record_loads(con, data_df, points_digest: str, variables: list = None, interp: str = DEFAULT_INTERP):
+    """
+    Adds ledger rows for every (source_s3, variable) present in data_df, with the interpolation method that
+    produced them (see check_interp). Requested `variables` a source has no rows for (fields a file does not carry,
+    e.g. accumulations at f00) get a row with a row_count of 0, so plan_tasks treats them as loaded instead of
+    downloading the file again on every run.
+    """
+    ledger_df = (
+        data_df.groupby(["source_s3", "variable"], observed=True)
+        .agg(run_time_utc=("run_time_utc", "first"), row_count=("value", "size"))
+        .reset_index()
+    )
+    ledger_df["source_s3"] = ledger_df["source_s3"].astype(str)
+    ledger_df["variable"] = ledger_df["variable"].astype(str)
+    if variables:
+        present = set(zip(ledger_df["source_s3"], ledger_df["variable"]))
+        sources = ledger_df.drop_duplicates("source_s3")
+        absent = [
+            (source_s3, variable, run_time, 0)
+            for source_s3, run_time in zip(sources["source_s3"], sources["run_time_utc"])
+            for variable in variables
+            if (source_s3, variable) not in present
+        ]
+        if absent:
+            ledger_df = pd.concat([ledger_df, pd.DataFrame(absent, columns=ledger_df.columns)], ignore_index=True)
+    ledger_df["points_digest"] = points_digest
+    ledger_df["loaded_at"] = datetime.now(timezone.utc).replace(tzinfo=None)
+    ledger_df["interp"] = interp
+
+    con.register("df_ledger", ledger_df)
+    con.execute(
+        f"""
+            INSERT INTO {LEDGER_TABLE_NAME}
+                (source_s3, variable, points_digest, run_time_utc, row_count, loaded_at, interp)
+            SELECT source_s3, variable, points_digest, run_time_utc, row_count, loaded_at, interp
+            FROM df_ledger
+            ON CONFLICT (source_s3, variable, points_digest) DO NOTHING;
+        """
+    )
+    con.unregister("df_ledger")
+
+
+def _record_inserts(offered: int, result) -> int:
+    """
+    Counts the rows DuckDB inserted (the count an INSERT returns) and the ones it skipped as duplicates.
+    Returns the number inserted.
+    """
+    row = result.fetchone() if result is not None else None
+    inserted = row[0] if row else 0
+    get_metrics().count("db.rows_inserted", inserted)
+    get_metrics().count("db.rows_skipped", offered - inserted)
+    return inserted
+
+
+def insert_data(con, data_df) -> int:
+    """Inserts data from a Pandas DataFrame into the table. Duplicates are skipped. Returns the rows inserted."""
     data_df["run_time_utc"] = pd.to_datetime(data_df["run_time_utc"])
     data_df["valid_time_utc"] = pd.to_datetime(data_df["valid_time_utc"])
 
@@ -41,6 +270,285 @@ def insert_data(con, data_df):
         FROM {temp_table_name}
         ON CONFLICT (valid_time_utc, run_time_utc, latitude, longitude, variable) DO NOTHING;
     """
-    con.execute(insert_sql)
+    inserted = _record_inserts(len(data_df), con.execute(insert_sql))
     con.unregister("df_temp")
     con.execute(f"DROP TABLE IF EXISTS {temp_table_name}")
+    return inserted
+
+
+def to_arrow(data_df) -> pa.Table:
+    """Converts extracted rows to Arrow, with timestamps as naive UTC to match the TIMESTAMP columns."""
+    table = pa.Table.from_pandas(data_df, preserve_index=False)
+    for column in ["valid_time_utc", "run_time_utc"]:
+        index = table.schema.get_field_index(column)
+        if table.schema.field(index).type != pa.timestamp("us"):
+            # Arrow stores instants as UTC whatever the zone, so dropping it leaves naive UTC in one cast
+            table = table.set_column(index, column, pc.cast(table[column], pa.timestamp("us")))
+    return table
+
+
+def _drop_loaded_rows(con, table: pa.Table, points_digest: str) -> pa.Table:
+    """
+    Filters out rows whose (source_s3, variable) is already in the ledger for points_digest. plan_tasks skips
+    loaded files, so usually nothing matches and the rows are never scanned; otherwise one mask drops them all.
+    """
+    loaded = get_loaded_sources(con, points_digest)
+    sources = {str(source) for source in pc.unique(table["source_s3"]).to_pylist()}
+    variables = {str(variable) for variable in pc.unique(table["variable"]).to_pylist()}
+    loaded_keys = [
+        f"{source_s3}\n{variable}" for source_s3 in sources & set(loaded) for variable in loaded[source_s3] & variables
+    ]
+    if not loaded_keys:
+        return table
+    keys = pc.binary_join_element_wise(
+        pc.cast(table["source_s3"], pa.string()), pc.cast(table["variable"], pa.string()), "\n"
+    )
+    return table.filter(pc.invert(pc.is_in(keys, value_set=pa.array(loaded_keys))))
+
+
+def bulk_insert_data(
+    con, data_df, points_digest: str = None, batch_rows: int = BULK_BATCH_ROWS, unique_key: bool = None
+):
+    """
+    Bulk-loads data_df by streaming Arrow record batches straight into the table.
+    Skips the pandas datetime conversion and the temp table copy of insert_data. Rows whose
+    (source_s3, variable) is already in the ledger for points_digest are dropped up front.
+
+    On a table without the UNIQUE key (created with `bulk`, see create_table_if_not_exists) duplicates are
+    prevented like in insert_data_compact: only (source_s3, variable) pairs the ledger shows were loaded
+    before, for any point set, are anti-joined against the stored rows, so new files are appended without any
+    per-row check. Tables that have the key keep ON CONFLICT DO NOTHING. `unique_key` is looked up if None.
+    Returns the number of rows inserted.
+    """
+    table = to_arrow(data_df)
+
+    if points_digest is not None:
+        table = _drop_loaded_rows(con, table, points_digest)
+    if table.num_rows == 0:
+        _record_inserts(len(data_df), None)
+        return 0
+    if unique_key is None:
+        unique_key = has_unique_key(con)
+
+    columns = "valid_time_utc, run_time_utc, latitude, longitude, variable, value, source_s3"
+    if unique_key:
+        sql = f"""
+            INSERT INTO {TABLE_NAME} ({columns})
+            SELECT {columns} FROM arrow_batches
+            ON CONFLICT (valid_time_utc, run_time_utc, latitude, longitude, variable) DO NOTHING;
+        """
+    else:
+        sql = f"""
+            CREATE OR REPLACE TEMP TABLE previously_loaded AS
+            SELECT DISTINCT source_s3, variable FROM {LEDGER_TABLE_NAME}
+            WHERE source_s3 IN (SELECT source_s3 FROM arrow_sources);
+
+            INSERT INTO {TABLE_NAME} ({columns})
+            SELECT {', '.join(f'r.{column}' for column in columns.split(', '))} FROM arrow_batches r
+            WHERE NOT EXISTS (
+                SELECT 1 FROM previously_loaded pl
+                JOIN {TABLE_NAME} f USING (source_s3, variable)
+                WHERE pl.source_s3 = r.source_s3
+                    AND pl.variable = r.variable
+                    AND f.valid_time_utc = r.valid_time_utc
+                    AND f.run_time_utc = r.run_time_utc
+                    AND f.latitude = r.latitude
+                    AND f.longitude = r.longitude
+            );
+        """
+
+    reader = pa.RecordBatchReader.from_batches(table.schema, table.to_batches(max_chunksize=batch_rows))
+    con.register("arrow_batches", reader)
+    con.register("arrow_sources", pa.table({"source_s3": pc.unique(pc.cast(table["source_s3"], pa.string()))}))
+    try:
+        inserted = _record_inserts(len(data_df), con.execute(sql))
+        if not unique_key:
+            con.execute("DROP TABLE previously_loaded")
+    finally:
+        con.unregister("arrow_batches")
+        con.unregister("arrow_sources")
+    return inserted
+
+
+def insert_data_compact(con, data_df, points_digest: str = None) -> int:
+    """
+    Inserts extracted rows into the compact schema. New variables, sources and grid cells are added to the
+    dimension tables, then the rows are stored as (source_key, variable_key, point_key, value).
+
+    The values table has no UNIQUE constraint; duplicates are prevented by the ledger instead. Only
+    (source_s3, variable) pairs that the ledger shows were loaded before, for any point set, are anti-joined
+    against existing values, so brand new files are appended without any per-row check.
+    Returns the number of rows inserted.
+    """
+    table = to_arrow(data_df)
+    if points_digest is not None:
+        table = _drop_loaded_rows(con, table, points_digest)
+    if table.num_rows == 0:
+        _record_inserts(len(data_df), None)
+        return 0
+
+    con.register("arrow_rows", table)
+    try:
+        result = con.execute(
+            f"""
+                INSERT INTO {VARIABLES_TABLE_NAME} (variable)
+                SELECT DISTINCT variable FROM arrow_rows
+                WHERE variable NOT IN (SELECT variable FROM {VARIABLES_TABLE_NAME});
+
+                INSERT INTO {SOURCES_TABLE_NAME} (source_s3, run_time_utc, valid_time_utc)
+                SELECT source_s3, any_value(run_time_utc), any_value(valid_time_utc) FROM arrow_rows
+                WHERE source_s3 NOT IN (SELECT source_s3 FROM {SOURCES_TABLE_NAME})
+                GROUP BY source_s3;
+
+                INSERT INTO {POINTS_TABLE_NAME} (point_key, grid_iy, grid_ix, latitude, longitude)
+                SELECT point_key, any_value(grid_iy), any_value(grid_ix), any_value(latitude), any_value(longitude)
+                FROM (SELECT (grid_iy::INTEGER << 16) | grid_ix AS point_key, * FROM arrow_rows)
+                WHERE point_key NOT IN (SELECT point_key FROM {POINTS_TABLE_NAME})
+                GROUP BY point_key;
+
+                CREATE OR REPLACE TEMP TABLE previously_loaded AS
+                SELECT DISTINCT s.source_key, v.variable_key
+                FROM {LEDGER_TABLE_NAME} l
+                JOIN {SOURCES_TABLE_NAME} s USING (source_s3)
+                JOIN {VARIABLES_TABLE_NAME} v USING (variable);
+
+                INSERT INTO {VALUES_TABLE_NAME} (source_key, variable_key, point_key, value)
+                SELECT DISTINCT s.source_key, v.variable_key, (r.grid_iy::INTEGER << 16) | r.grid_ix, r.value
+                FROM arrow_rows r
+                JOIN {SOURCES_TABLE_NAME} s ON s.source_s3 = r.source_s3
+                JOIN {VARIABLES_TABLE_NAME} v ON v.variable = r.variable
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM previously_loaded pl
+                    JOIN {VALUES_TABLE_NAME} f USING (source_key, variable_key)
+                    WHERE pl.source_key = s.source_key
+                        AND pl.variable_key = v.variable_key
+                        AND f.point_key = (r.grid_iy::INTEGER << 16) | r.grid_ix
+                );
+            """
+        )
+        inserted = _record_inserts(len(data_df), result)
+        con.execute("DROP TABLE previously_loaded")
+    finally:
+        con.unregister("arrow_rows")
+    return inserted
+
+
+def cluster_forecasts(con):
+    """
+    Rewrites the stored rows sorted by variable, location and time, so the per-row-group min/max statistics of
+    each column are narrow and queries for a few points and variables (see forecast_query) skip most row groups.
+    Rows are appended one forecast hour at a time, so this is worth running after large ingests. The table keeps
+    its constraints and dependent views.
+    """
+    if get_storage_schema(con) == "compact":
+        table, order = VALUES_TABLE_NAME, "variable_key, point_key, source_key"
+    else:
+        table, order = TABLE_NAME, "variable, latitude, longitude, valid_time_utc, run_time_utc"
+    con.execute("BEGIN TRANSACTION")
+    try:
+        con.execute(f"CREATE TEMP TABLE clustered_rows AS SELECT * FROM {table}")
+        con.execute(f"DELETE FROM {table}")
+        con.execute(f"INSERT INTO {table} SELECT * FROM clustered_rows ORDER BY {order}")
+        con.execute("DROP TABLE clustered_rows")
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    con.execute("CHECKPOINT")  # reclaims the space of the deleted rows
+
+
+class StreamingWriter:
+    """
+    Writes extracted data to the database as it arrives instead of at the end of the run.
+
+    DataFrames are buffered until at least `flush_rows` rows are pending (0 flushes every call to add), then
+    inserted (into the compact schema, or through the Arrow bulk path if `bulk` or the table has no UNIQUE key)
+    together with their ledger rows in one transaction. A crash therefore loses at most the unflushed buffer, and a
+    rerun can skip every source already recorded in the ledger. Requested `variables` missing from a source are
+    recorded as absent (see record_loads). Raises ValueError if the database holds rows of another `interp` method.
+    """
+
+    def __init__(
+        self,
+        con,
+        points_digest: str,
+        flush_rows: int = DEFAULT_FLUSH_ROWS,
+        bulk: bool = False,
+        schema: str = DEFAULT_STORAGE_SCHEMA,
+        variables: list = None,
+        interp: str = DEFAULT_INTERP,
+    ):
+        check_interp(con, interp)
+        self.con = con
+        self.points_digest = points_digest
+        self.variables = variables
+        self.interp = interp
+        self.flush_rows = flush_rows
+        self.bulk = bulk
+        self.schema = schema
+        # A wide table without the UNIQUE key can only be kept free of duplicates by the bulk path
+        self.unique_key = schema == "wide" and has_unique_key(con)
+        self.buffer = []
+        self.buffered_rows = 0
+        self.written_rows = 0
+        self.point_map = None  # staged by save_point_map, committed with the next flush
+        self.point_map_saved = has_point_map(con, points_digest)
+
+    def save_point_map(self, map_df):
+        """
+        Stages the point map so the next flush commits it in the same transaction as the rows. Saving it on its
+        own could leave rows in the ledger without a map if the process died in between.
+        """
+        if map_df.empty:
+            return
+        self.point_map = map_df
+        self.point_map_saved = True
+
+    def add(self, data_df):
+        if data_df.empty:
+            return
+        self.buffer.append(data_df)
+        self.buffered_rows += len(data_df)
+        if self.buffered_rows >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            if self.point_map is not None:
+                save_point_map(self.con, self.point_map, self.points_digest)
+                self.point_map = None
+            return
+        data_df = self.buffer[0] if len(self.buffer) == 1 else pd.concat(self.buffer, ignore_index=True)
+        flush_start = time.perf_counter()
+
+        self.con.execute("BEGIN TRANSACTION")
+        try:
+            if self.point_map is not None:
+                save_point_map(self.con, self.point_map, self.points_digest)
+            if self.schema == "compact":
+                inserted = insert_data_compact(self.con, data_df, self.points_digest)
+            elif self.bulk or not self.unique_key:
+                inserted = bulk_insert_data(self.con, data_df, self.points_digest, unique_key=self.unique_key)
+            else:
+                inserted = insert_data(self.con, data_df)
+            record_loads(self.con, data_df, self.points_digest, self.variables, self.interp)
+            self.con.execute("COMMIT")
+        except Exception:
+            self.con.execute("ROLLBACK")
+            raise
+        self.point_map = None
+
+        get_metrics().observe("db.flush", time.perf_counter() - flush_start)
+        get_metrics().count("db.rows", len(data_df))
+        logging.info(f"Committed {inserted} new records of {len(data_df)} extracted.")
+        self.written_rows += inserted  # rows the database kept, duplicates excluded
+        self.buffer = []
+        self.buffered_rows = 0
+
+    def discard(self):
+        """Drops the buffered rows, e.g. after a failed flush, so the next flush does not retry them."""
+        self.buffer = []
+        self.buffered_rows = 0
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,84 @@
+import logging
+
+import numpy as np
+
+from config import HRRR_LAMBERT_LATIN, HRRR_LAMBERT_LOV, VARIABLE_MAP
+
+
+def is_derived(var_name: str) -> bool:
+    """Whether `var_name` is computed from other variables (an "expression" entry in VARIABLE_MAP)."""
+    return "expression" in VARIABLE_MAP.get(var_name, {})
+
+
+def source_variables(variables: list) -> list:
+    """The GRIB variables needed for `variables`: derived ones are replaced by their inputs, each listed once."""
+    sources = []
+    for var_name in variables:
+        for source in VARIABLE_MAP[var_name]["inputs"] if is_derived(var_name) else [var_name]:
+            if source not in sources:
+                sources.append(source)
+    return sources
+
+
+def wind_direction(u: np.ndarray, v: np.ndarray, longitude: np.ndarray) -> np.ndarray:
+    """
+    Meteorological wind direction (degrees the wind blows from, 0 = north) of HRRR wind components.
+    HRRR winds are relative to its Lambert conformal grid, so they are first rotated to earth-relative
+    by the local angle between grid north and true north: sin(latin) * (longitude - LoV).
+    """
+    angle = np.sin(np.radians(HRRR_LAMBERT_LATIN)) * np.radians(np.asarray(longitude) - HRRR_LAMBERT_LOV)
+    cos_angle, sin_angle = np.cos(angle), np.sin(angle)
+    u_earth = cos_angle * u + sin_angle * v
+    v_earth = -sin_angle * u + cos_angle * v
+    return np.mod(270.0 - np.degrees(np.arctan2(v_earth, u_earth)), 360.0)
+
+
+# Names available to VARIABLE_MAP expressions besides the input variables and `latitude`/`longitude`
+EXPRESSION_FUNCTIONS = {
+    "abs": np.abs,
+    "arctan2": np.arctan2,
+    "degrees": np.degrees,
+    "exp": np.exp,
+    "hypot": np.hypot,
+    "log": np.log,
+    "maximum": np.maximum,
+    "minimum": np.minimum,
+    "mod": np.mod,
+    "radians": np.radians,
+    "sqrt": np.sqrt,
+    "where": np.where,
+    "wind_direction": wind_direction,
+}
+
+_compiled = {}
+
+
+def _compile(var_name: str):
+    if var_name not in _compiled:
+        _compiled[var_name] = compile(VARIABLE_MAP[var_name]["expression"], f"<{var_name}>", "eval")
+    return _compiled[var_name]
+
+
+def derive_variables(sampled: dict, variables: list, latitude: np.ndarray, longitude: np.ndarray) -> dict:
+    """
+    Returns {variable: 1-D array} for `variables`, in that order: GRIB variables come from `sampled` (values at
+    the points), derived ones are evaluated with NumPy over the sampled inputs. Inputs that were not requested
+    themselves are dropped. A derived variable whose inputs are missing from the file is skipped.
+    """
+    result = {}
+    for var_name in variables:
+        if not is_derived(var_name):
+            if var_name in sampled:
+                result[var_name] = sampled[var_name]
+            continue
+
+        inputs = VARIABLE_MAP[var_name]["inputs"]
+        missing = [source for source in inputs if source not in sampled]
+        if missing:
+            logging.warning(f"Cannot derive {var_name}, missing {', '.join(missing)}.")
+            continue
+        namespace = {source: sampled[source] for source in inputs}
+        namespace.update(latitude=latitude, longitude=longitude)
+        values = eval(_compile(var_name), {"__builtins__": {}, **EXPRESSION_FUNCTIONS}, namespace)
+        result[var_name] = np.broadcast_to(np.asarray(values, dtype=np.float32), len(latitude))
+    return result
@@ -0,0 +1,481 @@
+"""
+Sharded ingestion across several processes or hosts, coordinated through a shared work ledger.
+
+The coordinator plans the forecast hours as usual and enqueues them instead of ingesting them:
+    python hrrr_ingest.py points.csv --run-date 2025-01-01 --end-date 2025-03-31 --enqueue work.sqlite
+
+Any number of workers, on any host that sees the ledger and shard directory (e.g. a shared filesystem), then
+lease forecast hours, extract them and write Parquet shards under <shards>/worker=<id>/:
+    python distributed.py work work.sqlite points.csv --shards shards/
+
+A worker renews its leases while it works; if it dies, its leases expire and other workers pick the hours up
+again. Finally the shards are merged into data.db with the usual ledger and duplicate handling:
+    python distributed.py merge work.sqlite
+    python distributed.py status work.sqlite
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date
+
+import pyarrow.parquet as pq
+
+from config import (
+    DEFAULT_DECODE_WORKERS,
+    DEFAULT_DOWNLOAD_WORKERS,
+    DEFAULT_FLUSH_ROWS,
+    DEFAULT_S3_CONNECTIONS,
+    WORK_LEASE_SECONDS,
+    WORK_MAX_ATTEMPTS,
+    WORK_POLL_INTERVAL,
+    setup_logging,
+)
+from db_manager import StreamingWriter, create_table_if_not_exists, get_db_connection
+from hrrr_processor import map_task_points
+from parquet_sink import ParquetWriter, read_forecast_hour
+from pipeline import run_pipeline
+from scheduler import IngestTask
+from utils import get_s3_client, points_digest, read_points, unique_points
+
+# Lifecycle of a work item: pending -> leased -> done -> merged. A failed attempt or an expired lease puts it
+# back to pending, until it has been tried WORK_MAX_ATTEMPTS times and is marked failed.
+STATUSES = ["pending", "leased", "done", "merged", "failed"]
+
+
+class WorkLedger:
+    """
+    SQLite file listing the forecast hours of one ingest job and who is working on what. Every change is a short
+    transaction, and claims take SQLite's write lock first (BEGIN IMMEDIATE), so two workers never lease the same
+    hour. The job's settings (points digest, variables, fetch mode, interpolation, storage schema) are stored with
+    it, so workers and the merge step need nothing but the ledger and the points file.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = WORK_LEASE_SECONDS, max_attempts: int = WORK_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.con = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()  # the heartbeat thread shares the connection
+        self.con.executescript(
+            """
+                CREATE TABLE IF NOT EXISTS job (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS work_items (
+                    run_date TEXT,
+                    run_hour INTEGER,
+                    forecast_hour INTEGER,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    shard TEXT,
+                    error TEXT,
+                    updated_at REAL,
+                    PRIMARY KEY (run_date, run_hour, forecast_hour)
+                );
+            """
+        )
+
+    @contextmanager
+    def _transaction(self, immediate: bool = False):
+        """One transaction on the shared connection; IMMEDIATE takes the write lock before reading."""
+        with self._lock:
+            self.con.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield self.con
+                self.con.execute("COMMIT")
+            except BaseException:
+                self.con.execute("ROLLBACK")
+                raise
+
+    @staticmethod
+    def _key(task: IngestTask) -> list:
+        return [f"{task.run_date:%Y-%m-%d}", task.run_hour, task.forecast_hour]
+
+    @staticmethod
+    def _task(row) -> IngestTask:
+        return IngestTask(date.fromisoformat(row[0]), row[1], row[2])
+
+    def _update(self, task: IngestTask, assignments: str, params: list, condition: str, condition_params: list = ()):
+        """Updates one work item if it meets `condition`. Returns whether it did."""
+        with self._transaction() as con:
+            cursor = con.execute(
+                f"UPDATE work_items SET {assignments}, updated_at = ? "
+                f"WHERE run_date = ? AND run_hour = ? AND forecast_hour = ? AND {condition}",
+                [*params, time.time(), *self._key(task), *condition_params],
+            )
+            return cursor.rowcount > 0
+
+    # --- coordinator ---
+
+    def create_job(self, settings: dict):
+        """Records the job's settings. Raises ValueError if the ledger already holds a different job."""
+        with self._transaction(immediate=True) as con:
+            existing = {key: json.loads(value) for key, value in con.execute("SELECT key, value FROM job")}
+            if existing and existing != settings:
+                raise ValueError(f"{self.path} already holds a job with different settings: {existing}")
+            con.executemany(
+                "INSERT OR IGNORE INTO job VALUES (?, ?)", [[key, json.dumps(value)] for key, value in settings.items()]
+            )
+
+    def job(self) -> dict:
+        with self._lock:
+            return {key: json.loads(value) for key, value in self.con.execute("SELECT key, value FROM job")}
+
+    def add_tasks(self, tasks: list) -> int:
+        """Enqueues tasks that are not in the ledger yet. Returns how many were added."""
+        now = time.time()
+        with self._transaction() as con:
+            cursor = con.executemany(
+                "INSERT OR IGNORE INTO work_items (run_date, run_hour, forecast_hour, updated_at) VALUES (?, ?, ?, ?)",
+                [[*self._key(task), now] for task in tasks],
+            )
+            return max(cursor.rowcount, 0)
+
+    # --- workers ---
+
+    def claim(self, worker: str, limit: int) -> list[IngestTask]:
+        """Leases up to `limit` pending hours, or hours whose lease expired, to `worker`."""
+        now = time.time()
+        with self._transaction(immediate=True) as con:
+            con.execute(
+                "UPDATE work_items SET status = 'failed', error = 'lease expired', worker = NULL, updated_at = ? "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                [now, now, self.max_attempts],
+            )
+            rows = con.execute(
+                "SELECT run_date, run_hour, forecast_hour FROM work_items "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY run_date, run_hour, forecast_hour LIMIT ?",
+                [now, limit],
+            ).fetchall()
+            con.executemany(
+                "UPDATE work_items SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, "
+                "updated_at = ? WHERE run_date = ? AND run_hour = ? AND forecast_hour = ?",
+                [[worker, now + self.lease_seconds, now, *row] for row in rows],
+            )
+        return [self._task(row) for row in rows]
+
+    def renew(self, worker: str, tasks: list):
+        """Extends the leases `worker` still holds on `tasks`."""
+        expires = time.time() + self.lease_seconds
+        with self._transaction() as con:
+            con.executemany(
+                "UPDATE work_items SET lease_expires = ? "
+                "WHERE run_date = ? AND run_hour = ? AND forecast_hour = ? AND status = 'leased' AND worker = ?",
+                [[expires, *self._key(task), worker] for task in tasks],
+            )
+
+    def _relative_path(self, path: str) -> str:
+        """
+        `path` relative to the ledger's directory, so the merge finds it from any working directory, and on hosts
+        that mount the shared filesystem elsewhere. Absolute if there is no relative path (another drive).
+        """
+        try:
+            return os.path.relpath(os.path.abspath(path), os.path.dirname(os.path.abspath(self.path)))
+        except ValueError:
+            return os.path.abspath(path)
+
+    def resolve_path(self, path: str) -> str:
+        """A path stored by complete(), resolved against the ledger's directory."""
+        return os.path.join(os.path.dirname(os.path.abspath(self.path)), path)
+
+    def complete(self, worker: str, task: IngestTask, shard: str) -> bool:
+        """Marks a leased hour done, written to `shard`. False if the lease was lost to another worker meanwhile."""
+        return self._update(
+            task,
+            "status = 'done', shard = ?, lease_expires = NULL, error = NULL",
+            [self._relative_path(shard)],
+            "status = 'leased' AND worker = ?",
+            [worker],
+        )
+
+    def fail(self, worker: str, task: IngestTask, error: str):
+        """Gives a leased hour back for another attempt, or marks it failed after `max_attempts` attempts."""
+        self._update(
+            task,
+            "status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "worker = NULL, lease_expires = NULL, error = ?",
+            [self.max_attempts, error],
+            "status = 'leased' AND worker = ?",
+            [worker],
+        )
+
+    # --- merge and monitoring ---
+    def done(self) -> list[tuple]:
+        """(task, shard directory) of every hour written to a shard but not merged yet."""
+        with self._lock:
+            rows = self.con.execute(
+                "SELECT run_date, run_hour, forecast_hour, shard FROM work_items WHERE status = 'done' "
+                "ORDER BY run_date, run_hour, forecast_hour"
+            ).fetchall()
+        return [(self._task(row), self.resolve_path(row[3])) for row in rows]
+
+    def mark_merged(self, task: IngestTask):
+        self._update(task, "status = 'merged'", [], "status = 'done'")
+
+    def requeue(self, task: IngestTask, error: str):
+        """Puts a done hour whose shard is gone back in the queue, so a worker extracts it again."""
+        self._update(task, "status = 'pending', attempts = 0, shard = NULL, error = ?", [error], "status = 'done'")
+
+    def retry_failed(self) -> int:
+        """Puts failed hours back in the queue with a fresh attempt budget. Returns how many."""
+        with self._transaction() as con:
+            return con.execute(
+                "UPDATE work_items SET status = 'pending', attempts = 0, updated_at = ? WHERE status = 'failed'",
+                [time.time()],
+            ).rowcount
+
+    def counts(self) -> dict:
+        with self._lock:
+            counts = dict(self.con.execute("SELECT status, count(*) FROM work_items GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in STATUSES}
+
+    def items(self, statuses: list) -> list[dict]:
+        """Work items in any of `statuses`, in task order."""
+        with self._lock:
+            cursor = self.con.execute(
+                f"SELECT * FROM work_items WHERE status IN ({', '.join('?' * len(statuses))}) "
+                "ORDER BY run_date, run_hour, forecast_hour",
+                list(statuses),
+            )
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def close(self):
+        self.con.close()
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def work(
+    ledger: WorkLedger,
+    points,  # utils.Points of the job's points file
+    shard_root: str,
+    worker_id: str = None,
+    download_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+    decode_workers: int = DEFAULT_DECODE_WORKERS,
+    s3_connections: int = DEFAULT_S3_CONNECTIONS,
+    max_pending_files: int = None,
+    poll_interval: float = WORK_POLL_INTERVAL,
+    stop: threading.Event = None,
+) -> int:
+    """
+    Leases forecast hours from the ledger and writes them to <shard_root>/worker=<worker_id>/ until no hour is
+    pending or leased any more (or `stop` is set). Returns the number of hours completed.
+
+    A heartbeat thread renews the leases of the batch in flight every third of the lease time. Hours that
+    yield no rows are handed back for another attempt; if the worker dies, its leases simply expire.
+    """
+    job = ledger.job()
+    if not job:
+        raise ValueError(f"{ledger.path} holds no job; enqueue one with hrrr_ingest.py --enqueue first.")
+    digest = points_digest(points.lats, points.lons, interp=job["interp"], ids=points.ids)
+    if digest != job["points_digest"]:
+        raise ValueError(f"The points file does not match the job in {ledger.path} (digest {digest}).")
+
+    stop = stop or threading.Event()
+    worker_id = worker_id or default_worker_id()
+    shard = os.path.join(shard_root, f"worker={worker_id}")
+    writer = ParquetWriter(shard, digest, job["variables"])
+    extract_points = unique_points(points.lats, points.lons)
+    variables, fetch_mode, interp = job["variables"], job["fetch_mode"], job["interp"]
+
+    held, held_lock, finished = set(), threading.Lock(), threading.Event()
+
+    def heartbeat():
+        while not finished.wait(ledger.lease_seconds / 3):
+            with held_lock:
+                tasks = list(held)
+            try:
+                ledger.renew(worker_id, tasks)
+            except sqlite3.Error as e:
+                logging.warning(f"Failed to renew leases: {e}")
+
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    s3_client = get_s3_client(s3_connections)
+    completed = 0
+    logging.info(f"Worker {worker_id} writing shards to {shard}.")
+    try:
+        with ThreadPoolExecutor(download_workers) as download_pool, ProcessPoolExecutor(decode_workers) as decode_pool:
+            while not stop.is_set():
+                tasks = ledger.claim(worker_id, download_workers + decode_workers)
+                if not tasks:
+                    counts = ledger.counts()
+                    if not counts["pending"] and not counts["leased"]:
+                        break
+                    stop.wait(poll_interval)  # other workers hold the rest; their leases may still expire
+                    continue
+                logging.info(f"Leased {', '.join(str(task) for task in tasks)}")
+                with held_lock:
+                    held.update(tasks)
+                error = "no data extracted"
+                try:
+                    results = run_pipeline(
+                        s3_client,
+                        tasks,
+                        extract_points,
+                        variables,
+                        fetch_mode=fetch_mode,
+                        download_workers=download_workers,
+                        decode_workers=decode_workers,
+                        max_pending_files=max_pending_files,
+                        interp=interp,
+                        download_pool=download_pool,
+                        decode_pool=decode_pool,
+                    )
+                    for task, data_df in results:
+                        if data_df.empty:
+                            continue
+                        if not writer.point_map_saved:
+                            # Written before the hour's files, so a shard never holds rows without its map
+                            map_df = map_task_points(task, fetch_mode, variables, points, interp, s3_client)
+                            if map_df.empty:
+                                continue  # handed back below
+                            writer.save_point_map(map_df)
+                        writer.add(data_df)
+                        if ledger.complete(worker_id, task, shard):
+                            completed += 1
+                        else:
+                            logging.warning(f"Lost the lease on {task}; another worker took it over.")
+                        with held_lock:
+                            held.discard(task)
+                except Exception as e:
+                    error = str(e)
+                    raise
+                finally:
+                    with held_lock:
+                        failed = list(held)
+                        held.clear()
+                    for task in failed:
+                        logging.error(f"Handing {task} back: {error}")
+                        ledger.fail(worker_id, task, error)
+    finally:
+        finished.set()
+        heartbeat_thread.join()
+        s3_client.close()
+    logging.info(f"Worker {worker_id} completed {completed} forecast hours.")
+    return completed
+
+
+def merge(ledger: WorkLedger, con, bulk: bool = False, flush_rows: int = DEFAULT_FLUSH_ROWS) -> int:
+    """
+    Loads every done hour's shard into the database, through the same StreamingWriter (load ledger, duplicate
+    handling) as a local run, and marks it merged. Rows are committed before their hours are marked merged, so
+    an interrupted merge can simply be run again. Shards are left in place. Returns the number of rows written.
+    """
+    job = ledger.job()
+    digest = job["points_digest"]
+    create_table_if_not_exists(con, job["schema"], bulk=bulk)
+    writer = StreamingWriter(
+        con,
+        digest,
+        flush_rows=flush_rows,
+        bulk=bulk,
+        schema=job["schema"],
+        variables=job["variables"],
+        interp=job["interp"],
+    )
+
+    pending = []  # hours buffered in the writer but not committed yet
+    for task, shard in ledger.done():
+        data_df = read_forecast_hour(shard, task.run_date, task.run_hour, task.forecast_hour, digest)
+        if data_df.empty:
+            logging.error(f"No shard files for {task} under {shard}; queueing it again.")
+            ledger.requeue(task, f"shard files missing from {shard}")
+            continue
+        if not writer.point_map_saved:
+            point_map_path = os.path.join(shard, "point_map", f"{digest}.parquet")
+            if not os.path.exists(point_map_path):
+                logging.error(f"No point map under {shard}; leaving {task} unmerged.")
+                continue
+            writer.save_point_map(pq.read_table(point_map_path).to_pandas())  # committed with the first rows
+        writer.add(data_df)
+        pending.append(task)
+        if not writer.buffer:  # flushed
+            for merged_task in pending:
+                ledger.mark_merged(merged_task)
+            pending = []
+    writer.close()
+    for task in pending:
+        ledger.mark_merged(task)
+    logging.info(f"Merged {writer.written_rows} records into the database.")
+    return writer.written_rows
+
+
+def print_status(ledger: WorkLedger):
+    counts = ledger.counts()
+    print(", ".join(f"{status}: {count}" for status, count in counts.items()))
+    for item in ledger.items(["leased", "failed"]):
+        task = IngestTask(date.fromisoformat(item["run_date"]), item["run_hour"], item["forecast_hour"])
+        detail = f"worker {item['worker']}" if item["status"] == "leased" else item["error"]
+        print(f"{task}  {item['status']}  attempts={item['attempts']}  {detail}")
+
+
+if __name__ == "__main__":
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Sharded HRRR ingestion from a shared work ledger.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    work_parser = commands.add_parser("work", help="Lease forecast hours and write them to Parquet shards.")
+    work_parser.add_argument("ledger", help="Work ledger written by hrrr_ingest.py --enqueue.")
+    work_parser.add_argument("points_file", help="The points file the job was enqueued with.")
+    work_parser.add_argument("--shards", required=True, help="Directory shared by all workers for their shards.")
+    work_parser.add_argument("--worker-id", default=None, help="Defaults to <hostname>-<pid>.")
+    work_parser.add_argument("--download-workers", type=int, default=DEFAULT_DOWNLOAD_WORKERS)
+    work_parser.add_argument("--decode-workers", type=int, default=DEFAULT_DECODE_WORKERS)
+    work_parser.add_argument("--s3-connections", type=int, default=DEFAULT_S3_CONNECTIONS)
+    work_parser.add_argument("--max-pending-files", type=int, default=None)
+    work_parser.add_argument("--lease-seconds", type=float, default=WORK_LEASE_SECONDS)
+
+    merge_parser = commands.add_parser("merge", help="Load the shards of done hours into the database.")
+    merge_parser.add_argument("ledger")
+    merge_parser.add_argument("--bulk-load", action="store_true")
+    merge_parser.add_argument("--flush-rows", type=int, default=DEFAULT_FLUSH_ROWS)
+
+    status_parser = commands.add_parser("status", help="Show the state of the job.")
+    status_parser.add_argument("ledger")
+    status_parser.add_argument("--retry-failed", action="store_true", help="Queue failed hours again.")
+    args = parser.parse_args()
+
+    ledger = WorkLedger(args.ledger, lease_seconds=getattr(args, "lease_seconds", WORK_LEASE_SECONDS))
+    try:
+        if args.command == "work":
+            try:
+                points = read_points(args.points_file)
+                work(
+                    ledger,
+                    points,
+                    args.shards,
+                    args.worker_id,
+                    download_workers=args.download_workers,
+                    decode_workers=args.decode_workers,
+                    s3_connections=args.s3_connections,
+                    max_pending_files=args.max_pending_files,
+                )
+            except ValueError as e:
+                logging.error(e)
+                sys.exit(1)
+        elif args.command == "merge":
+            con = get_db_connection()
+            try:
+                merge(ledger, con, bulk=args.bulk_load, flush_rows=args.flush_rows)
+            finally:
+                con.close()
+        else:
+            if args.retry_failed:
+                logging.info(f"Queued {ledger.retry_failed()} failed hours again.")
+            print_status(ledger)
+    finally:
+        ledger.close()
@@ -1,32 +1,217 @@
 import os
+import hashlib
+import logging
+import math
 from datetime import date
-from utils import get_grib_s3_key, build_grib_file_path
-from config import CACHE_DIR
+from utils import (
+    get_grib_s3_key,
+    build_grib_file_path,
+    parse_idx,
+    find_idx_byte_ranges,
+    coalesce_byte_ranges,
+    file_lock,
+    s3_etag,
+)
+from config import CACHE_DIR, RUN_HOUR, VARIABLE_IDX_MAP
+from derived import source_variables
+from cache_manager import get_cache_manager
+from metrics import get_metrics
 
 
 os.makedirs(CACHE_DIR, exist_ok=True)
 
 
-def download_s3_file(s3_client, bucket: str, key: str, local_path: str):
+MAX_ETAG_PART_SIZE_GUESSES = 4
+
+
+def download_s3_file(s3_client, bucket: str, key: str, local_path: str, head: dict = None):
+    """Downloads an object and, given its `head_object` response, verifies the local copy against it."""
     s3_client.download_file(bucket, key, local_path)
+    if head is not None:
+        verify_download(local_path, head)
 
 
-def download_and_cache_file(s3_client, bucket: str, run_date: date, forecast_hour: int):
-    date_folder = os.path.join(CACHE_DIR, f"{run_date:%Y%m%d}")
-    os.makedirs(date_folder, exist_ok=True)
-    cache_path = os.path.join(date_folder, build_grib_file_path(forecast_hour))
+def verify_download(local_path: str, head: dict):
+    """
+    Checks the size and ETag of a downloaded file against a `head_object` response. Raises ValueError on mismatch.
+    Multipart ETags do not record the part size, so the whole-MiB part sizes that give the reported part count
+    are tried; when there are too many candidates only the size is checked.
+    """
+    size = os.path.getsize(local_path)
+    if size != head["ContentLength"]:
+        raise ValueError(f"Downloaded {size} bytes to {local_path}, expected {head['ContentLength']}")
 
-    if not os.path.exists(cache_path):
-        print(f"Downloading {cache_path} from S3...")
-        s3_key = get_grib_s3_key(run_date, forecast_hour)
-        download_s3_file(s3_client, bucket, s3_key, cache_path)
+    etag = head.get("ETag", "").strip('"')
+    if not etag:
+        return
+    if "-" not in etag:
+        candidates = [None]
     else:
-        print(f"Using cached file: {cache_path}")
+        parts = int(etag.rsplit("-", 1)[1])
+        mib = 1024 * 1024
+        smallest = max(1, math.ceil(size / parts / mib))
+        candidates = []
+        for part_mib in range(smallest, smallest + MAX_ETAG_PART_SIZE_GUESSES + 1):
+            if math.ceil(size / (part_mib * mib)) == parts:
+                candidates.append(part_mib * mib)
+        if not candidates or len(candidates) > MAX_ETAG_PART_SIZE_GUESSES:
+            logging.debug(f"Cannot infer the part size of ETag {etag}, only the size of {local_path} was checked.")
+            return
+
+    if not any(s3_etag(local_path, part_size) == etag for part_size in candidates):
+        raise ValueError(f"ETag of {local_path} does not match S3 ETag {etag}")
+
+
+def cached_download(cache_path: str, plan, pin: bool = False):
+    """
+    On a cache miss, calls `plan()` for the size of the file and its downloader, `(nbytes, download)`, evicts
+    least-recently-used cache files to make room for `nbytes`, runs `download(tmp_path)` to fetch and verify the
+    file and atomically renames it to `cache_path`, so the cache only ever holds complete files. The new file is
+    registered with the cache manager. Cache hits only refresh the access time and never call `plan`, so any
+    S3 request it makes (HEAD, .idx) is only paid for a download.
+
+    A per-file lock makes concurrent callers (threads or processes on this host) share one download:
+    the first one fetches the file and the others find it in the cache once the lock is released.
+    """
+    cache = get_cache_manager()
+    metrics = get_metrics()
+    with file_lock(f"{cache_path}.lock"):
+        if os.path.exists(cache_path):
+            print(f"Using cached file: {cache_path}")
+            metrics.count("cache.hits")
+            cache.touch(cache_path, pin=pin)
+            return cache_path
+        metrics.count("cache.misses")
 
+        # Leftover of an interrupted download is overwritten, nobody else can be writing it while we hold the lock
+        tmp_path = f"{cache_path}.tmp"
+        nbytes, download = plan()
+        cache.ensure_space(nbytes)
+        try:
+            with metrics.timer("download"):
+                download(tmp_path)
+            metrics.count("download.bytes", os.path.getsize(tmp_path))
+            os.replace(tmp_path, cache_path)
+        except Exception:
+            cache.release(nbytes)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        cache.add(cache_path, reserved=nbytes, pin=pin)
     return cache_path
 
 
-def get_grib_file_path(s3_client, bucket: str, run_date: date, forecast_hour: int):
-    """Wrapper to download and cache the GRIB file."""
-    print(f"Downloading {run_date} forecast hour {forecast_hour} GRIB file from S3...")
-    return download_and_cache_file(s3_client, bucket, run_date, forecast_hour)
+def get_cache_path(
+    run_date: date, forecast_hour: int, fetch_mode: str = "full", variables: list = None, run_hour: int = RUN_HOUR
+) -> str:
+    """Local cache path of a GRIB file, either the full file or the subset holding `variables`."""
+    if fetch_mode == "partial":
+        file_name = build_subset_file_path(forecast_hour, variables, run_hour)
+    else:
+        file_name = build_grib_file_path(forecast_hour, run_hour=run_hour)
+    return os.path.join(CACHE_DIR, f"{run_date:%Y%m%d}", file_name)
+
+
+def download_and_cache_file(
+    s3_client, bucket: str, run_date: date, forecast_hour: int, pin: bool = False, run_hour: int = RUN_HOUR
+):
+    cache_path = get_cache_path(run_date, forecast_hour, run_hour=run_hour)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    def plan():
+        print(f"Downloading {cache_path} from S3...")
+        s3_key = get_grib_s3_key(run_date, forecast_hour, run_hour=run_hour)
+        head = s3_client.head_object(Bucket=bucket, Key=s3_key)
+        return head["ContentLength"], lambda tmp_path: download_s3_file(s3_client, bucket, s3_key, tmp_path, head)
+
+    return cached_download(cache_path, plan, pin)
+
+
+def build_subset_file_path(forecast_hour: int, variables: list, run_hour: int = RUN_HOUR) -> str:
+    """
+    Cache file name for a partial GRIB holding only the given variables.
+    For example: hrrr.t06z.wrfsfcf00.subset-1a2b3c4d.grib2
+    """
+    digest = hashlib.sha1(",".join(sorted(source_variables(variables))).encode()).hexdigest()[:8]
+    return build_grib_file_path(forecast_hour, run_hour=run_hour).replace(".grib2", f".subset-{digest}.grib2")
+
+
+def fetch_idx(s3_client, bucket: str, run_date: date, forecast_hour: int, run_hour: int = RUN_HOUR) -> list[dict]:
+    """Downloads and parses the .idx inventory of a GRIB file."""
+    idx_key = get_grib_s3_key(run_date, forecast_hour, for_idx=True, run_hour=run_hour)
+    response = s3_client.get_object(Bucket=bucket, Key=idx_key)
+    return parse_idx(response["Body"].read().decode())
+
+
+def download_byte_ranges(s3_client, bucket: str, key: str, byte_ranges: list[tuple], local_path: str) -> int:
+    """
+    Fetches each (start, end) range with a ranged GET and writes them back to back. Returns bytes written.
+    Raises ValueError if a range comes back short, or if the object's ETag changes between requests
+    (the file was replaced on S3 mid-download, so the ranges no longer line up).
+    """
+    written = 0
+    etag = None
+    with open(local_path, "wb") as f:
+        for start, end in byte_ranges:
+            byte_range = f"bytes={start}-{'' if end is None else end}"
+            response = s3_client.get_object(Bucket=bucket, Key=key, Range=byte_range)
+            chunk = response["Body"].read()
+            expected = response["ContentLength"] if end is None else end - start + 1
+            if len(chunk) != expected:
+                raise ValueError(f"Range {byte_range} of {key} returned {len(chunk)} bytes, expected {expected}")
+            if etag is not None and response.get("ETag") != etag:
+                raise ValueError(f"{key} changed on S3 while its byte ranges were being downloaded")
+            etag = response.get("ETag")
+            f.write(chunk)
+            written += len(chunk)
+    return written
+
+
+def download_and_cache_subset(
+    s3_client,
+    bucket: str,
+    run_date: date,
+    forecast_hour: int,
+    variables: list,
+    pin: bool = False,
+    run_hour: int = RUN_HOUR,
+):
+    """
+    Downloads only the GRIB messages needed for `variables`.
+    The .idx inventory is used to resolve each variable to a byte range, adjacent ranges are coalesced,
+    and the selected messages are written into a compact GRIB file that cfgrib can open as usual.
+    """
+    cache_path = get_cache_path(run_date, forecast_hour, "partial", variables, run_hour)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    def plan():
+        idx_entries = fetch_idx(s3_client, bucket, run_date, forecast_hour, run_hour)
+        messages = source_variables(variables)  # derived variables are computed from their inputs' messages
+        byte_ranges = coalesce_byte_ranges(find_idx_byte_ranges(idx_entries, [VARIABLE_IDX_MAP[v] for v in messages]))
+        print(f"Downloading {len(messages)} messages in {len(byte_ranges)} ranged requests to {cache_path}...")
+        s3_key = get_grib_s3_key(run_date, forecast_hour, run_hour=run_hour)
+        # The size of an open-ended last range is unknown until it is fetched, so only the known ranges are reserved
+        nbytes = sum(end - start + 1 for start, end in byte_ranges if end is not None)
+        return nbytes, lambda tmp_path: download_byte_ranges(s3_client, bucket, s3_key, byte_ranges, tmp_path)
+
+    return cached_download(cache_path, plan, pin)
+
+
+def get_grib_file_path(
+    s3_client,
+    bucket: str,
+    run_date: date,
+    forecast_hour: int,
+    fetch_mode: str = "full",
+    variables: list = None,
+    pin: bool = False,
+    run_hour: int = RUN_HOUR,
+):
+    """
+    Wrapper to download and cache the GRIB file, either in full or only the messages for `variables`.
+    With `pin`, the file is pinned in the cache until the caller unpins it (see cache_manager).
+    """
+    print(f"Downloading {run_date} {run_hour:02}z forecast hour {forecast_hour} GRIB file from S3...")
+    if fetch_mode == "partial":
+        return download_and_cache_subset(s3_client, bucket, run_date, forecast_hour, variables, pin, run_hour)
+    return download_and_cache_file(s3_client, bucket, run_date, forecast_hour, pin, run_hour)
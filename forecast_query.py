@@ -0,0 +1,302 @@
+"""
+Read side of the database: time series, latest-run and snapshot queries on hrrr_forecasts, returned as Arrow tables
+(`table.column("value").to_numpy()` gives NumPy arrays).
+
+Queried points are matched to the nearest stored location (a grid cell, or an interpolated point) with a KD-tree,
+then joined against hrrr_forecasts with the variables and times pushed into the scan, so DuckDB's per-row-group
+min/max statistics skip most of the table, all the more after db_manager.cluster_forecasts has sorted it.
+Recent results are kept in an LRU cache that is dropped as soon as the database changes.
+
+DuckDB lets one process write a database file, or any number of processes read it, not both. So the reader holds
+no connection between queries: it opens a read-only one for each cache miss and closes it right away, and tells
+whether new rows were committed from the size and modification time of the database and its write-ahead log,
+without opening it. Queries therefore fail while an ingest holds data.db open, and ingests can start whenever no
+query is running.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from scipy.spatial import cKDTree
+
+from config import (
+    DB_FILE,
+    LEDGER_TABLE_NAME,
+    POINT_MAP_TABLE_NAME,
+    QUERY_CACHE_SIZE,
+    QUERY_MAX_DISTANCE_KM,
+    TABLE_NAME,
+)
+from grid_index import lat_lon_to_xyz
+from metrics import get_metrics
+
+EARTH_RADIUS_KM = 6371.0
+SERIES_SCHEMA = pa.schema(
+    [
+        ("point", pa.int64()),
+        ("variable", pa.string()),
+        ("run_time_utc", pa.timestamp("us")),
+        ("valid_time_utc", pa.timestamp("us")),
+        ("value", pa.float32()),
+    ]
+)
+
+
+def _table_exists(con, name: str) -> bool:
+    row = con.execute("SELECT 1 FROM information_schema.tables WHERE table_name = ?", [name]).fetchone()
+    return row is not None
+
+
+def _check_variables(variables: list):
+    if not variables:
+        raise ValueError("At least one variable is required.")
+
+
+def _timestamp(value):
+    """Naive UTC timestamp, matching the TIMESTAMP columns; None stays None."""
+    if value is None:
+        return None
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert("UTC").tz_localize(None)
+    return timestamp.to_pydatetime()
+
+
+class ForecastReader:
+    """
+    Queries a database written by hrrr_ingest.py. Points are (lats, lons) array pairs or utils.Points; every
+    result row carries the index of its queried point (`point`, plus `point_id` for Points with IDs).
+    Points farther than QUERY_MAX_DISTANCE_KM from every stored location get no rows. Safe to share
+    between threads, queries on one reader run one at a time.
+
+    Without `con` the reader opens `path` read-only for each query that misses the cache (see the module
+    docstring). With `con`, e.g. the writer's own connection, it queries that connection and checks the load
+    ledger for new commits instead.
+    """
+
+    def __init__(self, con=None, cache_size: int = QUERY_CACHE_SIZE, path: str = DB_FILE):
+        self.con = con
+        self.path = path
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._locations = None  # (lats, lons, KD-tree) of the stored locations
+        self._version = None
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def _connect(self):
+        """The caller's connection, or a read-only one to `path` that is closed on exit."""
+        if self.con is not None:
+            yield self.con
+            return
+        con = duckdb.connect(self.path, read_only=True)
+        try:
+            yield con
+        finally:
+            con.close()
+
+    # --- invalidation ---
+
+    def _current_version(self):
+        if self.con is None:
+            # Commits land in the write-ahead log and checkpoints rewrite the file, so together they show any change
+            stats = [os.stat(path) for path in (self.path, f"{self.path}.wal") if os.path.exists(path)]
+            return tuple((stat.st_mtime_ns, stat.st_size) for stat in stats)
+        if not _table_exists(self.con, LEDGER_TABLE_NAME):
+            return self.con.execute(f"SELECT count(*) FROM {TABLE_NAME}").fetchone()
+        return self.con.execute(f"SELECT count(*), max(loaded_at) FROM {LEDGER_TABLE_NAME}").fetchone()
+
+    def _check_version(self):
+        """Drops cached results and locations if rows were committed since the last call."""
+        version = self._current_version()
+        if version != self._version:
+            self._cache.clear()
+            self._locations = None
+            self._version = version
+
+    def invalidate(self):
+        with self._lock:
+            self._cache.clear()
+            self._locations = None
+            self._version = None
+
+    def _cached(self, key: tuple, query):
+        with self._lock:
+            self._check_version()
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                get_metrics().count("query.cache_hits")
+                return self._cache[key]
+            get_metrics().count("query.cache_misses")
+            with get_metrics().timer("query"), self._connect() as con:
+                result = query(con)
+            self._cache[key] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return result
+
+    # --- point matching ---
+
+    def _load_locations(self, con):
+        if self._locations is None:
+            # The point map lists every location rows were stored under; older databases are scanned instead
+            lats = lons = []
+            if _table_exists(con, POINT_MAP_TABLE_NAME):
+                rows = con.execute(
+                    f"SELECT DISTINCT forecast_latitude, forecast_longitude FROM {POINT_MAP_TABLE_NAME}"
+                ).fetchnumpy()
+                lats, lons = rows["forecast_latitude"], rows["forecast_longitude"]
+            if len(lats) == 0:
+                rows = con.execute(f"SELECT DISTINCT latitude, longitude FROM {TABLE_NAME}").fetchnumpy()
+                lats, lons = rows["latitude"], rows["longitude"]
+            lats, lons = np.asarray(lats, dtype=np.float32), np.asarray(lons, dtype=np.float32)
+            tree = cKDTree(lat_lon_to_xyz(lats, lons)) if len(lats) else None
+            self._locations = (lats, lons, tree)
+        return self._locations
+
+    def _match_points(self, con, point_lats, point_lons) -> pa.Table:
+        """(point, latitude, longitude) of the stored location of each queried point that has one."""
+        lats, lons, tree = self._load_locations(con)
+        if tree is None:
+            return pa.table({"point": pa.array([], pa.int64()), "latitude": lats, "longitude": lons})
+        distances, nearest = tree.query(lat_lon_to_xyz(point_lats, point_lons))
+        # Chord length on the unit sphere, close enough to the arc for distances of a few km
+        found = np.flatnonzero(distances * EARTH_RADIUS_KM <= QUERY_MAX_DISTANCE_KM)
+        return pa.table({"point": found, "latitude": lats[nearest[found]], "longitude": lons[nearest[found]]})
+
+    @staticmethod
+    def _points_key(points) -> tuple:
+        lats, lons = np.ascontiguousarray(points[0], dtype=np.float64), np.ascontiguousarray(points[1], dtype=np.float64)
+        return lats, lons, hashlib.sha1(lats.tobytes() + lons.tobytes()).hexdigest()
+
+    @staticmethod
+    def _with_point_ids(table: pa.Table, points) -> pa.Table:
+        ids = getattr(points, "ids", None)
+        if ids is None:
+            return table
+        return table.append_column("point_id", pa.array(np.asarray(ids)[table["point"].to_numpy()], pa.string()))
+
+    # --- queries ---
+
+    def get_series(self, points, variables: list, run=None, valid_range: tuple = None) -> pa.Table:
+        """
+        Time series at `points`: point, variable, run_time_utc, valid_time_utc, value, sorted in that order.
+        `run` restricts the rows to one run (its run_time_utc), `valid_range` to (start, end) valid times,
+        both inclusive and either may be None. Timestamps may be tz-aware or naive UTC.
+        """
+        _check_variables(variables)
+        lats, lons, points_hash = self._points_key(points)
+        run = _timestamp(run)
+        start, end = (_timestamp(value) for value in (valid_range or (None, None)))
+
+        def query(con):
+            filters, params = [f"f.variable IN ({', '.join('?' * len(variables))})"], list(variables)
+            for condition, value in [("f.run_time_utc = ?", run), ("f.valid_time_utc >= ?", start), ("f.valid_time_utc <= ?", end)]:
+                if value is not None:
+                    filters.append(condition)
+                    params.append(value)
+            con.register("query_points", self._match_points(con, lats, lons))
+            try:
+                return con.execute(
+                    f"""
+                        SELECT q.point, f.variable, f.run_time_utc, f.valid_time_utc, f.value
+                        FROM {TABLE_NAME} f
+                        JOIN query_points q ON f.latitude = q.latitude AND f.longitude = q.longitude
+                        WHERE {' AND '.join(filters)}
+                        ORDER BY q.point, f.variable, f.valid_time_utc, f.run_time_utc
+                    """,
+                    params,
+                ).fetch_arrow_table()
+            finally:
+                con.unregister("query_points")
+
+        table = self._cached(("series", points_hash, tuple(variables), run, start, end), query)
+        return self._with_point_ids(table, points)
+
+    def latest_run(self, variables: list):
+        """run_time_utc of the newest run with committed rows for any of `variables`, or None."""
+        _check_variables(variables)
+
+        def query(con):
+            # The ledger is small; databases from before it existed are scanned instead
+            table = LEDGER_TABLE_NAME if _table_exists(con, LEDGER_TABLE_NAME) else TABLE_NAME
+            return con.execute(
+                f"SELECT max(run_time_utc) FROM {table} WHERE variable IN ({', '.join('?' * len(variables))})",
+                list(variables),
+            ).fetchone()[0]
+
+        return self._cached(("latest_run", tuple(variables)), query)
+
+    def get_latest(self, points, variables: list) -> pa.Table:
+        """The time series of the newest run at `points` (see get_series). Empty if nothing is loaded yet."""
+        run = self.latest_run(variables)
+        if run is None:
+            return self._with_point_ids(SERIES_SCHEMA.empty_table(), points)
+        return self.get_series(points, variables, run=run)
+
+    def get_snapshot(self, valid_time, variables: list, run=None) -> pa.Table:
+        """
+        Every stored location at one valid time: variable, latitude, longitude, run_time_utc, valid_time_utc, value.
+        Without `run`, each location and variable takes its value from the newest run that forecasts `valid_time`.
+        """
+        _check_variables(variables)
+        valid_time, run = _timestamp(valid_time), _timestamp(run)
+
+        def query(con):
+            params = [valid_time, *variables]
+            run_filter = "AND run_time_utc = ?" if run is not None else ""
+            if run is not None:
+                params.append(run)
+            newest = (
+                "QUALIFY row_number() OVER (PARTITION BY variable, latitude, longitude ORDER BY run_time_utc DESC) = 1"
+                if run is None
+                else ""
+            )
+            return con.execute(
+                f"""
+                    SELECT variable, latitude, longitude, run_time_utc, valid_time_utc, value
+                    FROM {TABLE_NAME}
+                    WHERE valid_time_utc = ? AND variable IN ({', '.join('?' * len(variables))}) {run_filter}
+                    {newest}
+                    ORDER BY variable, latitude, longitude
+                """,
+                params,
+            ).fetch_arrow_table()
+
+        return self._cached(("snapshot", valid_time, tuple(variables), run), query)
+
+    def close(self):
+        """Closes the connection passed in, if any, and drops the cache."""
+        if self.con is not None:
+            self.con.close()
+        self.invalidate()
+
+
+_reader = None
+
+
+def get_reader() -> ForecastReader:
+    """Process-wide reader of DB_FILE, which opens it read-only only while a query runs."""
+    global _reader
+    if _reader is None:
+        _reader = ForecastReader()
+    return _reader
+
+
+def get_series(points, variables: list, run=None, valid_range: tuple = None) -> pa.Table:
+    return get_reader().get_series(points, variables, run, valid_range)
+
+
+def get_latest(points, variables: list) -> pa.Table:
+    return get_reader().get_latest(points, variables)
+
+
+def get_snapshot(valid_time, variables: list, run=None) -> pa.Table:
+    return get_reader().get_snapshot(valid_time, variables, run)
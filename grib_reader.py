@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+import eccodes
+import numpy as np
+import pandas as pd
+
+from config import GRID_INDEX_DIR, MESSAGE_INDEX_SUFFIX, VARIABLE_MAP
+from metrics import get_metrics
+
+HEADER_KEYS = ["shortName", "typeOfLevel", "level"]
+# Also recorded in the message index, so reading a cached file needs neither a rescan nor extra decoding
+METADATA_KEYS = ["dataDate", "dataTime", "validityDate", "validityTime", "Ni", "Nj", "md5GridSection"]
+MESSAGE_INDEX_VERSION = 1
+
+# In-process memo of grid coordinates, keyed by the MD5 of the GRIB grid definition section
+_grid_coordinates = {}
+
+
+def scan_grib_messages(grib_file: str) -> list[dict]:
+    """
+    Scans the message headers of a GRIB file in a single pass, without decoding any data values.
+    Returns one entry per message with its byte offset, length, the keys used by VARIABLE_MAP and METADATA_KEYS.
+    """
+    messages = []
+    with open(grib_file, "rb") as f:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(f, headers_only=True)
+            if gid is None:
+                break
+            try:
+                message = {
+                    "offset": int(eccodes.codes_get(gid, "offset")),
+                    "length": int(eccodes.codes_get(gid, "totalLength")),
+                }
+                for key in HEADER_KEYS + METADATA_KEYS:
+                    message[key] = eccodes.codes_get(gid, key)
+                messages.append(message)
+            finally:
+                eccodes.codes_release(gid)
+    return messages
+
+
+def _file_signature(grib_file: str) -> dict:
+    stat = os.stat(grib_file)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def load_message_index(grib_file: str) -> list[dict]:
+    """
+    Returns the messages of a GRIB file, from its `<file>.msgidx.json` sidecar when it matches the file's
+    size and modification time, otherwise by scanning the file and writing the sidecar for next time.
+    """
+    index_path = f"{grib_file}{MESSAGE_INDEX_SUFFIX}"
+    signature = _file_signature(grib_file)
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get("version") == MESSAGE_INDEX_VERSION and index.get("file") == signature:
+            return index["messages"]
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable message index {index_path}: {e}")
+
+    get_metrics().count("grib.scans")
+    messages = scan_grib_messages(grib_file)
+    index = {"version": MESSAGE_INDEX_VERSION, "file": signature, "messages": messages}
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)  # atomic, concurrent workers may index the same file
+    except OSError as e:
+        logging.warning(f"Could not write message index {index_path}: {e}")
+    return messages
+
+
+def load_grid_coordinates(grib_file: str, message: dict) -> tuple:
+    """
+    Returns 2-D (latitude, longitude) arrays for the grid of `message`. Computing them for a projected grid
+    is costly, so they are saved under GRID_INDEX_DIR once per grid definition and memoized in-process.
+    The saved arrays are memory-mapped, so only the pages a worker actually touches are read into memory.
+    """
+    grid_hash = message["md5GridSection"]
+    if grid_hash in _grid_coordinates:
+        return _grid_coordinates[grid_hash]
+
+    coords_path = os.path.join(GRID_INDEX_DIR, f"{grid_hash}.latlon.npy")
+    coords = None
+    if os.path.exists(coords_path):
+        try:
+            coords = np.load(coords_path, mmap_mode="r")
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable grid coordinates {coords_path}: {e}")
+
+    if coords is None:
+        shape = (message["Nj"], message["Ni"])
+        with open(grib_file, "rb") as f:
+            f.seek(message["offset"])
+            gid = eccodes.codes_new_from_message(f.read(message["length"]))
+        try:
+            computed = np.stack(
+                (
+                    eccodes.codes_get_array(gid, "latitudes").reshape(shape),
+                    eccodes.codes_get_array(gid, "longitudes").reshape(shape),
+                )
+            )
+        finally:
+            eccodes.codes_release(gid)
+        os.makedirs(GRID_INDEX_DIR, exist_ok=True)
+        tmp_path = f"{coords_path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, computed)
+        os.replace(tmp_path, coords_path)
+        del computed
+        coords = np.load(coords_path, mmap_mode="r")
+
+    _grid_coordinates[grid_hash] = (coords[0], coords[1])
+    return _grid_coordinates[grid_hash]
+
+
+def match_messages(messages: list[dict], variables: list) -> dict:
+    """Picks the first message matching each variable's VARIABLE_MAP filter keys, same as cfgrib's filter_by_keys."""
+    matched = {}
+    for var_name in variables:
+        filter_keys = VARIABLE_MAP[var_name]
+        message = next((m for m in messages if all(m.get(k) == v for k, v in filter_keys.items())), None)
+        if message is None:
+            logging.warning(f"No GRIB message matches {var_name} ({filter_keys}).")
+            continue
+        matched[var_name] = message
+    return matched
+
+
+def _grib_datetime(message: dict, date_key: str, time_key: str) -> pd.Timestamp:
+    value = f"{message[date_key]}{message[time_key]:04d}"
+    return pd.Timestamp(datetime.strptime(value, "%Y%m%d%H%M"), tz="UTC")
+
+
+def read_grib_header(grib_file: str, variables: list) -> dict:
+    """
+    Finds the messages of the requested variables without decoding any data values. The scan is skipped
+    when the file's message index is already persisted (see load_message_index). Returns a dict with:
+        messages: {variable name: message index entry}
+        latitude, longitude: 2-D grid coordinate arrays (of the first matched message's grid), lazily loaded
+        run_time_utc, valid_time_utc: tz-aware timestamps
+    """
+    with get_metrics().timer("decode.header"):
+        matched = match_messages(load_message_index(grib_file), variables)
+    result = {"messages": matched, "latitude": None, "longitude": None, "run_time_utc": None, "valid_time_utc": None}
+    if matched:
+        first = next(iter(matched.values()))
+        result["latitude"], result["longitude"] = load_grid_coordinates(grib_file, first)
+        result["run_time_utc"] = _grib_datetime(first, "dataDate", "dataTime")
+        result["valid_time_utc"] = _grib_datetime(first, "validityDate", "validityTime")
+    return result
+
+
+def decode_fields(grib_file: str, messages: dict, window: tuple = None) -> dict:
+    """
+    Decodes the given messages ({variable name: message index entry}) into 2-D arrays, cropped to `window`
+    ((row slice, column slice)) when given. GRIB packing has to be decoded whole, so messages are decoded
+    one at a time and only the window is kept: peak memory is one full field plus the cropped windows.
+    """
+    fields = {}
+    metrics = get_metrics()
+    metrics.count("grib.opens")
+    with open(grib_file, "rb") as f:
+        for var_name, message in messages.items():
+            decode_start = time.perf_counter()
+            f.seek(message["offset"])
+            gid = eccodes.codes_new_from_message(f.read(message["length"]))
+            try:
+                values = eccodes.codes_get_values(gid).reshape(message["Nj"], message["Ni"])
+                if window is not None:
+                    values = values[window].copy()  # drop the full field right away
+                if eccodes.codes_get(gid, "bitmapPresent"):
+                    values[values == eccodes.codes_get(gid, "missingValue")] = np.nan
+                fields[var_name] = values
+            finally:
+                eccodes.codes_release(gid)
+            metrics.observe(f"decode.{var_name}", time.perf_counter() - decode_start)
+            metrics.count("grib.messages_decoded")
+    return fields
+
+
+def read_grib_fields(grib_file: str, variables: list, window: tuple = None) -> dict:
+    """
+    Reads the requested variables from a GRIB file, opening and scanning it only once.
+    Only the matched messages are decoded. Returns read_grib_header's dict plus:
+        fields: {variable name: 2-D array of values, cropped to `window` if given}
+    """
+    result = read_grib_header(grib_file, variables)
+    result["fields"] = decode_fields(grib_file, result["messages"], window)
+    return result
@@ -0,0 +1,186 @@
+import hashlib
+import logging
+import os
+import pickle
+
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from config import GRID_INDEX_DIR
+
+# In-process memo so every variable and forecast hour handled by a worker reuses the same tree and lookups
+_trees = {}
+_lookups = {}
+
+
+def lat_lon_to_xyz(lats, lons) -> np.ndarray:
+    """Converts degrees to 3-D unit-sphere coordinates, so chord distance ranks like great-circle distance."""
+    lat_rad = np.radians(np.asarray(lats, dtype=np.float64)).ravel()
+    lon_rad = np.radians(np.asarray(lons, dtype=np.float64)).ravel()
+    cos_lat = np.cos(lat_rad)
+    return np.column_stack((cos_lat * np.cos(lon_rad), cos_lat * np.sin(lon_rad), np.sin(lat_rad)))
+
+
+def grid_fingerprint(lats: np.ndarray, lons: np.ndarray) -> str:
+    """Identifies a grid by its shape and a strided sample of its coordinates (the HRRR grid is fixed)."""
+    sample = np.concatenate((lats[::97, ::97].ravel(), lons[::97, ::97].ravel(), lats[-1, -1:], lons[-1, -1:]))
+    digest = hashlib.sha1(repr(lats.shape).encode() + np.round(sample, 5).tobytes()).hexdigest()
+    return digest[:16]
+
+
+def load_or_build_grid_index(lats: np.ndarray, lons: np.ndarray) -> tuple:
+    """
+    Returns (fingerprint, cKDTree) for the grid. The tree is built once per grid, persisted under
+    GRID_INDEX_DIR next to the GRIB cache, and memoized in-process.
+    """
+    fingerprint = grid_fingerprint(lats, lons)
+    if fingerprint in _trees:
+        return fingerprint, _trees[fingerprint]
+
+    index_path = os.path.join(GRID_INDEX_DIR, f"{fingerprint}.kdtree.pkl")
+    tree = None
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, "rb") as f:
+                tree = pickle.load(f)
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable grid index {index_path}: {e}")
+
+    if tree is None:
+        logging.info(f"Building grid index for {lats.shape} grid...")
+        tree = cKDTree(lat_lon_to_xyz(lats, lons))
+        os.makedirs(GRID_INDEX_DIR, exist_ok=True)
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, index_path)  # atomic, concurrent workers may build the same index
+
+    _trees[fingerprint] = tree
+    return fingerprint, tree
+
+
+def parse_interp(interp: str) -> tuple:
+    """Parses "nearest", "bilinear" or "idw-<k>" (inverse distance weighting of the k nearest cells) into (method, k)."""
+    if interp in ("nearest", "bilinear"):
+        return interp, 1 if interp == "nearest" else 4
+    method, _, k = interp.partition("-")
+    if method == "idw" and k.isdigit() and int(k) >= 1:
+        return method, int(k)
+    raise ValueError(f"Unknown interpolation '{interp}', expected nearest, bilinear or idw-<k>")
+
+
+def _bilinear_neighbors(lats: np.ndarray, lons: np.ndarray, point_xyz: np.ndarray, iy, ix) -> tuple:
+    """
+    Locates each point inside its grid quad and returns the quad's 4 flat cell indices and bilinear weights.
+    The grid is locally linear at the scale of one cell, so the point's fractional grid position is solved
+    from the grid steps around its nearest cell (least squares in 3-D, which also avoids longitude wrap).
+    """
+    ny, nx = lats.shape
+
+    def xyz_at(y, x):
+        return lat_lon_to_xyz(lats[y, x], lons[y, x])
+
+    x_next, x_prev = np.minimum(ix + 1, nx - 1), np.maximum(ix - 1, 0)
+    y_next, y_prev = np.minimum(iy + 1, ny - 1), np.maximum(iy - 1, 0)
+    step_x = (xyz_at(iy, x_next) - xyz_at(iy, x_prev)) / (x_next - x_prev)[:, None]
+    step_y = (xyz_at(y_next, ix) - xyz_at(y_prev, ix)) / (y_next - y_prev)[:, None]
+    offset = point_xyz - xyz_at(iy, ix)
+
+    # 2x2 normal equations of [step_x step_y] @ [dx, dy] = offset, solved for every point at once
+    xx, xy, yy = (step_x * step_x).sum(1), (step_x * step_y).sum(1), (step_y * step_y).sum(1)
+    xo, yo = (step_x * offset).sum(1), (step_y * offset).sum(1)
+    det = xx * yy - xy * xy
+    fx = np.clip(ix + (yy * xo - xy * yo) / det, 0, nx - 1)
+    fy = np.clip(iy + (xx * yo - xy * xo) / det, 0, ny - 1)
+
+    x0 = np.minimum(np.floor(fx).astype(np.int64), max(nx - 2, 0))
+    y0 = np.minimum(np.floor(fy).astype(np.int64), max(ny - 2, 0))
+    tx, ty = fx - x0, fy - y0
+    x1, y1 = np.minimum(x0 + 1, nx - 1), np.minimum(y0 + 1, ny - 1)
+    neighbors = np.column_stack((y0 * nx + x0, y0 * nx + x1, y1 * nx + x0, y1 * nx + x1))
+    weights = np.column_stack(((1 - ty) * (1 - tx), (1 - ty) * tx, ty * (1 - tx), ty * tx))
+    return neighbors, weights
+
+
+def compute_sampling(lats: np.ndarray, lons: np.ndarray, point_lats, point_lons, interp: str = "nearest") -> dict:
+    """
+    Computes, once per grid, point set and method, how every target point is sampled from the grid:
+        iy, ix: nearest grid cell of each point
+        neighbors: (n_points, k) flat indices of the grid cells each point is interpolated from
+        weights: (n_points, k) weights of those cells, summing to 1 per point
+    The result is memoized in-process, so every variable and forecast hour handled by a worker reuses it.
+    """
+    method, k = parse_interp(interp)
+    fingerprint, tree = load_or_build_grid_index(lats, lons)
+    point_lats = np.asarray(point_lats, dtype=np.float64)
+    point_lons = np.asarray(point_lons, dtype=np.float64)
+
+    lookup_key = (fingerprint, hashlib.sha1(point_lats.tobytes() + point_lons.tobytes()).hexdigest(), interp)
+    if lookup_key in _lookups:
+        return _lookups[lookup_key]
+
+    point_xyz = lat_lon_to_xyz(point_lats, point_lons)
+    distances, flat_index = tree.query(point_xyz, k=max(k if method == "idw" else 1, 1))
+    distances, flat_index = distances.reshape(len(point_xyz), -1), flat_index.reshape(len(point_xyz), -1)
+    iy, ix = np.unravel_index(flat_index[:, 0], lats.shape)
+
+    if method == "bilinear":
+        neighbors, weights = _bilinear_neighbors(lats, lons, point_xyz, iy, ix)
+    elif method == "idw":
+        neighbors = flat_index
+        with np.errstate(divide="ignore"):
+            weights = 1.0 / distances**2
+        exact = distances == 0
+        weights[exact.any(axis=1)] = exact[exact.any(axis=1)]  # a point on a grid cell takes its value
+        weights /= weights.sum(axis=1, keepdims=True)
+    else:
+        neighbors, weights = flat_index, np.ones_like(distances)
+
+    _lookups.clear()  # only the current point set is worth keeping
+    _lookups[lookup_key] = {"iy": iy, "ix": ix, "neighbors": neighbors, "weights": weights}
+    return _lookups[lookup_key]
+
+
+def sampling_matrix(sampling: dict, grid_shape: tuple) -> tuple:
+    """
+    Returns (window, matrix): the bounding window of every grid cell the points are sampled from, and a sparse
+    (n_points x window cells) matrix applying the sampling weights to a field cropped to that window, so all
+    points are interpolated with one matrix-vector product per field: values = matrix @ field[window].ravel().
+    Built once per point set and kept with the memoized sampling.
+    """
+    if "matrix" not in sampling:
+        n_points, k = sampling["neighbors"].shape
+        cell_iy, cell_ix = np.unravel_index(sampling["neighbors"].ravel(), grid_shape)
+        window = bounding_window(cell_iy, cell_ix)
+        window_height, window_width = window[0].stop - window[0].start, window[1].stop - window[1].start
+        columns = (cell_iy - window[0].start) * window_width + (cell_ix - window[1].start)
+        rows = np.repeat(np.arange(n_points), k)
+        matrix = sparse.csr_matrix(
+            (sampling["weights"].ravel(), (rows, columns)), shape=(n_points, window_height * window_width)
+        )
+        sampling["window"], sampling["matrix"] = window, matrix
+    return sampling["window"], sampling["matrix"]
+
+
+def unique_cells(sampling: dict, grid_shape: tuple) -> tuple:
+    """
+    (iy, ix) of the distinct nearest grid cells of the points, in order of first appearance. Points sharing a
+    cell get identical nearest-cell values, so each cell only has to be extracted once.
+    """
+    if "cells" not in sampling:
+        _, first = np.unique(np.ravel_multi_index((sampling["iy"], sampling["ix"]), grid_shape), return_index=True)
+        first.sort()
+        sampling["cells"] = sampling["iy"][first], sampling["ix"][first]
+    return sampling["cells"]
+
+
+def find_nearest_grid_points(lats: np.ndarray, lons: np.ndarray, point_lats, point_lons) -> tuple:
+    """Returns (iy, ix) arrays of the nearest grid cell for every target point, using one vectorized query."""
+    sampling = compute_sampling(lats, lons, point_lats, point_lons, "nearest")
+    return sampling["iy"], sampling["ix"]
+
+
+def bounding_window(iy: np.ndarray, ix: np.ndarray) -> tuple:
+    """(row slice, column slice) of the smallest grid window containing every (iy, ix) cell."""
+    return slice(int(iy.min()), int(iy.max()) + 1), slice(int(ix.min()), int(ix.max()) + 1)
@@ -1,37 +1,70 @@
 import argparse
 import logging
+import signal
 import sys
+import threading
+import time
+from contextlib import nullcontext
 from datetime import datetime
-import pandas as pd
 from tqdm import tqdm
-import boto3
-from botocore import UNSIGNED
-from botocore.client import Config
-from botocore.exceptions import ClientError
 
-from db_manager import get_db_connection, create_table_if_not_exists, insert_data
-from utils import read_points, get_grib_s3_uri
-from hrrr_processor import find_latest_complete_run_date, extract_data_from_grib
-from file_fetch import get_grib_file_path
-from config import ALL_VARIABLES, DEFAULT_NUM_HOURS, S3_BUCKET_URL, setup_logging
+from db_manager import get_db_connection, create_table_if_not_exists, cluster_forecasts, get_loaded_sources, StreamingWriter
+from utils import read_points, get_s3_client, points_digest, unique_points
+from hrrr_processor import find_latest_complete_run_date, map_task_points
+from pipeline import run_pipeline
+from scheduler import date_range, parse_cycles, plan_tasks
+from grid_index import parse_interp
+from watcher import watch
+from distributed import WorkLedger
+from metrics import Profiler, build_report, get_metrics, write_json_report, write_prometheus_textfile
+import parquet_sink
+from config import (
+    ALL_VARIABLES,
+    DEFAULT_DECODE_WORKERS,
+    DEFAULT_DOWNLOAD_WORKERS,
+    DEFAULT_FETCH_MODE,
+    DEFAULT_FLUSH_ROWS,
+    DEFAULT_INTERP,
+    DEFAULT_OUTPUT,
+    DEFAULT_NUM_HOURS,
+    DEFAULT_POLL_INTERVAL,
+    DEFAULT_S3_CONNECTIONS,
+    DEFAULT_STORAGE_SCHEMA,
+    DB_FILE,
+    STORAGE_SCHEMAS,
+    FETCH_MODES,
+    GRIB_VARIABLES,
+    RUN_HOUR,
+    setup_logging,
+)
 
 
 setup_logging()
 
 
-def main():
+def parse_args():
     parser = argparse.ArgumentParser(description="Ingest HRRR forecast data into DuckDB.")
 
-    parser.add_argument("points_file", help="The path to the input data file (e.g., points.txt).")
+    parser.add_argument("points_file", help="The path to the points file: headerless latitude,longitude lines (e.g., points.txt), or a CSV/Parquet file with latitude, longitude and optional point_id columns.")
     parser.add_argument(
         "--run-date",
         help="The forecast run date of the data to ingest. Defaults to the last available date with complete data.",
         default=None,  # Will be determined later if None
     )
+    parser.add_argument(
+        "--end-date",
+        help="Last run date to ingest (YYYY-MM-DD), for backfilling every date from --run-date to --end-date. Defaults to --run-date.",
+        default=None,
+    )
+    parser.add_argument(
+        "--cycles",
+        help=f"Comma separated cycle hours (0-23) to ingest for each run date, or 'all' for every hourly run. Cycles other than 00/06/12/18z only forecast up to 18 hours. Defaults to {RUN_HOUR}.",
+        default=str(RUN_HOUR),
+    )
     parser.add_argument(
         "--variables",
-        help=f"A comma separated list of variables to ingest. The variables should be passed using the human-readable names listed above. Defaults to all supported variables. Available: {', '.join(ALL_VARIABLES)}",
-        default=",".join(ALL_VARIABLES),
+        help=f"A comma separated list of variables to ingest. The variables should be passed using the human-readable names listed above. Defaults to all variables read from the GRIB files; derived variables are only ingested when listed. Available: {', '.join(ALL_VARIABLES)}",
+        default=",".join(GRIB_VARIABLES),
     )
     parser.add_argument(
         "--num-hours",
@@ -39,11 +72,131 @@ def main():
         default=DEFAULT_NUM_HOURS,
         help=f"Number of hours of forecast data to ingest (0 to 48). Defaults to {DEFAULT_NUM_HOURS}. This will be useful for testing so that you can work with smaller amounts of data.",
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--fetch-mode",
+        choices=FETCH_MODES,
+        default=DEFAULT_FETCH_MODE,
+        help=f"'full' downloads the whole GRIB file per forecast hour. 'partial' uses the .idx inventory to download only the messages for the requested variables with ranged GETs. Defaults to {DEFAULT_FETCH_MODE}.",
+    )
+    parser.add_argument(
+        "--interp",
+        default=DEFAULT_INTERP,
+        help=f"How values are sampled at each point: 'nearest' grid cell, 'bilinear' over the enclosing grid cell quad, or 'idw-<k>' inverse distance weighting of the k nearest cells (e.g. idw-4). Interpolated rows carry the point's own coordinates. Defaults to {DEFAULT_INTERP}.",
+    )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        default=DEFAULT_DOWNLOAD_WORKERS,
+        help=f"Number of threads downloading GRIB files. Defaults to {DEFAULT_DOWNLOAD_WORKERS}.",
+    )
+    parser.add_argument(
+        "--decode-workers",
+        type=int,
+        default=DEFAULT_DECODE_WORKERS,
+        help=f"Number of processes decoding GRIB files. Defaults to {DEFAULT_DECODE_WORKERS}.",
+    )
+    parser.add_argument(
+        "--s3-connections",
+        type=int,
+        default=DEFAULT_S3_CONNECTIONS,
+        help=f"Maximum concurrent S3 connections, shared by run-date discovery and downloads. Defaults to {DEFAULT_S3_CONNECTIONS}.",
+    )
+    parser.add_argument(
+        "--max-pending-files",
+        type=int,
+        default=None,
+        help="Maximum number of downloaded files waiting to be decoded, to bound disk use. Defaults to download + decode workers.",
+    )
+    parser.add_argument(
+        "--flush-rows",
+        type=int,
+        default=DEFAULT_FLUSH_ROWS,
+        help="Commit to the database once at least this many rows are buffered. 0 commits every forecast hour as soon as it is extracted.",
+    )
+    parser.add_argument(
+        "--bulk-load",
+        action="store_true",
+        help="Load rows into DuckDB as Arrow record batches, skipping the temp table copy and sources already in the load ledger.",
+    )
+    parser.add_argument(
+        "--schema",
+        choices=STORAGE_SCHEMAS,
+        default=DEFAULT_STORAGE_SCHEMA,
+        help=f"'wide' stores one row per value with all columns. 'compact' stores small-integer keys into points/variables/sources tables and exposes the same hrrr_forecasts view. Defaults to {DEFAULT_STORAGE_SCHEMA}.",
+    )
+    parser.add_argument(
+        "--output",
+        default=DEFAULT_OUTPUT,
+        help=f"Where to write the data: 'duckdb' inserts into {DB_FILE}; 'parquet://<dir>' writes one Parquet (GeoParquet) file per forecast hour and variable under <dir>, partitioned by run_date/cycle/variable, without opening the database. Defaults to {DEFAULT_OUTPUT}.",
+    )
+    parser.add_argument(
+        "--cluster",
+        action="store_true",
+        help="After ingesting, rewrite the stored rows sorted by variable, location and time, so time series queries (forecast_query.py) read only a few row groups. Rewrites the whole table.",
+    )
+    parser.add_argument(
+        "--enqueue",
+        default=None,
+        metavar="LEDGER",
+        help="Instead of ingesting, add the planned forecast hours to this SQLite work ledger, for workers on any number of hosts to process (python distributed.py work) and merge into the database afterwards (python distributed.py merge).",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Run until interrupted, ingesting each forecast hour of the newest runs of --cycles as soon as it is published on S3.",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help=f"Seconds between S3 polls in --watch mode. Defaults to {DEFAULT_POLL_INTERVAL}.",
+    )
+    parser.add_argument(
+        "--metrics-report",
+        default=None,
+        help="Write a JSON run report to this path: counters (requests, retries, cache hits, bytes, rows inserted and skipped), per-stage timings, throughput and peak memory.",
+    )
+    parser.add_argument(
+        "--prometheus-textfile",
+        default=None,
+        help="Write the run report in the Prometheus text format to this path, for node_exporter's textfile collector.",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        help="Profile the main process and write the result to this path: an .html path uses pyinstrument (if installed), anything else a cProfile dump.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    started_at = time.time()
+    try:
+        profiler = Profiler(args.profile) if args.profile else nullcontext()
+    except ImportError as e:
+        logging.error(f"Cannot profile to {args.profile}: {e}")
+        sys.exit(1)
+    with profiler:
+        summary = ingest(args)
+
+    if args.metrics_report or args.prometheus_textfile:
+        report = build_report(get_metrics(), started_at, summary)
+        if args.metrics_report:
+            write_json_report(report, args.metrics_report)
+            logging.info(f"Wrote the metrics report to {args.metrics_report}.")
+        if args.prometheus_textfile:
+            write_prometheus_textfile(report, args.prometheus_textfile)
+    if summary.get("write_error"):
+        sys.exit(1)
+
+
+def ingest(args) -> dict:
+    """Runs the ingestion described by the command line arguments. Returns a summary for the run report."""
 
     # --- Input Validation ---
     try:
-        target_points = read_points(args.points_file)
+        points = read_points(args.points_file)
     except Exception as e:
         logging.error(f"Error reading points file: {e}")
         sys.exit(1)
@@ -61,8 +214,50 @@ def main():
         )
         args.num_hours = DEFAULT_NUM_HOURS
 
+    try:
+        cycles = parse_cycles(args.cycles)
+    except ValueError as e:
+        logging.error(f"Invalid --cycles: {e}")
+        sys.exit(1)
+
+    try:
+        parse_interp(args.interp)
+    except ValueError as e:
+        logging.error(f"Invalid --interp: {e}")
+        sys.exit(1)
+    if args.interp != "nearest" and args.schema == "compact":
+        logging.error("--schema compact stores values per grid cell and only supports --interp nearest.")
+        sys.exit(1)
+
+    try:
+        parquet_dir = parquet_sink.parse_output(args.output)
+    except ValueError as e:
+        logging.error(f"Invalid --output: {e}")
+        sys.exit(1)
+
+    if args.cluster and (parquet_dir or args.watch):
+        logging.error("--cluster rewrites the DuckDB table after a run and cannot be combined with --watch or Parquet output.")
+        sys.exit(1)
+
+    if args.enqueue and (parquet_dir or args.watch or args.cluster):
+        logging.error("--enqueue plans a job for distributed.py workers and cannot be combined with --watch, --cluster or Parquet output.")
+        sys.exit(1)
+
+    if args.watch and (args.run_date or args.end_date):
+        logging.error("--watch follows the newest runs and cannot be combined with --run-date or --end-date.")
+        sys.exit(1)
+
+    if args.download_workers < 1 or args.decode_workers < 1 or args.s3_connections < 1:
+        logging.error("--download-workers, --decode-workers and --s3-connections must be at least 1.")
+        sys.exit(1)
+
+    # One pooled S3 client for the whole run
+    s3_client = get_s3_client(args.s3_connections)
+
     run_date = None
-    if args.run_date:
+    if args.watch:
+        logging.info(f"Watching for new forecast hours every {args.poll_interval:g} seconds.")
+    elif args.run_date:
         try:
             run_date = datetime.strptime(args.run_date, "%Y-%m-%d").date()
         except ValueError:
@@ -70,59 +265,174 @@ def main():
             sys.exit(1)
     else:
         try:
-            # Find the latest date with complete data up to the requested num_hours
-            run_date = find_latest_complete_run_date(max_hours=args.num_hours)
+            # Find the latest date with complete data for every cycle up to the requested num_hours
+            run_date = find_latest_complete_run_date(max_hours=args.num_hours, s3_client=s3_client, cycles=cycles)
         except Exception as e:
             logging.error(f"Failed to determine latest run date: {e}")
             sys.exit(1)
 
-    logging.info(f"Target run date: {run_date.strftime('%Y-%m-%d')}")
+    end_date = run_date
+    if args.end_date:
+        try:
+            end_date = datetime.strptime(args.end_date, "%Y-%m-%d").date()
+        except ValueError:
+            logging.error("Invalid date format for --end-date. Please use YYYY-MM-DD.")
+            sys.exit(1)
+        if end_date < run_date:
+            logging.error("--end-date must not be before the run date.")
+            sys.exit(1)
+
+    if run_date:
+        logging.info(f"Target run dates: {run_date:%Y-%m-%d} to {end_date:%Y-%m-%d}")
+    logging.info(f"Cycles: {', '.join(f'{cycle:02}z' for cycle in cycles)}")
     logging.info(f"Variables to ingest: {', '.join(variables_to_ingest)}")
     logging.info(f"Number of forecast hours: {args.num_hours}")
-    logging.info(f"Number of points: {len(target_points)}")
+    # Identical points are extracted once; workers further collapse points sharing a grid cell
+    extract_points = unique_points(points.lats, points.lons)
+    logging.info(f"Number of points: {len(points.lats)} ({len(extract_points[0])} unique)")
+    logging.info(f"Interpolation: {args.interp}")
 
-    # --- Database Setup ---
-    try:
-        con = get_db_connection()
-        create_table_if_not_exists(con)
-    except Exception as e:
-        logging.error(f"Database connection or setup failed: {e}")
-        sys.exit(1)
+    digest = points_digest(points.lats, points.lons, interp=args.interp, ids=points.ids)
+    summary = {
+        "points": len(points.lats),
+        "unique_points": len(extract_points[0]),
+        "variables": variables_to_ingest,
+        "fetch_mode": args.fetch_mode,
+        "interp": args.interp,
+        "output": args.output,
+    }
 
-    # --- Ingestion Loop ---
-    all_inserted_data = []
-    logging.info("Starting ingestion...")
+    # --- Output Setup: the Parquet sink needs no database, so concurrent runs never contend for its lock ---
+    con = None
+    if parquet_dir:
+        loaded_sources = parquet_sink.get_loaded_sources(parquet_dir, digest)
+        writer = parquet_sink.ParquetWriter(parquet_dir, digest, variables_to_ingest)
+    else:
+        try:
+            con = get_db_connection()
+            create_table_if_not_exists(con, args.schema, bulk=args.bulk_load)
+            writer = StreamingWriter(
+                con,
+                digest,
+                flush_rows=args.flush_rows,
+                bulk=args.bulk_load,
+                schema=args.schema,
+                variables=variables_to_ingest,
+                interp=args.interp,
+            )
+        except Exception as e:
+            logging.error(f"Database connection or setup failed: {e}")
+            sys.exit(1)
+        loaded_sources = get_loaded_sources(con, digest)
 
-    # TODO: parellelize
-    s3_client = boto3.client("s3", config=Config(signature_version=UNSIGNED))
-    for idx, forecast_hour in enumerate(range(args.num_hours + 1)):
-        print(f"\rProcessing forecast hours: {idx}/{args.num_hours}", flush=True)
-        grib_file_path = get_grib_file_path(s3_client, S3_BUCKET_URL, run_date, forecast_hour)
-        new_data_df = extract_data_from_grib(
-            grib_file=grib_file_path,
-            source_s3=get_grib_s3_uri(run_date, forecast_hour),
-            target_points=target_points,
-            variables_to_ingest=variables_to_ingest,
-        )
+    # --- Watch mode: keep the S3 client, DB connection and pools warm and ingest hours as they land ---
+    if args.watch:
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        try:
+            watch(
+                s3_client,
+                writer,
+                extract_points,
+                variables_to_ingest,
+                cycles,
+                args.num_hours,
+                loaded_sources,
+                fetch_mode=args.fetch_mode,
+                download_workers=args.download_workers,
+                decode_workers=args.decode_workers,
+                max_pending_files=args.max_pending_files,
+                interp=args.interp,
+                poll_interval=args.poll_interval,
+                stop=stop,
+                input_points=points,
+            )
+        except KeyboardInterrupt:
+            logging.info("Interrupted, stopping watch mode.")
+        writer.close()
+        logging.info(f"Wrote {writer.written_rows} records while watching.")
+        s3_client.close()
+        if con:
+            con.close()
+        return {**summary, "written_rows": writer.written_rows}
 
-        if not new_data_df.empty:
-            all_inserted_data.append(new_data_df)
+    # --- Schedule: run dates x cycles x forecast hours, skipping files already committed for these points ---
+    run_dates = date_range(run_date, end_date)
+    tasks = plan_tasks(
+        run_dates, cycles, args.num_hours, variables_to_ingest, loaded_sources, fetch_mode=args.fetch_mode
+    )
 
-    # --- Batch Insert ---
-    if all_inserted_data:
-        all_inserted_data = pd.concat(all_inserted_data, ignore_index=True)
-        logging.info(f"Attempting to insert {len(all_inserted_data)} new records into the database...")
+    # --- Distributed mode: hand the plan to the work ledger instead of running it here ---
+    if args.enqueue:
+        ledger = WorkLedger(args.enqueue)
         try:
-            insert_data(con, all_inserted_data)
-            logging.info("Batch insertion completed.")
-        except Exception as e:
-            logging.error(f"Error during batch database insertion: {e}")
+            ledger.create_job(
+                {
+                    "points_digest": digest,
+                    "variables": variables_to_ingest,
+                    "fetch_mode": args.fetch_mode,
+                    "interp": args.interp,
+                    "schema": args.schema,
+                }
+            )
+        except ValueError as e:
+            logging.error(e)
+            sys.exit(1)
+        added = ledger.add_tasks(tasks)
+        logging.info(f"Enqueued {added} forecast hours in {args.enqueue} ({len(tasks) - added} already there).")
+        ledger.close()
+        s3_client.close()
+        con.close()
+        return {**summary, "tasks": len(tasks), "enqueued": added}
+
+    # --- Ingestion Loop: each file is committed as soon as it is extracted ---
+    logging.info("Starting ingestion...")
+
+    results = run_pipeline(
+        s3_client,
+        tasks,
+        extract_points,
+        variables_to_ingest,
+        fetch_mode=args.fetch_mode,
+        download_workers=args.download_workers,
+        decode_workers=args.decode_workers,
+        max_pending_files=args.max_pending_files,
+        interp=args.interp,
+    )
+    write_error = None
+    try:
+        for idx, (task, new_data_df) in enumerate(results, start=1):
+            print(f"\rProcessed {task} ({idx}/{len(tasks)})", flush=True)
+            if not writer.point_map_saved and not new_data_df.empty:
+                # The map is committed with the first rows, so no run can record sources without it
+                map_df = map_task_points(task, args.fetch_mode, variables_to_ingest, points, args.interp, s3_client)
+                if map_df.empty:
+                    logging.error(f"Skipping {task}: could not map the points to its grid.")
+                    continue
+                writer.save_point_map(map_df)
+            writer.add(new_data_df)
+        writer.close()
+    except Exception as e:
+        write_error = str(e)
+        logging.error(f"Error during database insertion: {e}")
+    finally:
+        results.close()  # shuts down the pools and unpins the hours not consumed if the loop stopped early
+
+    if con and args.cluster:
+        logging.info("Clustering the stored rows by variable, location and time...")
+        cluster_forecasts(con)
+
+    if writer.written_rows:
+        logging.info(f"Wrote {writer.written_rows} new records.")
     else:
         logging.info("No new data found to insert.")
 
     # --- Cleanup ---
-    con.close()
+    s3_client.close()
+    if con:
+        con.close()
     logging.info("Ingestion process finished.")
+    return {**summary, "tasks": len(tasks), "written_rows": writer.written_rows, "write_error": write_error}
 
 
 if __name__ == "__main__":
@@ -1,111 +1,286 @@
 import logging
-import boto3
-from botocore import UNSIGNED
-from botocore.client import Config
-from botocore.exceptions import ClientError
 from datetime import date, datetime, timezone, timedelta
 
-import xarray as xr
 import pandas as pd
 import numpy as np
 
-from config import S3_BUCKET_URL, RUN_HOUR, VARIABLE_MAP, setup_logging
-from utils import get_grib_s3_key, timeit
+from config import DEFAULT_INTERP, S3_BUCKET_URL, RUN_DATE_LOOKBACK_DAYS, RUN_HOUR, VARIABLE_MAP, setup_logging
+from cache_manager import get_cache_manager
+from file_fetch import get_cache_path, get_grib_file_path
+from derived import derive_variables, source_variables
+from grib_reader import decode_fields, read_grib_header
+from metrics import get_metrics
+from grid_index import bounding_window, compute_sampling, sampling_matrix, unique_cells
+from scheduler import max_forecast_hour
+from utils import Points, get_grib_s3_key, get_s3_client, timeit
 
 setup_logging()
 
 
-def find_latest_complete_run_date(max_hours: int = 48) -> date:
-    """Finds the most recent date with a complete 06z run (up to max_hours)."""
+def find_latest_complete_run_date(max_hours: int = 48, s3_client=None, cycles: list = None) -> date:
+    """
+    Finds the most recent date on which every cycle in `cycles` (default: the 06z run) is complete, i.e. has
+    every forecast hour up to max_hours, or up to the last hour the cycle publishes (see scheduler).
+    All candidate dates, cycles and forecast hours are probed concurrently in one burst of HEAD requests.
+    """
+    cycles = cycles or [RUN_HOUR]
     logging.info(f"Searching for the latest complete run date (up to {max_hours} hours)...")
-    s3_client = boto3.client("s3", config=Config(signature_version=UNSIGNED))
+    s3_client = s3_client or get_s3_client()
     today = datetime.now(timezone.utc).date()
-    for i in range(10):  # Check last 10 days
-        check_date = today - timedelta(days=i)
-        key = get_grib_s3_key(check_date, max_hours)
+    check_dates = [today - timedelta(days=i) for i in range(RUN_DATE_LOOKBACK_DAYS)]
+
+    def run_keys(check_date):
+        return [
+            get_grib_s3_key(check_date, hour, run_hour=cycle)
+            for cycle in cycles
+            for hour in range(min(max_hours, max_forecast_hour(cycle)) + 1)
+        ]
 
-        try:
-            s3_client.head_object(Bucket=S3_BUCKET_URL, Key=key)
+    keys = [key for check_date in check_dates for key in run_keys(check_date)]
+
+    try:
+        found = dict(zip(keys, s3_client.exists_many(S3_BUCKET_URL, keys)))
+    except Exception as e:
+        logging.error(f"Unexpected error when accessing S3: {e}")
+        raise
+
+    for check_date in check_dates:
+        if all(found[key] for key in run_keys(check_date)):
             logging.info(f"Found latest complete run date: {check_date.strftime('%Y-%m-%d')}")
             return check_date
-        except ClientError as e:
-            if e.response["Error"]["Code"] == "404":
-                logging.debug(f"Run date {check_date.strftime('%Y-%m-%d')} is incomplete or not available.")
-            else:
-                logging.error(f"Unexpected error when accessing S3: {e}")
-                raise
+        logging.debug(f"Run date {check_date.strftime('%Y-%m-%d')} is incomplete or not available.")
 
     logging.error("Could not find a recent complete run date.")
     raise ValueError("Could not determine the latest available complete run date.")
 
 
+def sample_fields(fields: dict, iy: np.ndarray, ix: np.ndarray, origin: tuple = (0, 0)) -> dict:
+    """Values of each field at grid cells (iy, ix) of the full grid; fields cropped to a window start at `origin`."""
+    field_iy, field_ix = iy - origin[0], ix - origin[1]
+    return {var_name: field[field_iy, field_ix] for var_name, field in fields.items()}
+
+
+def interpolate_fields(fields: dict, matrix) -> dict:
+    """Values of each windowed field at the target points, one sparse matrix-vector product per field."""
+    return {var_name: matrix @ field.ravel() for var_name, field in fields.items()}
+
+
+def build_rows(
+    sampled: dict,  # {variable name: 1-D array with one value per point}
+    grid_iy: np.ndarray,
+    grid_ix: np.ndarray,
+    row_lats: np.ndarray,
+    row_lons: np.ndarray,
+    run_time_utc: pd.Timestamp,
+    valid_time_utc: pd.Timestamp,
+    source_s3: str,
+) -> pd.DataFrame:
+    """
+    Builds the output rows as NumPy columns, one block of len(grid_iy) rows per variable.
+    Values are stored as float32, and the variable and source_s3 columns are categorical so each string is
+    stored once. grid_iy/grid_ix identify the (nearest) grid cell of each row.
+    """
+    var_names = list(sampled)
+    n_points = len(grid_iy)
+
+    values = np.empty(len(var_names) * n_points, dtype=np.float32)
+    for i, var_name in enumerate(var_names):
+        values[i * n_points : (i + 1) * n_points] = sampled[var_name]
+
+    variable_codes = np.repeat(np.arange(len(var_names), dtype=np.int16), n_points)
+    return pd.DataFrame(
+        {
+            "valid_time_utc": valid_time_utc,
+            "run_time_utc": run_time_utc,
+            "latitude": np.tile(np.asarray(row_lats, dtype=np.float32), len(var_names)),
+            "longitude": np.tile(np.asarray(row_lons, dtype=np.float32), len(var_names)),
+            "variable": pd.Categorical.from_codes(variable_codes, categories=var_names),
+            "value": values,
+            "source_s3": pd.Categorical.from_codes(np.zeros(len(values), dtype=np.int8), categories=[source_s3]),
+            "grid_iy": np.tile(np.asarray(grid_iy, dtype=np.int16), len(var_names)),
+            "grid_ix": np.tile(np.asarray(grid_ix, dtype=np.int16), len(var_names)),
+        }
+    )
+
+
+def assemble_rows(
+    fields: dict,  # {variable name: 2-D array}, the full grid or a window of it starting at `origin`
+    iy: np.ndarray,
+    ix: np.ndarray,
+    lats: np.ndarray,
+    lons: np.ndarray,
+    run_time_utc: pd.Timestamp,
+    valid_time_utc: pd.Timestamp,
+    source_s3: str,
+    origin: tuple = (0, 0),
+) -> pd.DataFrame:
+    """
+    Builds the nearest-cell output rows: values are gathered with fancy indexing at grid cells (iy, ix),
+    and the latitude/longitude columns hold the coordinates of those cells. `iy`/`ix` index the full grid,
+    as do `lats`/`lons`; fields cropped to a window are offset by `origin`.
+    """
+    return build_rows(
+        sample_fields(fields, iy, ix, origin),
+        iy,
+        ix,
+        lats[iy, ix],
+        lons[iy, ix],
+        run_time_utc,
+        valid_time_utc,
+        source_s3,
+    )
+
+
 @timeit()
 def extract_data_from_grib(
     grib_file: str,
     source_s3: str,
-    target_points: list,  # [{"latitude": float, "longitude": float}]
+    point_lats: np.ndarray,  # float64 latitudes of the points to extract
+    point_lons: np.ndarray,
     variables_to_ingest: list,  # list of human-readable names like "surface_pressure", relative_humidity_2m, etc.
+    interp: str = DEFAULT_INTERP,  # "nearest", "bilinear" or "idw-<k>", see grid_index.parse_interp
+) -> pd.DataFrame:
+    """
+    Opens a GRIB2 file once and extracts specified variables for target points.
+    Returns a DataFrame with one row per (point, variable) for the database.
+
+    "nearest" takes the value of each point's nearest grid cell and reports that cell's coordinates.
+    The other methods weight several cells per point and report the target point's own coordinates.
+    """
+    unknown_vars = [v for v in variables_to_ingest if v not in VARIABLE_MAP]
+    for var_name in unknown_vars:
+        logging.warning(f"Variable '{var_name}' is not defined in the VARIABLE_MAP.")
+
+    # Scan the file once (or read its persisted message index) without decoding any values yet
+    try:
+        sources = source_variables([v for v in variables_to_ingest if v in VARIABLE_MAP])
+        grib = read_grib_header(grib_file, sources)
+    except Exception as e:
+        logging.error(f"Error reading GRIB file {grib_file}: {e}")
+        return pd.DataFrame()
+
+    lats, lons = grib["latitude"], grib["longitude"]
+    if lats is None:
+        return pd.DataFrame()
+
+    # Grid cells and weights for all points from one KD-tree query, shared by every variable and memoized
+    with get_metrics().timer("extract.sampling"):
+        sampling = compute_sampling(lats, lons, point_lats, point_lons, interp)
+    nearest_iy, nearest_ix = sampling["iy"], sampling["ix"]
+
+    # Keep only the window of the grid around the points, so memory scales with the region, not CONUS
+    if interp == "nearest":
+        nearest_iy, nearest_ix = unique_cells(sampling, lats.shape)  # points sharing a cell are extracted once
+        window, matrix = bounding_window(nearest_iy, nearest_ix), None
+    else:
+        window, matrix = sampling_matrix(sampling, lats.shape)
+    try:
+        fields = decode_fields(grib_file, grib["messages"], window)
+    except Exception as e:
+        logging.error(f"Error decoding GRIB file {grib_file}: {e}")
+        return pd.DataFrame()
+
+    if matrix is not None:
+        sampled = interpolate_fields(fields, matrix)
+        row_lats = point_lats
+        row_lons = np.mod(point_lons, 360.0)  # same 0-360 convention as the grid longitudes of nearest rows
+    else:
+        sampled = sample_fields(fields, nearest_iy, nearest_ix, origin=(window[0].start, window[1].start))
+        row_lats, row_lons = lats[nearest_iy, nearest_ix], lons[nearest_iy, nearest_ix]
+
+    # Derived variables are evaluated on the values at the points, before any rows are built
+    sampled = derive_variables(sampled, variables_to_ingest, row_lats, row_lons)
+    with get_metrics().timer("extract.build_rows"):
+        data_df = build_rows(
+            sampled,
+            nearest_iy,
+            nearest_ix,
+            row_lats,
+            row_lons,
+            grib["run_time_utc"],
+            grib["valid_time_utc"],
+            source_s3,
+        )
+    get_metrics().count("extract.files")
+    get_metrics().count("extract.rows", len(data_df))
+    return data_df
+
+
+def map_points(
+    grib_file: str,
+    variables: list,
+    point_lats: np.ndarray,
+    point_lons: np.ndarray,
+    interp: str = DEFAULT_INTERP,
+    point_ids=None,  # defaults to the position of each point in the input
 ) -> pd.DataFrame:
     """
-    Opens a GRIB2 file and extracts specified variables for target points.
-    Returns a list of dictionaries, each representing a row for the database.
+    Maps every input point to the coordinates its rows are stored under in hrrr_forecasts: the nearest grid
+    cell for "nearest" (points are collapsed to unique cells before extraction), the point itself otherwise.
+    Only reads the GRIB file's message index and grid coordinates, no data values.
     """
+    if point_ids is None:
+        point_ids = np.arange(len(point_lats))
+    grib = read_grib_header(grib_file, source_variables([v for v in variables if v in VARIABLE_MAP]))
+    lats, lons = grib["latitude"], grib["longitude"]
+    if lats is None:
+        return pd.DataFrame()
 
-    def find_nearest_point(ds, lat, lon):
-        lon = lon if lon >= 0 else lon + 360  # wrap -180 - 180 to 0 - 360
-        lats = ds.latitude.values
-        lons = ds.longitude.values
-        distance_sq = (lats - lat) ** 2 + (lons - lon) ** 2
-        iy, ix = np.unravel_index(np.argmin(distance_sq), distance_sq.shape)
-        return iy, ix
-
-    extracted_data = []
-
-    # Loop through the variables to be extracted and prepare the filter for each
-    for var_name in variables_to_ingest:
-        if var_name not in VARIABLE_MAP:
-            logging.warning(f"Variable '{var_name}' is not defined in the VARIABLE_MAP.")
-            continue
-
-        filter_keys = VARIABLE_MAP[var_name]
-
-        try:
-            var_ds = xr.open_dataset(
-                grib_file,
-                engine="cfgrib",
-                backend_kwargs={
-                    "filter_by_keys": filter_keys,
-                    "decode_timedelta": False,  # ToFutureWarning: In a future version of xarray decode_timedelta will default to False rather than None. To silence this warning, set decode_timedelta to True, False, or a 'CFTimedeltaCoder' instance.
-                },
+    sampling = compute_sampling(lats, lons, point_lats, point_lons, interp)
+    iy, ix = sampling["iy"], sampling["ix"]
+    if interp == "nearest":
+        forecast_lats, forecast_lons = lats[iy, ix], lons[iy, ix]
+    else:
+        forecast_lats, forecast_lons = point_lats, np.mod(point_lons, 360.0)
+    map_df = pd.DataFrame(
+        {
+            "point_id": pd.Series(point_ids, dtype=str),
+            "latitude": point_lats,
+            "longitude": point_lons,
+            "grid_iy": np.asarray(iy, dtype=np.int16),
+            "grid_ix": np.asarray(ix, dtype=np.int16),
+            "forecast_latitude": np.asarray(forecast_lats, dtype=np.float32),
+            "forecast_longitude": np.asarray(forecast_lons, dtype=np.float32),
+        }
+    )
+    if interp != "nearest":
+        # Rows are keyed by float32 coordinates, so distinct points closer than their precision share one row
+        distinct = map_df.drop_duplicates(["latitude", "longitude"])
+        collapsed = distinct[distinct.duplicated(["forecast_latitude", "forecast_longitude"])]
+        if not collapsed.empty:
+            logging.warning(
+                f"{len(collapsed)} points round to the stored coordinates of another point (e.g. point_id "
+                f"{collapsed['point_id'].iloc[0]}) and share its {interp} rows instead of getting their own."
+            )
+    return map_df
+
+
+def map_task_points(
+    task, fetch_mode: str, variables: list, points: Points, interp: str = DEFAULT_INTERP, s3_client=None
+):
+    """
+    map_points on the cached GRIB file of an ingested scheduler.IngestTask. With `s3_client`, a file evicted from
+    the cache since it was decoded is fetched again (and pinned while it is read). Empty if the file is unreadable.
+    """
+    grib_file = get_cache_path(task.run_date, task.forecast_hour, fetch_mode, variables, task.run_hour)
+    pinned = False
+    try:
+        if s3_client is not None:
+            grib_file = get_grib_file_path(
+                s3_client,
+                S3_BUCKET_URL,
+                task.run_date,
+                task.forecast_hour,
+                fetch_mode,
+                variables,
+                pin=True,
+                run_hour=task.run_hour,
             )
-            data_var_name = list(var_ds.data_vars)[0]
-            data_array = var_ds[data_var_name].values
-            run_time_utc = pd.to_datetime(var_ds.time.values.item()).tz_localize("UTC")
-            valid_time_utc = pd.to_datetime(var_ds.valid_time.values.item()).tz_localize("UTC")
-
-            for point in target_points:
-                lat, lon = point["latitude"], point["longitude"]
-
-                try:
-                    iy, ix = find_nearest_point(var_ds, lat, lon)
-                    value = data_array[iy, ix]
-
-                    extracted_data.append(
-                        {
-                            "valid_time_utc": valid_time_utc,
-                            "run_time_utc": run_time_utc,
-                            "latitude": var_ds.latitude.values[iy, ix],
-                            "longitude": var_ds.longitude.values[iy, ix],
-                            "variable": var_name,
-                            "value": float(value),
-                            "source_s3": source_s3,
-                        }
-                    )
-                except Exception as e:
-                    logging.error(f"Failed to extract value at ({lat}, {lon}) for {var_name}: {e}")
-
-        except Exception as e:
-            logging.error(f"Error opening GRIB file for {var_name}: {e}")
-            continue
-
-    return pd.DataFrame(extracted_data)
+            pinned = True
+        return map_points(grib_file, variables, points.lats, points.lons, interp, points.point_ids)
+    except Exception as e:
+        logging.warning(f"Could not map points to grid cells with {grib_file}: {e}")
+        return pd.DataFrame()
+    finally:
+        if pinned:
+            get_cache_manager().unpin(grib_file)
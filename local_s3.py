@@ -0,0 +1,129 @@
+"""
+A minimal local S3 stand-in that serves a directory of fixture files over HTTP.
+
+Only the requests this tool makes are supported: HEAD and GET on path-style URLs
+(http://host:port/<bucket>/<key>), including single ranged GETs. Keys are resolved relative to the
+served directory, the bucket name is ignored.
+
+Usage:
+    python local_s3.py <fixture_dir> --port 9000
+    HRRR_S3_ENDPOINT_URL=http://127.0.0.1:9000 python hrrr_ingest.py points.txt --run-date 2025-01-01
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import re
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+RANGE_PATTERN = re.compile(r"bytes=(\d+)-(\d*)")
+
+
+def _file_etag(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return f'"{md5.hexdigest()}"'
+
+
+class LocalS3Handler(BaseHTTPRequestHandler):
+    root_dir = "."
+    etags = {}
+
+    def log_message(self, format, *args):
+        logging.debug(f"[local_s3] {format % args}")
+
+    def _resolve(self):
+        path = unquote(urlparse(self.path).path).lstrip("/")
+        _, _, key = path.partition("/")  # drop the bucket
+        local_path = os.path.realpath(os.path.join(self.root_dir, key))
+        if not local_path.startswith(os.path.realpath(self.root_dir)) or not os.path.isfile(local_path):
+            return None
+        return local_path
+
+    def _etag(self, local_path: str) -> str:
+        stat = os.stat(local_path)
+        cache_key = (local_path, stat.st_size, stat.st_mtime_ns)
+        if cache_key not in self.etags:
+            self.etags[cache_key] = _file_etag(local_path)
+        return self.etags[cache_key]
+
+    def _not_found(self, with_body: bool):
+        body = b"<?xml version='1.0' encoding='UTF-8'?><Error><Code>NoSuchKey</Code><Message>Not Found</Message></Error>"
+        self.send_response(404)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body) if with_body else 0))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def _send_headers(self, local_path: str, status: int, length: int, content_range: str = None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", self._etag(local_path))
+        self.send_header("Last-Modified", formatdate(os.path.getmtime(local_path), usegmt=True))
+        if content_range:
+            self.send_header("Content-Range", content_range)
+        self.end_headers()
+
+    def do_HEAD(self):
+        local_path = self._resolve()
+        if local_path is None:
+            return self._not_found(with_body=False)
+        self._send_headers(local_path, 200, os.path.getsize(local_path))
+
+    def do_GET(self):
+        local_path = self._resolve()
+        if local_path is None:
+            return self._not_found(with_body=True)
+
+        size = os.path.getsize(local_path)
+        start, end, status, content_range = 0, size - 1, 200, None
+        match = RANGE_PATTERN.fullmatch(self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            status, content_range = 206, f"bytes {start}-{end}/{size}"
+
+        self._send_headers(local_path, status, end - start + 1, content_range)
+        with open(local_path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+class LocalS3Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # the default backlog of 5 drops connections from a pooled concurrent client
+
+
+def start_local_s3(root_dir: str, host: str = "127.0.0.1", port: int = 0):
+    """Starts the stand-in on a background thread. Returns (server, endpoint_url); call server.shutdown() to stop."""
+    handler = type("BoundLocalS3Handler", (LocalS3Handler,), {"root_dir": root_dir, "etags": {}})
+    server = LocalS3Server((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a directory of fixture files as a local S3 stand-in.")
+    parser.add_argument("root_dir", help="Directory laid out like the bucket, e.g. <root_dir>/hrrr.20250101/conus/...")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    args = parser.parse_args()
+
+    handler = type("BoundLocalS3Handler", (LocalS3Handler,), {"root_dir": args.root_dir, "etags": {}})
+    print(f"Serving {args.root_dir} on http://{args.host}:{args.port}")
+    LocalS3Server((args.host, args.port), handler).serve_forever()
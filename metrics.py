@@ -0,0 +1,195 @@
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from config import METRICS_PREFIX
+
+
+class Metrics:
+    """
+    Thread-safe counters and timings of one process. Decode workers collect their own and send a snapshot back
+    with each result, which the pipeline merges into the main process's registry (see pipeline.extract_task).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}  # name -> [count, total seconds, max seconds]
+        self.peak_rss_bytes = 0  # largest worker RSS seen in snapshots
+
+    def count(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def timer(self, name: str):
+        return _Timer(self, name)
+
+    def reset(self):
+        with self._lock:
+            self.counters, self.timings, self.peak_rss_bytes = {}, {}, 0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "timings": {name: list(timing) for name, timing in self.timings.items()},
+                "peak_rss_bytes": peak_rss_bytes(),
+            }
+
+    def merge(self, snapshot: dict):
+        with self._lock:
+            for name, value in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, (count, total, longest) in snapshot["timings"].items():
+                timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+                timing[0] += count
+                timing[1] += total
+                timing[2] = max(timing[2], longest)
+            self.peak_rss_bytes = max(self.peak_rss_bytes, snapshot["peak_rss_bytes"])
+
+
+class _Timer:
+    def __init__(self, metrics: Metrics, name: str):
+        self.metrics, self.name = metrics, name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+
+
+def peak_rss_bytes(who: int = resource.RUSAGE_SELF) -> int:
+    """Peak resident set size (ru_maxrss is in KiB on Linux, bytes on macOS)."""
+    max_rss = resource.getrusage(who).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+_metrics = None
+
+
+def get_metrics() -> Metrics:
+    """Process-wide metrics registry."""
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+def build_report(metrics: Metrics, started_at: float, extra: dict = None) -> dict:
+    """
+    Run report: counters, per-stage timings, throughput and peak memory. Stage totals add up time spent in
+    each stage across all workers, so comparing download, decode and database totals shows which one bounds a run.
+    """
+    snapshot = metrics.snapshot()
+    counters, timings = snapshot["counters"], snapshot["timings"]
+    wall_seconds = time.time() - started_at
+
+    def rate(amount: str, timing: str) -> float:
+        seconds = timings.get(timing, [0, 0.0])[1]
+        return round(counters.get(amount, 0) / seconds, 1) if seconds else None
+
+    return {
+        "started_at": datetime.fromtimestamp(started_at, timezone.utc).isoformat(),
+        "wall_seconds": round(wall_seconds, 3),
+        **(extra or {}),
+        "counters": counters,
+        "timings": {
+            name: {
+                "count": count,
+                "total_seconds": round(total, 4),
+                "mean_seconds": round(total / count, 4),
+                "max_seconds": round(longest, 4),
+            }
+            for name, (count, total, longest) in sorted(timings.items())
+        },
+        "throughput": {
+            "download_bytes_per_second": rate("download.bytes", "download"),
+            "db_rows_per_second": rate("db.rows", "db.flush"),
+            "extracted_rows_per_second_of_wall": round(counters.get("extract.rows", 0) / wall_seconds, 1),
+        },
+        "peak_rss_bytes": {
+            "main": peak_rss_bytes(),
+            # Workers report their RSS with each result; RUSAGE_CHILDREN also covers workers that already exited
+            "workers": max(metrics.peak_rss_bytes, peak_rss_bytes(resource.RUSAGE_CHILDREN)),
+        },
+    }
+
+
+def _write_atomic(path: str, text: str):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)  # node_exporter's textfile collector must never read a partial file
+
+
+def write_json_report(report: dict, path: str):
+    _write_atomic(path, json.dumps(report, indent=2) + "\n")
+
+
+def write_prometheus_textfile(report: dict, path: str):
+    """Writes the report in the Prometheus text exposition format, for node_exporter's textfile collector."""
+
+    def metric_name(name: str) -> str:
+        return METRICS_PREFIX + "_" + "".join(c if c.isalnum() else "_" for c in name)
+
+    lines = [
+        f"# TYPE {METRICS_PREFIX}_wall_seconds gauge",
+        f"{METRICS_PREFIX}_wall_seconds {report['wall_seconds']}",
+    ]
+    for name, value in sorted(report["counters"].items()):
+        lines += [f"# TYPE {metric_name(name)}_total counter", f"{metric_name(name)}_total {value}"]
+    lines.append(f"# TYPE {METRICS_PREFIX}_stage_seconds summary")
+    for name, timing in report["timings"].items():
+        lines.append(f'{METRICS_PREFIX}_stage_seconds_sum{{stage="{name}"}} {timing["total_seconds"]}')
+        lines.append(f'{METRICS_PREFIX}_stage_seconds_count{{stage="{name}"}} {timing["count"]}')
+    lines.append(f"# TYPE {METRICS_PREFIX}_peak_rss_bytes gauge")
+    for process, value in report["peak_rss_bytes"].items():
+        lines.append(f'{METRICS_PREFIX}_peak_rss_bytes{{process="{process}"}} {value}')
+    _write_atomic(path, "\n".join(lines) + "\n")
+
+
+class Profiler:
+    """
+    Optional profiler of the main process: a `.html` path uses pyinstrument (if installed), anything else
+    cProfile, whose dump can be read with `python -m pstats` or snakeviz. Decode workers are not profiled.
+    Raises ImportError when an .html profile is requested without pyinstrument installed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if path.endswith(".html"):
+            from pyinstrument import Profiler as PyinstrumentProfiler  # optional dependency
+
+            self.profiler = PyinstrumentProfiler()
+        else:
+            self.profiler = cProfile.Profile()
+
+    def __enter__(self):
+        if self.path.endswith(".html"):
+            self.profiler.start()
+        else:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.path.endswith(".html"):
+            self.profiler.stop()
+            with open(self.path, "w") as f:
+                f.write(self.profiler.output_html())
+        else:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.path)
@@ -0,0 +1,189 @@
+import glob
+import logging
+import os
+import re
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import DEFAULT_OUTPUT, PARQUET_COMPRESSION, PARQUET_ROW_GROUP_ROWS
+from db_manager import to_arrow
+from metrics import get_metrics
+from utils import get_grib_s3_uri
+
+OUTPUT_PREFIX = "parquet://"
+# <root>/run_date=YYYY-MM-DD/cycle=HH/variable=<name>/f<FF>-<points digest>.parquet, Hive-style partitions.
+# A requested variable the GRIB file does not carry leaves an empty _f<FF>-<points digest>.absent marker instead;
+# the leading underscore makes pyarrow.dataset and Spark skip it, like their own _SUCCESS files.
+PARTITION_PATTERN = re.compile(
+    r"run_date=(\d{4}-\d{2}-\d{2})/cycle=(\d{2})/variable=([^/]+)/_?f(\d{2})-(\w+)\.(?:parquet|absent)$"
+)
+ABSENT_SUFFIX = ".absent"
+
+# GeoParquet 1.0 metadata: a WKB point geometry column in OGC:CRS84 (the default CRS when none is given)
+GEO_METADATA = (
+    b'{"version": "1.0.0", "primary_column": "geometry", '
+    b'"columns": {"geometry": {"encoding": "WKB", "geometry_types": ["Point"]}}}'
+)
+_WKB_POINT = np.dtype([("byte_order", "u1"), ("geometry_type", "<u4"), ("x", "<f8"), ("y", "<f8")])
+
+
+def parse_output(output: str) -> str:
+    """Returns the directory of a "parquet://<dir>" output, or None for the DuckDB database."""
+    if output == DEFAULT_OUTPUT:
+        return None
+    if output.startswith(OUTPUT_PREFIX) and output[len(OUTPUT_PREFIX) :]:
+        return output[len(OUTPUT_PREFIX) :]
+    raise ValueError(f"Unknown output '{output}', expected duckdb or parquet://<dir>")
+
+
+def wkb_points(lats: np.ndarray, lons: np.ndarray) -> pa.Array:
+    """Little-endian WKB points, built for all rows at once. Longitudes are wrapped into [-180, 180)."""
+    records = np.empty(len(lats), dtype=_WKB_POINT)
+    records["byte_order"] = 1
+    records["geometry_type"] = 1
+    records["x"] = (np.asarray(lons, dtype=np.float64) + 180.0) % 360.0 - 180.0
+    records["y"] = lats
+    fixed = pa.FixedSizeBinaryArray.from_buffers(
+        pa.binary(_WKB_POINT.itemsize), len(records), [None, pa.py_buffer(records.tobytes())]
+    )
+    return fixed.cast(pa.binary())
+
+
+def write_parquet_atomic(table: pa.Table, path: str):
+    """
+    Writes `table` to a hidden temporary file next to `path` and renames it into place, so readers (which skip
+    files starting with ".") never see a partial file, and a crash never leaves one behind under its final name.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}.tmp")
+    try:
+        pq.write_table(
+            table,
+            tmp_path,
+            row_group_size=PARQUET_ROW_GROUP_ROWS,
+            compression=PARQUET_COMPRESSION,
+            write_statistics=True,
+        )
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def get_loaded_sources(root: str, points_digest: str) -> dict:
+    """
+    Returns {source_s3: set of variables} already written under `root` for the point set identified by
+    points_digest, like db_manager.get_loaded_sources. The files themselves are the ledger: a file only appears
+    under its final name once it is completely written. Variables with an absent marker count as loaded.
+    """
+    loaded = {}
+    for path in glob.glob(os.path.join(root, "run_date=*", "cycle=*", "variable=*", f"*f*-{points_digest}.*")):
+        match = PARTITION_PATTERN.search(path.replace(os.sep, "/"))
+        if match is None:
+            continue
+        run_date, cycle, variable, forecast_hour, _ = match.groups()
+        source_s3 = get_grib_s3_uri(
+            datetime.strptime(run_date, "%Y-%m-%d").date(), int(forecast_hour), run_hour=int(cycle)
+        )
+        loaded.setdefault(source_s3, set()).add(variable)
+    return loaded
+
+
+def read_forecast_hour(root: str, run_date, run_hour: int, forecast_hour: int, points_digest: str) -> pd.DataFrame:
+    """
+    Reads the rows ParquetWriter wrote for one forecast hour back into the extractor's DataFrame layout:
+    the variable comes back from the partition path and the geometry column is dropped.
+    """
+    pattern = os.path.join(
+        root, f"run_date={run_date:%Y-%m-%d}", f"cycle={run_hour:02d}", "variable=*", f"f{forecast_hour:02d}-{points_digest}.parquet"
+    )
+    frames = []
+    for path in sorted(glob.glob(pattern)):
+        variable = PARTITION_PATTERN.search(path.replace(os.sep, "/")).group(3)
+        data_df = pq.read_table(path).drop_columns(["geometry"]).to_pandas()
+        data_df["variable"] = variable
+        frames.append(data_df)
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+class ParquetWriter:
+    """
+    Writes extracted data as Parquet files instead of into DuckDB, with the same interface as
+    db_manager.StreamingWriter. Every forecast hour and variable becomes one file, partitioned by run date,
+    cycle and variable, so any number of processes or hosts can write to the same directory without a shared
+    lock. Rows carry a GeoParquet point geometry next to the latitude/longitude columns.
+    """
+
+    def __init__(self, root: str, points_digest: str, variables: list = None):
+        self.root = root
+        self.points_digest = points_digest
+        self.variables = variables
+        self.written_rows = 0
+        self.point_map_path = os.path.join(root, "point_map", f"{points_digest}.parquet")
+        self.point_map_saved = os.path.exists(self.point_map_path)
+
+    def partition_path(self, run_time, valid_time, variable: str) -> str:
+        forecast_hour = int((valid_time - run_time).total_seconds() // 3600)
+        return os.path.join(
+            self.root,
+            f"run_date={run_time:%Y-%m-%d}",
+            f"cycle={run_time:%H}",
+            f"variable={variable}",
+            f"f{forecast_hour:02d}-{self.points_digest}.parquet",
+        )
+
+    def absent_path(self, run_time, valid_time, variable: str) -> str:
+        directory, name = os.path.split(self.partition_path(run_time, valid_time, variable))
+        return os.path.join(directory, "_" + os.path.splitext(name)[0] + ABSENT_SUFFIX)
+
+    def add(self, data_df):
+        """
+        Writes one forecast hour's rows right away, one file per variable, and an empty marker for each requested
+        variable the hour has no rows for, so reruns do not fetch the file again for it.
+        """
+        if data_df.empty:
+            return
+        flush_start = time.perf_counter()
+        run_time, valid_time = data_df["run_time_utc"].iloc[0], data_df["valid_time_utc"].iloc[0]
+        table = to_arrow(data_df)
+        table = table.append_column("geometry", wkb_points(data_df["latitude"], data_df["longitude"]))
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"geo": GEO_METADATA})
+
+        # Grid order clusters nearby points, so row group min/max statistics prune spatial filters
+        order = np.lexsort((data_df["grid_ix"].to_numpy(), data_df["grid_iy"].to_numpy()))
+        variables = data_df["variable"].to_numpy()[order]
+        for variable in data_df["variable"].unique():
+            rows = order[variables == variable]
+            # The variable is a partition key, so it is stored in the path rather than in the file
+            variable_table = table.take(pa.array(rows)).drop_columns(["variable"])
+            write_parquet_atomic(variable_table, self.partition_path(run_time, valid_time, str(variable)))
+        for variable in set(self.variables or []) - set(data_df["variable"].astype(str).unique()):
+            path = self.absent_path(run_time, valid_time, variable)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "wb").close()
+
+        get_metrics().observe("db.flush", time.perf_counter() - flush_start)
+        get_metrics().count("db.rows", len(data_df))
+        logging.info(f"Wrote {len(data_df)} records to {self.root}.")
+        self.written_rows += len(data_df)
+
+    def flush(self):
+        pass  # every forecast hour is written as soon as it is added
+
+    def discard(self):
+        pass  # nothing is buffered
+
+    def close(self):
+        pass
+
+    def save_point_map(self, map_df):
+        if map_df.empty:
+            return
+        write_parquet_atomic(pa.Table.from_pandas(map_df, preserve_index=False), self.point_map_path)
+        self.point_map_saved = True
@@ -0,0 +1,144 @@
+import logging
+import threading
+from contextlib import ExitStack
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from cache_manager import get_cache_manager
+from config import DEFAULT_INTERP, S3_BUCKET_URL
+from file_fetch import get_grib_file_path
+from hrrr_processor import extract_data_from_grib
+from metrics import get_metrics
+
+
+def extract_task(**kwargs):
+    """
+    Runs `extract_data_from_grib` in a decode worker and returns (DataFrame, metrics snapshot), so the
+    counters and timings collected in the worker reach the main process with the result.
+    """
+    get_metrics().reset()
+    data_df = extract_data_from_grib(**kwargs)
+    return data_df, get_metrics().snapshot()
+
+
+def run_pipeline(
+    s3_client,
+    tasks: list,  # [scheduler.IngestTask], processed in the given order
+    target_points: tuple,  # (lats, lons) float64 arrays of the points to extract
+    variables_to_ingest: list,
+    fetch_mode: str = "full",
+    download_workers: int = 4,
+    decode_workers: int = 2,
+    max_pending_files: int = None,
+    interp: str = DEFAULT_INTERP,
+    download_pool: ThreadPoolExecutor = None,
+    decode_pool: ProcessPoolExecutor = None,
+):
+    """
+    Downloads and decodes GRIB files concurrently. Yields (task, DataFrame) as each file is decoded.
+
+    Download threads fetch GRIB files into the cache while a process pool runs `extract_data_from_grib`
+    on files that are already on disk. At most `max_pending_files` files are downloaded ahead of the
+    decoders (back-pressure), so a slow decode stage does not let downloads fill the disk.
+    Each file stays pinned in the cache from download until its decode finishes, so LRU eviction
+    triggered by other downloads never removes a file that is still waiting to be decoded.
+
+    Pools passed in by the caller are reused and left running, so a long-running caller (see watcher)
+    keeps its decode processes, and the grid index they memoized, warm between calls.
+    """
+    max_pending_files = max_pending_files or download_workers + decode_workers
+    pending = threading.Semaphore(max_pending_files)
+    stopping = threading.Event()
+    # Files this call pinned and has not unpinned yet. Downloads that complete after the caller stopped
+    # consuming unpin their file themselves, so no pin outlives the call even in a caller-owned pool.
+    pinned, pin_lock = [], threading.Lock()
+
+    def download(task):
+        pending.acquire()
+        if stopping.is_set():
+            return None
+        try:
+            with get_metrics().timer("pipeline.fetch"):
+                grib_file_path = get_grib_file_path(
+                    s3_client,
+                    S3_BUCKET_URL,
+                    task.run_date,
+                    task.forecast_hour,
+                    fetch_mode,
+                    variables_to_ingest,
+                    pin=True,
+                    run_hour=task.run_hour,
+                )
+        except Exception:
+            pending.release()
+            raise
+        with pin_lock:
+            if stopping.is_set():
+                get_cache_manager().unpin(grib_file_path)
+                return None
+            pinned.append(grib_file_path)
+        return grib_file_path
+
+    def release(grib_file_path):
+        """Frees the download slot and the pin of a file whose decode finished."""
+        pending.release()
+        with pin_lock:
+            pinned.remove(grib_file_path)
+            get_cache_manager().unpin(grib_file_path)
+
+    with ExitStack() as pools:
+        download_pool = download_pool or pools.enter_context(ThreadPoolExecutor(download_workers))
+        decode_pool = decode_pool or pools.enter_context(ProcessPoolExecutor(decode_workers))
+        stages = {download_pool.submit(download, task): ("download", task, None) for task in tasks}
+        in_flight = set(stages)
+
+        try:
+            yield from _drain(stages, in_flight, release, decode_pool, target_points, variables_to_ingest, interp)
+        finally:
+            with pin_lock:
+                stopping.set()
+                for grib_file_path in pinned:
+                    get_cache_manager().unpin(grib_file_path)
+                pinned.clear()
+            for future in stages:
+                future.cancel()
+            # Unblock download threads still waiting for a slot so the pools can shut down early
+            for _ in range(download_workers):
+                pending.release()
+
+
+def _drain(stages, in_flight, release, decode_pool, target_points, variables_to_ingest, interp):
+    """Moves downloaded files into the decode pool and yields decoded files until all work is done."""
+    while in_flight:
+        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            stage, task, grib_file_path = stages.pop(future)
+
+            if stage == "download":
+                try:
+                    grib_file_path = future.result()
+                except Exception as e:
+                    logging.error(f"Failed to download {task}: {e}")
+                    get_metrics().count("pipeline.failed_downloads")
+                    continue
+                decode_future = decode_pool.submit(
+                    extract_task,
+                    grib_file=grib_file_path,
+                    source_s3=task.source_s3,
+                    point_lats=target_points[0],
+                    point_lons=target_points[1],
+                    variables_to_ingest=variables_to_ingest,
+                    interp=interp,
+                )
+                stages[decode_future] = ("decode", task, grib_file_path)
+                in_flight.add(decode_future)
+                continue
+
+            release(grib_file_path)
+            try:
+                data_df, worker_metrics = future.result()
+            except Exception as e:
+                logging.error(f"Failed to decode {task}: {e}")
+                get_metrics().count("pipeline.failed_decodes")
+                continue
+            get_metrics().merge(worker_metrics)
+            yield task, data_df
@@ -0,0 +1,143 @@
+"""
+asyncio S3 client for the public (unsigned) HRRR bucket.
+
+One aiohttp session with a pooled connector is shared by everything that talks to S3. The event loop runs on
+a background thread, so the synchronous methods (head_object, get_object, download_file, the same shapes
+as the boto3 calls they replace) can be called from the pipeline's download threads while the requests
+themselves run concurrently on the loop. Failed requests (connection errors, timeouts, 5xx) are retried
+with exponential backoff and jitter.
+"""
+
+import asyncio
+import io
+import logging
+import random
+import threading
+from urllib.parse import quote
+
+import aiohttp
+from botocore.exceptions import ClientError
+
+from config import DEFAULT_S3_CONNECTIONS, S3_ENDPOINT_URL, S3_MAX_RETRIES, S3_RETRY_BACKOFF
+from metrics import get_metrics
+
+RETRY_STATUSES = {500, 502, 503, 504}
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class _RetryableStatus(Exception):
+    pass
+
+
+class AsyncS3Client:
+    def __init__(
+        self,
+        endpoint_url: str = S3_ENDPOINT_URL,
+        max_connections: int = DEFAULT_S3_CONNECTIONS,
+        max_retries: int = S3_MAX_RETRIES,
+        retry_backoff: float = S3_RETRY_BACKOFF,
+    ):
+        self.endpoint_url = endpoint_url.rstrip("/") if endpoint_url else None
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._session = None
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="s3-event-loop", daemon=True).start()
+
+    def _url(self, bucket: str, key: str) -> str:
+        if self.endpoint_url:
+            return f"{self.endpoint_url}/{bucket}/{quote(key)}"
+        return f"https://{bucket}.s3.amazonaws.com/{quote(key)}"
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60),
+            )
+        return self._session
+
+    async def _request(self, method: str, bucket: str, key: str, handle, headers: dict = None):
+        """Sends a request and returns `await handle(response)`, retrying transient failures with backoff."""
+        url = self._url(bucket, key)
+        for attempt in range(self.max_retries + 1):
+            get_metrics().count(f"s3.{method.lower()}_requests")
+            try:
+                async with self._get_session().request(method, url, headers=headers) as response:
+                    if response.status in RETRY_STATUSES:
+                        raise _RetryableStatus(f"HTTP {response.status}")
+                    if response.status >= 400:
+                        code = str(response.status)
+                        raise ClientError({"Error": {"Code": code, "Message": response.reason}}, method)
+                    return await handle(response)
+            except (aiohttp.ClientError, asyncio.TimeoutError, _RetryableStatus) as e:
+                if attempt == self.max_retries:
+                    raise
+                get_metrics().count("s3.retries")
+                delay = self.retry_backoff * 2**attempt * (1 + random.random())
+                logging.warning(f"{method} {key} failed ({e!r}), retrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+
+    # --- coroutines ---
+
+    async def head(self, bucket: str, key: str) -> dict:
+        async def handle(response):
+            return {"ContentLength": response.content_length, "ETag": response.headers.get("ETag")}
+
+        return await self._request("HEAD", bucket, key, handle)
+
+    async def exists(self, bucket: str, key: str) -> bool:
+        try:
+            await self.head(bucket, key)
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "404":
+                return False
+            raise
+
+    async def get(self, bucket: str, key: str, byte_range: str = None) -> dict:
+        async def handle(response):
+            body = await response.read()
+            return {"Body": io.BytesIO(body), "ContentLength": len(body), "ETag": response.headers.get("ETag")}
+
+        return await self._request("GET", bucket, key, handle, headers={"Range": byte_range} if byte_range else None)
+
+    async def download(self, bucket: str, key: str, local_path: str) -> int:
+        """Streams an object to `local_path` in chunks. A retried download starts the file over."""
+
+        async def handle(response):
+            written = 0
+            with open(local_path, "wb") as f:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    written += len(chunk)
+            return written
+
+        return await self._request("GET", bucket, key, handle)
+
+    async def exists_all(self, bucket: str, keys: list) -> list[bool]:
+        return await asyncio.gather(*(self.exists(bucket, key) for key in keys))
+
+    # --- synchronous facade, safe to call from any thread except the event loop's ---
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        return self.run(self.head(Bucket, Key))
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None) -> dict:
+        return self.run(self.get(Bucket, Key, Range))
+
+    def download_file(self, bucket: str, key: str, local_path: str) -> int:
+        return self.run(self.download(bucket, key, local_path))
+
+    def exists_many(self, bucket: str, keys: list) -> list[bool]:
+        """Probes all keys concurrently in one burst. Returns whether each key exists, in order."""
+        return self.run(self.exists_all(bucket, keys))
+
+    def close(self):
+        if self._session is not None:
+            self.run(self._session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,79 @@
+import logging
+import os
+from datetime import date, timedelta
+from typing import NamedTuple
+
+from config import ALL_CYCLES, EXTENDED_CYCLES, MAX_FORECAST_HOUR, MAX_FORECAST_HOUR_HOURLY_CYCLES
+from file_fetch import get_cache_path
+from utils import get_grib_s3_uri
+
+
+class IngestTask(NamedTuple):
+    """One GRIB file to ingest: a forecast hour of the run started at `run_date` `run_hour`z."""
+
+    run_date: date
+    run_hour: int
+    forecast_hour: int
+
+    def __str__(self):
+        return f"{self.run_date:%Y-%m-%d} {self.run_hour:02}z f{self.forecast_hour:02}"
+
+    @property
+    def source_s3(self) -> str:
+        return get_grib_s3_uri(self.run_date, self.forecast_hour, run_hour=self.run_hour)
+
+
+def parse_cycles(text: str) -> list[int]:
+    """Parses "all" or a comma separated list of cycle hours like "0,6,12" into sorted, unique cycle hours."""
+    if text.strip().lower() == "all":
+        return list(ALL_CYCLES)
+    cycles = sorted({int(cycle) for cycle in text.split(",") if cycle.strip()})
+    invalid = [cycle for cycle in cycles if cycle not in ALL_CYCLES]
+    if not cycles or invalid:
+        raise ValueError(f"Cycles must be hours between 0 and 23, got '{text}'")
+    return cycles
+
+
+def date_range(start: date, end: date) -> list[date]:
+    """Dates from `start` to `end`, both inclusive."""
+    return [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+
+def max_forecast_hour(run_hour: int) -> int:
+    return MAX_FORECAST_HOUR if run_hour in EXTENDED_CYCLES else MAX_FORECAST_HOUR_HOURLY_CYCLES
+
+
+def plan_tasks(
+    run_dates: list,
+    cycles: list,
+    num_hours: int,
+    variables: list,
+    loaded_sources: dict = None,  # {source_s3: set of variables}, see db_manager.get_loaded_sources
+    fetch_mode: str = "full",
+) -> list[IngestTask]:
+    """
+    Builds the run date x cycle x forecast hour matrix of GRIB files to ingest. Forecast hours are capped at
+    what each cycle publishes, and files whose requested variables are all in the load ledger are skipped.
+
+    Files already in the local cache come first, so they are decoded before new downloads can evict them and
+    the decoders have work while the first downloads are still in flight. The rest follow run by run in
+    chronological order, so the download pool works through one run's files together.
+    """
+    loaded_sources = loaded_sources or {}
+    tasks = [
+        IngestTask(run_date, run_hour, forecast_hour)
+        for run_date in run_dates
+        for run_hour in cycles
+        for forecast_hour in range(min(num_hours, max_forecast_hour(run_hour)) + 1)
+    ]
+    planned = len(tasks)
+    tasks = [task for task in tasks if not set(variables) <= loaded_sources.get(task.source_s3, set())]
+    if len(tasks) < planned:
+        logging.info(f"Skipping {planned - len(tasks)} forecast hours already loaded for these points.")
+
+    def is_cached(task: IngestTask) -> bool:
+        return os.path.exists(
+            get_cache_path(task.run_date, task.forecast_hour, fetch_mode, variables, task.run_hour)
+        )
+
+    return sorted(tasks, key=lambda task: not is_cached(task))  # stable, keeps chronological order otherwise
@@ -0,0 +1,176 @@
+"""
+Synthetic HRRR fixtures for offline benchmarks: GRIB2 files on the real 1059x1799 Lambert conformal CONUS grid,
+holding one message per GRIB variable of VARIABLE_MAP, with their .idx inventories, laid out like the S3 bucket
+so local_s3.py can serve them.
+
+Fields are smooth gradients and waves plus a little noise, packed with complex packing and spatial differencing
+like HRRR's own files, so decode times and file sizes are close to the real thing.
+
+Usage:
+    python synthetic_hrrr.py bench_fixtures --hours 3
+    python local_s3.py bench_fixtures
+"""
+
+import argparse
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+import eccodes
+import numpy as np
+
+from config import GRIB_VARIABLES, VARIABLE_IDX_MAP, setup_logging
+from utils import get_grib_s3_key
+
+# Predates HRRR, so synthetic files never share a cache path with real ones
+SYNTHETIC_RUN_DATE = date(2000, 1, 1)
+
+HRRR_GRID_SHAPE = (1059, 1799)
+# Grid definition of HRRR's CONUS grid (GRIB2 template 3.30), as found in its wrfsfc files
+HRRR_GRID = {
+    "Nx": HRRR_GRID_SHAPE[1],
+    "Ny": HRRR_GRID_SHAPE[0],
+    "latitudeOfFirstGridPointInDegrees": 21.138123,
+    "longitudeOfFirstGridPointInDegrees": 237.280472,
+    "LaDInDegrees": 38.5,
+    "LoVInDegrees": 262.5,
+    "Latin1InDegrees": 38.5,
+    "Latin2InDegrees": 38.5,
+    "DxInMetres": 3000,
+    "DyInMetres": 3000,
+    "shapeOfTheEarth": 6,
+    "jScansPositively": 1,
+}
+
+# (discipline, parameterCategory, parameterNumber, typeOfFirstFixedSurface, level) of each GRIB variable, which
+# ecCodes maps back to the VARIABLE_MAP keys (NCEP local parameters need centre 7)
+GRIB_PARAMETERS = {
+    "surface_pressure": (0, 3, 0, 1, 0),
+    "surface_roughness": (2, 0, 1, 1, 0),
+    "visible_beam_downward_solar_flux": (0, 4, 200, 1, 0),
+    "visible_diffuse_downward_solar_flux": (0, 4, 201, 1, 0),
+    "temperature_2m": (0, 0, 0, 103, 2),
+    "dewpoint_2m": (0, 0, 6, 103, 2),
+    "relative_humidity_2m": (0, 1, 1, 103, 2),
+    "u_component_wind_10m": (0, 2, 2, 103, 10),
+    "v_component_wind_10m": (0, 2, 3, 103, 10),
+    "u_component_wind_80m": (0, 2, 2, 103, 80),
+    "v_component_wind_80m": (0, 2, 3, 103, 80),
+}
+
+# (base value, south-north change, wave amplitude, noise standard deviation) of each synthetic field
+FIELD_SHAPES = {
+    "surface_pressure": (100_000.0, -8_000.0, 1_500.0, 20.0),
+    "surface_roughness": (0.5, 0.2, 0.4, 0.01),
+    "visible_beam_downward_solar_flux": (300.0, -150.0, 120.0, 5.0),
+    "visible_diffuse_downward_solar_flux": (90.0, -40.0, 30.0, 2.0),
+    "temperature_2m": (300.0, -30.0, 5.0, 0.3),
+    "dewpoint_2m": (290.0, -30.0, 6.0, 0.3),
+    "relative_humidity_2m": (60.0, 10.0, 25.0, 1.0),
+    "u_component_wind_10m": (2.0, 3.0, 6.0, 0.5),
+    "v_component_wind_10m": (-1.0, 2.0, 5.0, 0.5),
+    "u_component_wind_80m": (4.0, 5.0, 9.0, 0.7),
+    "v_component_wind_80m": (-2.0, 3.0, 8.0, 0.7),
+}
+PACKING_BITS = 16
+
+
+def synthetic_field(var_name: str, forecast_hour: int, seed: int = 0) -> np.ndarray:
+    """A smooth, reproducible field for one variable and forecast hour, flattened in GRIB scanning order."""
+    base, gradient, amplitude, noise = FIELD_SHAPES[var_name]
+    rng = np.random.default_rng([seed, forecast_hour, GRIB_VARIABLES.index(var_name)])
+    ny, nx = HRRR_GRID_SHAPE
+    y = np.linspace(0.0, 1.0, ny)[:, None]
+    x = np.linspace(0.0, 2 * np.pi, nx)[None, :]
+    field = base + gradient * y + amplitude * np.sin(3 * x + forecast_hour / 6.0) * np.cos(5 * y)
+    return (field + rng.normal(0.0, noise, HRRR_GRID_SHAPE)).ravel()
+
+
+def encode_message(var_name: str, run_date: date, run_hour: int, forecast_hour: int, seed: int = 0) -> bytes:
+    discipline, category, number, surface, level = GRIB_PARAMETERS[var_name]
+    gid = eccodes.codes_grib_new_from_samples("GRIB2")
+    try:
+        eccodes.codes_set(gid, "centre", 7)
+        eccodes.codes_set(gid, "gridDefinitionTemplateNumber", 30)
+        for key, value in HRRR_GRID.items():
+            eccodes.codes_set(gid, key, value)
+        eccodes.codes_set(gid, "discipline", discipline)
+        eccodes.codes_set(gid, "parameterCategory", category)
+        eccodes.codes_set(gid, "parameterNumber", number)
+        eccodes.codes_set(gid, "typeOfFirstFixedSurface", surface)
+        if surface == 103:  # height above ground
+            eccodes.codes_set(gid, "scaleFactorOfFirstFixedSurface", 0)
+            eccodes.codes_set(gid, "scaledValueOfFirstFixedSurface", level)
+        eccodes.codes_set(gid, "dataDate", int(f"{run_date:%Y%m%d}"))
+        eccodes.codes_set(gid, "dataTime", run_hour * 100)
+        eccodes.codes_set(gid, "forecastTime", forecast_hour)
+        eccodes.codes_set(gid, "packingType", "grid_complex_spatial_differencing")
+        eccodes.codes_set(gid, "bitsPerValue", PACKING_BITS)
+        eccodes.codes_set_values(gid, synthetic_field(var_name, forecast_hour, seed))
+        return eccodes.codes_get_message(gid)
+    finally:
+        eccodes.codes_release(gid)
+
+
+def write_fixture(
+    root: str, run_date: date, run_hour: int, forecast_hour: int, variables: list = None, seed: int = 0
+) -> str:
+    """
+    Writes one synthetic GRIB2 file and its .idx inventory under `root` at the file's S3 key. Both are written
+    to temporary files first, so an interrupted run never leaves a fixture that looks complete.
+    """
+    path = os.path.join(root, get_grib_s3_key(run_date, forecast_hour, run_hour=run_hour))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    forecast = "anl" if forecast_hour == 0 else f"{forecast_hour} hour fcst"
+
+    offset, idx_lines = 0, []
+    with open(f"{path}.tmp", "wb") as f:
+        for number, var_name in enumerate(variables or GRIB_VARIABLES, start=1):
+            message = encode_message(var_name, run_date, run_hour, forecast_hour, seed)
+            idx_lines.append(f"{number}:{offset}:d={run_date:%Y%m%d}{run_hour:02}:{VARIABLE_IDX_MAP[var_name]}:{forecast}:")
+            f.write(message)
+            offset += len(message)
+    with open(f"{path}.idx.tmp", "w") as f:
+        f.write("\n".join(idx_lines) + "\n")
+    os.replace(f"{path}.tmp", path)
+    os.replace(f"{path}.idx.tmp", f"{path}.idx")
+    return path
+
+
+def write_fixtures(
+    root: str,
+    num_hours: int,
+    run_date: date = SYNTHETIC_RUN_DATE,
+    run_hour: int = 6,
+    seed: int = 0,
+    workers: int = None,
+    force: bool = False,
+) -> list:
+    """
+    Writes forecast hours 0..num_hours of one run in parallel, skipping files that already exist unless `force`.
+    Returns the paths of all files, in forecast hour order.
+    """
+    paths = [os.path.join(root, get_grib_s3_key(run_date, hour, run_hour=run_hour)) for hour in range(num_hours + 1)]
+    missing = [hour for hour, path in enumerate(paths) if force or not os.path.exists(f"{path}.idx")]
+    if missing:
+        logging.info(f"Writing {len(missing)} synthetic HRRR files to {root}...")
+        with ProcessPoolExecutor(workers) as pool:
+            list(pool.map(write_fixture, *zip(*[(root, run_date, run_hour, hour, None, seed) for hour in missing])))
+    return paths
+
+
+if __name__ == "__main__":
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Write synthetic HRRR GRIB2 files and .idx inventories.")
+    parser.add_argument("root_dir", help="Directory to lay the files out in, like the S3 bucket.")
+    parser.add_argument("--hours", type=int, default=2, help="Last forecast hour to write (f00 to f<hours>).")
+    parser.add_argument("--run-date", default=f"{SYNTHETIC_RUN_DATE:%Y-%m-%d}")
+    parser.add_argument("--cycle", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--force", action="store_true", help="Rewrite files that already exist.")
+    args = parser.parse_args()
+
+    run_date = date.fromisoformat(args.run_date)
+    for path in write_fixtures(args.root_dir, args.hours, run_date, args.cycle, args.seed, force=args.force):
+        print(path)
@@ -10,6 +10,8 @@ selected_vars = {}
 
 for variable in variables_to_extract:
     filter_keys = VARIABLE_MAP[variable]
+    if "expression" in filter_keys:
+        continue  # derived variable, computed from other variables
     try:
         ds = cfgrib.open_dataset(
             grib_file,
@@ -1,23 +1,39 @@
+import fcntl
+import functools
+import hashlib
 import logging
-import boto3
+import os
 import time
-from botocore import UNSIGNED
-from botocore.client import Config
-from botocore.exceptions import ClientError
+from contextlib import contextmanager
 from datetime import date, datetime, timezone, timedelta
+from typing import NamedTuple
 
 import xarray as xr
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 
-from config import S3_BUCKET_URL, RUN_HOUR, VARIABLE_MAP, setup_logging
+from config import DEFAULT_S3_CONNECTIONS, POINTS_CHUNK_ROWS, S3_BUCKET_URL, RUN_HOUR, VARIABLE_MAP, setup_logging
+from metrics import get_metrics
+from s3_async import AsyncS3Client
 
 setup_logging()
 
 
-def build_grib_file_path(forecast_hour: int, for_idx: bool = False) -> str:
+def get_s3_client(max_connections: int = DEFAULT_S3_CONNECTIONS) -> AsyncS3Client:
     """
-    Generates the grib file path for a given run date and forecast hour.
+    Creates an anonymous S3 client with a pooled async session, meant to be shared by the whole run.
+    HRRR_S3_ENDPOINT_URL points it at a local S3 stand-in.
+    """
+    return AsyncS3Client(max_connections=max_connections)
+
+
+def build_grib_file_path(forecast_hour: int, for_idx: bool = False, run_hour: int = RUN_HOUR) -> str:
+    """
+    Generates the grib file path for a given cycle (run_hour) and forecast hour.
     For example, for the file: hrrr.20250101/conus/hrrr.t06z.wrfsfcf00.grib2
     Year: 2025
     Month: 01
@@ -28,18 +44,18 @@ def build_grib_file_path(forecast_hour: int, for_idx: bool = False) -> str:
     FH (forecast hour): 48
     """
     product = "wrfsfcf"
-    file_path = f"hrrr.t{RUN_HOUR:02}z.{product}{forecast_hour:02}.grib2"
+    file_path = f"hrrr.t{run_hour:02}z.{product}{forecast_hour:02}.grib2"
     suffix = ".idx" if for_idx else ""
     return f"{file_path}{suffix}"
 
 
-def get_grib_s3_key(run_date: date, forecast_hour: int, for_idx: bool = False) -> str:
+def get_grib_s3_key(run_date: date, forecast_hour: int, for_idx: bool = False, run_hour: int = RUN_HOUR) -> str:
     sector = "conus"
-    file_path = build_grib_file_path(forecast_hour, for_idx)
+    file_path = build_grib_file_path(forecast_hour, for_idx, run_hour)
     return f"hrrr.{run_date:%Y%m%d}/{sector}/{file_path}"
 
 
-def get_grib_s3_uri(run_date: date, forecast_hour: int, for_idx: bool = False) -> str:
+def get_grib_s3_uri(run_date: date, forecast_hour: int, for_idx: bool = False, run_hour: int = RUN_HOUR) -> str:
     """
     Generates the S3 path for a given run date and forecast hour.
     For example, for the file: hrrr.20250101/conus/hrrr.t06z.wrfsfcf00.grib2
@@ -51,41 +67,318 @@ def get_grib_s3_uri(run_date: date, forecast_hour: int, for_idx: bool = False) -
     Variable: wrfsfcf
     FH (forecast hour): 48
     """
-    key = get_grib_s3_key(run_date, forecast_hour, for_idx)
+    key = get_grib_s3_key(run_date, forecast_hour, for_idx, run_hour)
     url = f"s3://{S3_BUCKET_URL}.s3.amazonaws.com/{key}"
     return url
 
 
-def read_points(filepath: str) -> list[dict]:
-    """Reads lat/lon points from a text file."""
-    points = []
+def parse_idx(idx_text: str) -> list[dict]:
+    """
+    Parses a wgrib2-style .idx inventory into a list of message entries.
+    Each line looks like: 1:0:d=2025010106:REFC:entire atmosphere:anl:
+    The last message has no known end byte (end is None), since the .idx does not record file size.
+    """
+    entries = []
+    for line in idx_text.splitlines():
+        parts = line.strip().split(":")
+        if len(parts) < 6:
+            continue
+        entries.append(
+            {
+                "message": int(parts[0]),
+                "start": int(parts[1]),
+                "end": None,
+                "date": parts[2],
+                "variable": parts[3],
+                "level": parts[4],
+                "forecast": parts[5],
+            }
+        )
+
+    entries.sort(key=lambda entry: entry["start"])
+    for entry, next_entry in zip(entries, entries[1:]):
+        entry["end"] = next_entry["start"] - 1
+    return entries
+
+
+def find_idx_byte_ranges(idx_entries: list[dict], idx_descriptions: list[str]) -> list[tuple]:
+    """
+    Resolves "VAR:level" descriptions (see VARIABLE_IDX_MAP) to (start, end) byte ranges.
+    The first matching message is used for each description, same as cfgrib picks the first match.
+    """
+    ranges = []
+    for description in idx_descriptions:
+        match = next((e for e in idx_entries if f"{e['variable']}:{e['level']}" == description), None)
+        if match is None:
+            raise ValueError(f"'{description}' not found in .idx inventory")
+        ranges.append((match["start"], match["end"]))
+    return ranges
+
+
+def coalesce_byte_ranges(ranges: list[tuple]) -> list[tuple]:
+    """Merges overlapping and adjacent (start, end) byte ranges so they can be fetched with fewer GETs."""
+    coalesced = []
+    for start, end in sorted(set(ranges), key=lambda r: r[0]):
+        if coalesced:
+            last_start, last_end = coalesced[-1]
+            if last_end is None or start <= last_end + 1:
+                coalesced[-1] = (last_start, None if last_end is None or end is None else max(last_end, end))
+                continue
+        coalesced.append((start, end))
+    return coalesced
+
+
+class Points(NamedTuple):
+    """Input points as contiguous float64 arrays, with the point IDs of the file (None if it has none)."""
+
+    lats: np.ndarray
+    lons: np.ndarray
+    ids: np.ndarray = None
+
+    @property
+    def point_ids(self) -> np.ndarray:
+        """The file's point IDs, or each point's position in the file."""
+        return self.ids if self.ids is not None else np.arange(len(self.lats)).astype(str)
+
+
+POINT_COLUMNS = ["latitude", "longitude", "point_id"]
+
+
+def _is_number(token: str) -> bool:
     try:
-        with open(filepath, "r") as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith("#"):
-                    continue
-                try:
-                    lat, lon = map(float, line.split(","))
-                    points.append({"latitude": lat, "longitude": lon})
-                except ValueError:
-                    logging.warning(f"Skipping invalid line in points file: {line}")
-        if not points:
-            raise ValueError(f"No valid points found in {filepath}")
-        return points
-    except FileNotFoundError:
+        float(token)
+        return True
+    except ValueError:
+        return False
+
+
+def _csv_header(filepath: str) -> list:
+    """
+    Column names of a CSV file's header line, or None if its first non-comment line is data: a header has no
+    numeric field, so a headerless file whose first row has one bad coordinate is still read as headerless.
+    """
+    with open(filepath, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            tokens = [token.strip() for token in line.split(",")]
+            return None if any(_is_number(token) for token in tokens) else tokens
+    return None
+
+
+def _csv_line_numbers(filepath: str, has_header: bool) -> np.ndarray:
+    """1-based line numbers of a points CSV's data rows, skipping blank and comment lines like the readers do."""
+    numbers = []
+    with open(filepath, "r") as f:
+        for number, line in enumerate(f, start=1):
+            if line.split("#", 1)[0].strip():
+                numbers.append(number)
+    return np.array(numbers[1:] if has_header else numbers, dtype=np.int64)
+
+
+def _read_points_csv(filepath: str, chunk_rows: int) -> list:
+    """
+    Reads a points CSV, with or without a header line, into {column: array} chunks. Arrow's multithreaded
+    reader streams well-formed files; files with comments or unparsable values are re-read with pandas,
+    which turns bad coordinates into NaN so they can be dropped.
+    """
+    header = _csv_header(filepath)
+    if header is None:
+        names = {"latitude": "latitude", "longitude": "longitude"}
+        read_options = pa_csv.ReadOptions(column_names=list(names), block_size=chunk_rows * 32)
+    else:
+        names = {column.lower(): column for column in header if column.lower() in POINT_COLUMNS}
+        if "latitude" not in names or "longitude" not in names:
+            raise ValueError(f"{filepath} has a header without latitude and longitude columns: {', '.join(header)}")
+        read_options = pa_csv.ReadOptions(skip_rows=1, column_names=header, block_size=chunk_rows * 32)
+    convert_options = pa_csv.ConvertOptions(
+        include_columns=list(names.values()),
+        column_types={name: "string" if column == "point_id" else "float64" for column, name in names.items()},
+    )
+    try:
+        chunks = []
+        with pa_csv.open_csv(filepath, read_options=read_options, convert_options=convert_options) as reader:
+            for batch in reader:
+                chunks.append(
+                    {column: batch.column(name).to_numpy(zero_copy_only=False) for column, name in names.items()}
+                )
+        return chunks
+    except pa.ArrowInvalid:
+        pass
+
+    if header is None:
+        options = {"header": None, "names": ["latitude", "longitude"]}
+    else:
+        options = {"header": 0, "usecols": lambda column: column.strip().lower() in POINT_COLUMNS}
+    reader = pd.read_csv(
+        filepath,
+        comment="#",
+        skip_blank_lines=True,
+        skipinitialspace=True,
+        dtype={"point_id": str},
+        chunksize=chunk_rows,
+        **options,
+    )
+    chunks = []
+    for chunk in reader:
+        chunk.columns = [column.strip().lower() for column in chunk.columns]
+        chunks.append({column: chunk[column].to_numpy() for column in chunk.columns})
+    return chunks
+
+
+def _read_points_parquet(filepath: str, chunk_rows: int):
+    """
+    Yields {column: array} record-batch chunks of a points Parquet file. Coordinates stored as strings are passed
+    on as they are, so read_points can drop the non-numeric ones instead of failing on the whole file.
+    """
+    parquet_file = pq.ParquetFile(filepath)
+    names = parquet_file.schema_arrow.names
+    columns = {name.lower(): name for name in names if name.lower() in POINT_COLUMNS}
+    if "latitude" not in columns or "longitude" not in columns:
+        raise ValueError(f"{filepath} has no latitude and longitude columns, found {', '.join(names) or 'none'}")
+    for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=list(columns.values())):
+        chunk = {}
+        for column, name in columns.items():
+            array = batch.column(name)
+            if column == "point_id" or not (pa.types.is_integer(array.type) or pa.types.is_floating(array.type)):
+                chunk[column] = pc.cast(array, "string").to_numpy(zero_copy_only=False)
+            else:
+                chunk[column] = pc.cast(array, "float64").to_numpy(zero_copy_only=False)
+        yield chunk
+
+
+def read_points(filepath: str, chunk_rows: int = POINTS_CHUNK_ROWS) -> Points:
+    """
+    Reads points from a CSV/text or Parquet (.parquet, .pq) file, `chunk_rows` rows at a time.
+
+    CSV files are either headerless `latitude,longitude` lines (lines starting with # are comments), or have
+    a header with `latitude` and `longitude` columns and an optional `point_id` column, as do Parquet files.
+    Rows with non-numeric or out-of-range coordinates, or without a point ID, are dropped with a warning that
+    gives their 1-based line numbers (row numbers for Parquet); point IDs must be unique.
+    """
+    if not os.path.exists(filepath):
         logging.error(f"Points file not found: {filepath}")
-        raise
+        raise FileNotFoundError(filepath)
+
+    is_parquet = os.path.splitext(filepath)[1].lower() in (".parquet", ".pq")
+    reader = _read_points_parquet if is_parquet else _read_points_csv
+    lats, lons, ids = [], [], []
+    for chunk in reader(filepath, chunk_rows):
+        if "latitude" not in chunk or "longitude" not in chunk:
+            raise ValueError(f"{filepath} needs latitude and longitude columns, found {', '.join(chunk) or 'none'}")
+        lats.append(pd.to_numeric(chunk["latitude"], errors="coerce").astype(np.float64, copy=False))
+        lons.append(pd.to_numeric(chunk["longitude"], errors="coerce").astype(np.float64, copy=False))
+        if "point_id" in chunk:
+            ids.append(chunk["point_id"])
+
+    lats = np.concatenate(lats) if lats else np.empty(0)
+    lons = np.concatenate(lons) if lons else np.empty(0)
+    ids = np.concatenate(ids) if ids else None
+
+    numeric = np.isfinite(lats) & np.isfinite(lons)
+    in_range = (np.abs(lats) <= 90) & (lons >= -180) & (lons <= 360)
+    valid = numeric & in_range
+    problems = {"non-numeric lat/lon": ~numeric, "out-of-range lat/lon": numeric & ~in_range}
+    if ids is not None:
+        problems["missing point_id"] = valid & pd.isna(ids)
+        valid &= pd.notna(ids)
+    if not valid.all():
+        invalid = np.flatnonzero(~valid)
+        if is_parquet:
+            unit, positions = "row", invalid + 1
+        else:
+            unit, positions = "line", _csv_line_numbers(filepath, _csv_header(filepath) is not None)[invalid]
+        counts = ", ".join(f"{int(mask.sum())} with {problem}" for problem, mask in problems.items() if mask.any())
+        shown = ", ".join(str(position) for position in positions[:10]) + (", ..." if len(positions) > 10 else "")
+        unit += "s" if len(invalid) > 1 else ""
+        logging.warning(f"Skipping {len(invalid)} invalid points in {filepath} ({counts}) at {unit} {shown}")
+        lats, lons = lats[valid], lons[valid]
+        ids = ids[valid] if ids is not None else None
+    if not len(lats):
+        raise ValueError(f"No valid points found in {filepath}")
+
+    if ids is not None and len(pd.unique(ids)) < len(ids):
+        duplicated = pd.Series(ids).duplicated().to_numpy()
+        raise ValueError(f"Duplicate point_id values in {filepath}, e.g. '{ids[duplicated][0]}'")
+    return Points(np.ascontiguousarray(lats), np.ascontiguousarray(lons), ids)
+
+
+def unique_points(lats: np.ndarray, lons: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Drops repeated (latitude, longitude) pairs, keeping the first occurrence of each in input order."""
+    first = ~pd.Series(lats + 1j * lons).duplicated().to_numpy()  # one hashable value per pair
+    return lats[first], lons[first]
+
+
+def points_digest(lats: np.ndarray, lons: np.ndarray, interp: str = "nearest", ids: np.ndarray = None) -> str:
+    """
+    Short fingerprint of a point set, used to tell whether a source file was already loaded for these points.
+    Interpolated values differ from nearest-cell ones, so any other `interp` method is part of the fingerprint,
+    as are point IDs read from the file (they are stored in the point map).
+    """
+    lats = np.ascontiguousarray(lats, dtype=np.float64)
+    lons = np.ascontiguousarray(lons, dtype=np.float64)
+    suffix = b"" if interp == "nearest" else interp.encode()
+    if ids is not None:
+        suffix += "\n".join(ids).encode()
+    return hashlib.sha1(lats.tobytes() + lons.tobytes() + suffix).hexdigest()[:16]
+
+
+def s3_etag(path: str, part_size: int = None) -> str:
+    """
+    Computes the ETag S3 reports for an unencrypted object with the contents of `path`: the MD5 of the file,
+    or for a multipart upload with `part_size` byte parts, the MD5 of the concatenated part MD5s plus "-<parts>".
+    """
+    whole = hashlib.md5()
+    part_digests = []
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(part_size or 8 * 1024 * 1024), b""):
+            whole.update(chunk)
+            part_digests.append(hashlib.md5(chunk).digest())
+    if part_size is None:
+        return whole.hexdigest()
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+@contextmanager
+def file_lock(lock_path: str, blocking: bool = True):
+    """
+    Exclusive advisory lock shared by threads and processes on this host (flock on a .lock file).
+    Yields whether the lock was taken: without `blocking`, it gives up at once if someone else holds it.
+    The holder may delete the lock file (see cache_manager); whoever was waiting on it then locks it anew.
+    """
+    os.makedirs(os.path.dirname(lock_path) or ".", exist_ok=True)
+    while True:
+        lock_file = open(lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            lock_file.close()
+            yield False
+            return
+        try:
+            if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        lock_file.close()  # locked a file that was deleted meanwhile, retry on the current one
+    try:
+        yield True
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
 
 
 def timeit(name=None):
     def decorator(func):
+        @functools.wraps(func)  # keeps the function picklable for process pools
         def wrapper(*args, **kwargs):
             label = name or func.__name__
             start = time.time()
             result = func(*args, **kwargs)
             duration = time.time() - start
             logging.info(f"[TIMER] {label} took {duration:.2f} seconds")
+            get_metrics().observe(label, duration)
             return result
 
         return wrapper
@@ -0,0 +1,171 @@
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from config import DEFAULT_INTERP, DEFAULT_POLL_INTERVAL, S3_BUCKET_URL, WATCH_LOOKBACK_HOURS, WATCH_MAX_ATTEMPTS
+from hrrr_processor import map_task_points
+from metrics import get_metrics
+from pipeline import run_pipeline
+from scheduler import IngestTask, max_forecast_hour
+from utils import Points, get_grib_s3_key
+
+
+def active_runs(now: datetime, cycles: list, lookback_hours: int = WATCH_LOOKBACK_HOURS) -> list[tuple]:
+    """(run_date, run_hour) of the requested cycles that started within the last `lookback_hours`, oldest first."""
+    run_start = now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=lookback_hours)
+    runs = []
+    while run_start <= now:
+        if run_start.hour in cycles:
+            runs.append((run_start.date(), run_start.hour))
+        run_start += timedelta(hours=1)
+    return runs
+
+
+def next_tasks(
+    runs: list, num_hours: int, variables: list, loaded_sources: dict, finished: set, lookahead: int = 1
+) -> list:
+    """
+    The earliest `lookahead` forecast hours of each run that are neither in the load ledger nor finished in this
+    session, in forecast hour order. Probing several at once lets a watcher that starts mid-run or comes back from
+    an outage catch up through the pipeline instead of one hour per poll.
+    """
+    tasks = []
+    for run_date, run_hour in runs:
+        run_tasks = []
+        for forecast_hour in range(min(num_hours, max_forecast_hour(run_hour)) + 1):
+            task = IngestTask(run_date, run_hour, forecast_hour)
+            if task in finished or set(variables) <= loaded_sources.get(task.source_s3, set()):
+                continue
+            run_tasks.append(task)
+            if len(run_tasks) == lookahead:
+                break
+        tasks.extend(run_tasks)
+    return tasks
+
+
+def published_prefix(tasks: list, published: list) -> list:
+    """
+    The tasks of each run up to its first unpublished one. NOAA publishes a run's forecast hours in order, so an
+    hour present after a missing one is not expected; it is left for the poll that finds the gap filled.
+    """
+    ready, blocked = [], set()
+    for task, is_published in zip(tasks, published):
+        run = (task.run_date, task.run_hour)
+        if not is_published:
+            blocked.add(run)
+        elif run not in blocked:
+            ready.append(task)
+    return ready
+
+
+def watch(
+    s3_client,
+    writer,  # db_manager.StreamingWriter
+    target_points: tuple,  # (lats, lons) of the unique points to extract
+    variables_to_ingest: list,
+    cycles: list,
+    num_hours: int,
+    loaded_sources: dict,
+    fetch_mode: str = "full",
+    download_workers: int = 4,
+    decode_workers: int = 2,
+    max_pending_files: int = None,
+    interp: str = DEFAULT_INTERP,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+    lookback_hours: int = WATCH_LOOKBACK_HOURS,
+    stop: threading.Event = None,
+    input_points: Points = None,  # every input point, for the point map; defaults to target_points
+):
+    """
+    Ingests forecast hours of the newest runs as soon as they are published, until `stop` is set.
+
+    Every poll probes the .idx inventory of the next `max_pending_files` forecast hours of each active run (all
+    in one concurrent burst). NOAA uploads the .idx after its GRIB file, so a present .idx means the hour is ready.
+    The published hours of each run up to its first missing one go through the usual download/decode pipeline
+    together and are committed as they come out. After a batch the runs are probed again without waiting, so
+    hours that landed meanwhile are picked up immediately.
+
+    The S3 client, DB connection and pools stay open between polls, so decode workers keep their memoized
+    grid index. An hour that fails `WATCH_MAX_ATTEMPTS` times is given up on so its run can move on.
+    """
+    stop = stop or threading.Event()
+    input_points = input_points or Points(*target_points)
+    finished = set()  # ingested or given up on in this session
+    attempts = {}
+    lookahead = max_pending_files or download_workers + decode_workers  # hours the pipeline keeps in flight
+
+    with ThreadPoolExecutor(download_workers) as download_pool, ProcessPoolExecutor(decode_workers) as decode_pool:
+        while not stop.is_set():
+            runs = active_runs(datetime.now(timezone.utc), cycles, lookback_hours)
+            finished = {task for task in finished if (task.run_date, task.run_hour) in runs}
+            attempts = {task: count for task, count in attempts.items() if (task.run_date, task.run_hour) in runs}
+            candidates = next_tasks(runs, num_hours, variables_to_ingest, loaded_sources, finished, lookahead)
+
+            idx_keys = [
+                get_grib_s3_key(task.run_date, task.forecast_hour, for_idx=True, run_hour=task.run_hour)
+                for task in candidates
+            ]
+            try:
+                published = s3_client.exists_many(S3_BUCKET_URL, idx_keys)
+            except Exception as e:
+                logging.error(f"Failed to poll S3 for new forecast hours: {e}")
+                stop.wait(poll_interval)
+                continue
+            ready = published_prefix(candidates, published)
+            if not ready:
+                stop.wait(poll_interval)
+                continue
+
+            logging.info(f"New forecast hours on S3: {', '.join(str(task) for task in ready)}")
+            ingested = set()
+            results = run_pipeline(
+                s3_client,
+                ready,
+                target_points,
+                variables_to_ingest,
+                fetch_mode=fetch_mode,
+                download_workers=download_workers,
+                decode_workers=decode_workers,
+                max_pending_files=max_pending_files,
+                interp=interp,
+                download_pool=download_pool,
+                decode_pool=decode_pool,
+            )
+            try:
+                for task, data_df in results:
+                    if data_df.empty:
+                        continue
+                    try:
+                        if not writer.point_map_saved:
+                            map_df = map_task_points(
+                                task, fetch_mode, variables_to_ingest, input_points, interp, s3_client
+                            )
+                            if map_df.empty:
+                                logging.error(f"Could not map the points to the grid of {task}.")
+                                continue  # counts as a failed attempt below
+                            writer.save_point_map(map_df)
+                        writer.add(data_df)
+                        writer.flush()
+                    except Exception as e:
+                        # A failed write (database error, full disk) costs the hour an attempt, not the daemon
+                        logging.error(f"Failed to write {task}: {e}")
+                        get_metrics().count("watch.failed_writes")
+                        writer.discard()
+                        continue
+                    ingested.add(task)
+                    run_start = datetime.combine(task.run_date, datetime.min.time(), timezone.utc)
+                    age = datetime.now(timezone.utc) - run_start - timedelta(hours=task.run_hour)
+                    logging.info(f"Ingested {task}, {age.total_seconds() / 60:.0f} minutes after the run started.")
+            finally:
+                results.close()  # releases the pins of hours not consumed if anything above raised
+
+            finished |= ingested
+            for task in set(ready) - ingested:
+                attempts[task] = attempts.get(task, 0) + 1
+                if attempts[task] >= WATCH_MAX_ATTEMPTS:
+                    logging.error(f"Giving up on {task} after {attempts[task]} failed attempts.")
+                    finished.add(task)
+                    del attempts[task]
+            if not ingested:
+                stop.wait(poll_interval)  # back off instead of retrying a failing hour in a tight loop